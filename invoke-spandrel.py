@@ -1,7 +1,17 @@
 import sys
 import json
 import importlib.util
+import importlib.metadata
 import os
+import argparse
+import hashlib
+import struct
+import subprocess
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import as_completed
+from pathlib import Path
+from typing import Any, Literal, Optional
 
 
 def is_installed(package: str) -> bool:
@@ -18,35 +28,607 @@ def return_error(message: str):
     sys.exit(0)
 
 
-def print_metadata(file: str):
+def ensure_spandrel() -> Optional[str]:
+    """
+    Makes sure that spandrel can be imported. Returns an error message if it can't.
+
+    Everything pip prints goes to stderr, so stdout stays reserved for results.
+    """
+
+    if is_installed("spandrel"):
+        return None
+
+    if not is_installed("torch"):
+        return "PyTorch is not installed. Install PyTorch on your system's Python installation to automatically detect model metadata."
+
+    print("Installing spandrel...", file=sys.stderr, flush=True)
+    subprocess.run(
+        [sys.executable, "-m", "pip", "install", "spandrel"], stdout=sys.stderr
+    )
+    importlib.invalidate_caches()
+    if not is_installed("spandrel"):
+        return "Failed to install spandrel."
+    return None
+
+
+class MetadataError(Exception):
+    pass
+
+
+DetectMode = Literal["auto", "header", "full"]
+
+SAFETENSORS_DTYPES = {
+    "F64": "float64",
+    "F32": "float32",
+    "F16": "float16",
+    "BF16": "bfloat16",
+    "I64": "int64",
+    "I32": "int32",
+    "I16": "int16",
+    "I8": "int8",
+    "U8": "uint8",
+    "BOOL": "bool",
+}
+
+
+# Tensors with at most this many elements and all integer tensors are read from model
+# files in header-only detection, since architectures read values like window sizes
+# from them. Only the shapes of larger weights are used.
+HEADER_MAX_VALUE_ELEMENTS = 1024
+
+
+def read_safetensors_header(file: str) -> tuple[dict[str, Any], int]:
+    """Returns the header of the file and the offset of its tensor data."""
+
+    with open(file, "rb") as f:
+        (length,) = struct.unpack("<Q", f.read(8))
+        if length > 100 * 1024 * 1024:
+            raise ValueError("Invalid safetensors header")
+        header: dict[str, Any] = json.loads(f.read(length))
+    header.pop("__metadata__", None)
+    return header, 8 + length
+
+
+def needs_values(shape: Any, floating: bool) -> bool:
+    numel = 1
+    for size in shape:
+        numel *= size
+    return not floating or numel <= HEADER_MAX_VALUE_ELEMENTS
+
+
+def load_meta_state_dict(file: str) -> dict[str, Any]:
+    """
+    Returns the state dict of the given file with all large weights on the meta device.
+
+    Meta tensors only have a shape and dtype, so their data is never read. Small and
+    integer tensors are read, see `HEADER_MAX_VALUE_ELEMENTS`. For safetensors, only
+    the JSON header and those tensors are read. Other files are memory-mapped and only
+    the pages of those tensors are touched. This only works for the zip-based format of
+    `torch.save` and files without custom classes.
+    """
+
+    import torch
+
+    if file.lower().endswith(".safetensors"):
+        header, data_start = read_safetensors_header(file)
+        state_dict: dict[str, Any] = {}
+        with open(file, "rb") as f:
+            for key, info in header.items():
+                dtype = getattr(torch, SAFETENSORS_DTYPES[info["dtype"]])
+                if not needs_values(info["shape"], dtype.is_floating_point):
+                    state_dict[key] = torch.empty(
+                        info["shape"], dtype=dtype, device="meta"
+                    )
+                    continue
+                start, end = info["data_offsets"]
+                f.seek(data_start + start)
+                data = bytearray(f.read(end - start))
+                if data:
+                    tensor = torch.frombuffer(data, dtype=dtype).reshape(info["shape"])
+                else:
+                    # frombuffer doesn't accept empty buffers
+                    tensor = torch.empty(info["shape"], dtype=dtype)
+                state_dict[key] = tensor
+        return state_dict
+
+    def to_meta(value: Any) -> Any:
+        if isinstance(value, torch.Tensor):
+            if needs_values(value.shape, value.is_floating_point()):
+                return value.clone()
+            return value.to("meta")
+        if isinstance(value, dict):
+            return {k: to_meta(v) for k, v in value.items()}  # type: ignore
+        return value
+
+    state_dict = torch.load(file, map_location="cpu", mmap=True, weights_only=True)
+    return to_meta(state_dict)
+
+
+def materialize(state_dict: dict[str, Any]) -> dict[str, Any]:
+    """Replaces meta tensors with uninitialized CPU tensors of the same shape."""
+
+    import torch
+
+    def convert(value: Any) -> Any:
+        if isinstance(value, torch.Tensor) and value.is_meta:
+            return torch.empty_like(value, device="cpu")
+        if isinstance(value, dict):
+            return {k: convert(v) for k, v in value.items()}  # type: ignore
+        return value
+
+    return convert(state_dict)
+
+
+def describe_model(model: Any, detection: str) -> dict[str, Any]:
+    return {
+        "architecture": model.architecture.name,
+        "tags": model.tags,
+        "scale": model.scale,
+        "inputChannels": model.input_channels,
+        "outputChannels": model.output_channels,
+        "detection": detection,
+    }
+
+
+def get_metadata(loader: Any, file: str, detect: DetectMode = "auto") -> dict[str, Any]:
+    """
+    Detects the metadata of a model file.
+
+    In `auto` mode, the architecture is first detected from tensor names and shapes
+    alone (`"detection": "header"`), and the file is only fully loaded if that fails
+    (`"detection": "full"`).
+    """
+
     import spandrel
 
+    if detect != "full":
+        try:
+            import torch
+
+            state_dict = load_meta_state_dict(file)
+            try:
+                with torch.device("meta"):
+                    model = spandrel.MAIN_REGISTRY.load(state_dict)
+            except spandrel.UnsupportedModelError:
+                raise
+            except Exception:
+                # Some constructors need real tensors, e.g. transformers like SwinIR
+                # and DAT call `.item()`. The model is built on the CPU then, which
+                # still doesn't read the weights from the file.
+                model = spandrel.MAIN_REGISTRY.load(materialize(state_dict))
+            return describe_model(model, "header")
+        except spandrel.UnsupportedModelError:
+            if detect == "header":
+                raise MetadataError("Unsupported model architecture")
+        except Exception as e:
+            if detect == "header":
+                raise MetadataError(f"Header-only detection failed: {e}")
+
     try:
-        loader = spandrel.ModelLoader()
         model = loader.load_from_file(file)
+    except spandrel.UnsupportedModelError:
+        raise MetadataError("Unsupported model architecture")
+
+    return describe_model(model, "full")
+
+
+def print_metadata(file: str, detect: DetectMode = "auto"):
+    import spandrel
+
+    try:
+        return_success(get_metadata(spandrel.ModelLoader(), file, detect))
+    except MetadataError as e:
+        return_error(str(e))
+
+
+def serve(concurrency: int, max_requests: int, detect: DetectMode = "auto"):
+    """
+    Reads JSON requests from stdin and writes JSON responses to stdout, one per line.
+
+    Request:  {"id": 1, "file": "path/to/model.pth"}
+    Response: {"id": 1, "status": "ok", "data": {...}}
+              {"id": 1, "status": "error", "error": "message"}
+
+    Spandrel and the model loader are only initialized once, so all requests after the
+    first are warm. Responses may be written in a different order than the requests were
+    received. If `max_requests` is positive, the server stops reading after that many
+    requests, finishes the ones it accepted, and exits. The caller is expected to resend
+    all requests that did not get a response to a new server.
+    """
+
+    output_lock = threading.Lock()
+
+    def respond(response: dict[str, Any]):
+        line = json.dumps(response)
+        with output_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    install_error = ensure_spandrel()
+    loader: Any = None
+    if install_error is None:
+        import spandrel
+
+        loader = spandrel.ModelLoader()
+
+    def handle(request_id: Any, file: str):
+        try:
+            if install_error is not None:
+                raise MetadataError(install_error)
+            data = get_metadata(loader, file, detect)
+            respond({"id": request_id, "status": "ok", "data": data})
+        except MetadataError as e:
+            respond({"id": request_id, "status": "error", "error": str(e)})
+        except Exception as e:
+            respond(
+                {
+                    "id": request_id,
+                    "status": "error",
+                    "error": f"{type(e).__name__}: {e}",
+                }
+            )
+
+    handled = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                request = json.loads(line)
+                request_id = request["id"]
+                file = str(request["file"])
+            except (ValueError, KeyError, TypeError) as e:
+                respond(
+                    {"id": None, "status": "error", "error": f"Invalid request: {e}"}
+                )
+                continue
+
+            pool.submit(handle, request_id, file)
+
+            handled += 1
+            if max_requests > 0 and handled >= max_requests:
+                break
+
+
+MODEL_FILE_EXTENSIONS = (".pth", ".pt", ".ckpt", ".safetensors")
 
-        return_success(
-            {
-                "architecture": model.architecture.name,
-                "tags": model.tags,
-                "scale": model.scale,
-                "inputChannels": model.input_channels,
-                "outputChannels": model.output_channels,
+
+def sha256_file(file: str) -> str:
+    h = hashlib.sha256()
+    with open(file, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_spandrel_version() -> str:
+    try:
+        return importlib.metadata.version("spandrel")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+
+def read_cached_result(
+    cache_dir: Path, sha256: str, version: str
+) -> Optional[dict[str, Any]]:
+    file = cache_dir / f"{sha256}.json"
+    try:
+        entry = json.loads(file.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get("spandrel") != version:
+        # a different version of spandrel might detect the model differently
+        return None
+    result = entry.get("result")
+    # malformed entries are misses
+    return result if isinstance(result, dict) else None
+
+
+class ResultCache:
+    """
+    Detection results keyed by the sha256 of the model file.
+
+    The sha256 of a file is remembered together with its size and modification time,
+    so unchanged files don't have to be hashed again.
+    """
+
+    def __init__(self, directory: Path, version: str):
+        self.directory = directory
+        self.version = version
+        self.index_file = directory / "_files.json"
+        self.files: dict[str, dict[str, Any]] = {}
+        if self.index_file.exists():
+            self.files = json.loads(self.index_file.read_text(encoding="utf-8"))
+
+    def known_hash(self, file: Path) -> Optional[str]:
+        entry = self.files.get(str(file.resolve()))
+        if entry is None:
+            return None
+        stat = file.stat()
+        if entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            return None
+        return entry["sha256"]
+
+    def remember_hash(self, file: Path, sha256: str):
+        stat = file.stat()
+        self.files[str(file.resolve())] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "sha256": sha256,
+        }
+
+    def get(self, sha256: str) -> Optional[dict[str, Any]]:
+        return read_cached_result(self.directory, sha256, self.version)
+
+    def put(self, sha256: str, result: dict[str, Any]):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entry = {"spandrel": self.version, "result": result}
+        file = self.directory / f"{sha256}.json"
+        file.write_text(json.dumps(entry), encoding="utf-8")
+
+    def save(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.index_file.write_text(json.dumps(self.files), encoding="utf-8")
+
+
+_batch_loader: Any = None
+
+
+def check_file(
+    file: str, cache_dir: str, version: str, detect: DetectMode
+) -> tuple[str, dict[str, Any], bool, bool]:
+    """
+    Runs in a worker process. Returns the sha256 of the file, the detection result,
+    whether the result came from the cache, and whether it may be cached.
+
+    Only successful detections and `MetadataError`s are the same every time. Other
+    errors (e.g. running out of memory or failing to read the file) may not happen
+    again, so they aren't cached.
+    """
+
+    global _batch_loader
+
+    sha256 = sha256_file(file)
+    cached = read_cached_result(Path(cache_dir), sha256, version)
+    if cached is not None:
+        return sha256, cached, True, False
+
+    try:
+        if _batch_loader is None:
+            import spandrel
+
+            _batch_loader = spandrel.ModelLoader()
+
+        result = {"status": "ok", "data": get_metadata(_batch_loader, file, detect)}
+    except MetadataError as e:
+        result = {"status": "error", "error": str(e)}
+    except Exception as e:
+        result = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+        return sha256, result, False, False
+    return sha256, result, False, True
+
+
+def collect_model_files(paths: list[str]) -> list[Path]:
+    files: list[Path] = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(
+                sorted(
+                    f
+                    for f in path.rglob("*")
+                    if f.is_file() and f.suffix.lower() in MODEL_FILE_EXTENSIONS
+                )
+            )
+        else:
+            files.append(path)
+    return files
+
+
+def find_arch(architectures: dict[str, Any], search: str) -> Optional[str]:
+    """The same lookup the website uses to turn spandrel's architecture name into an id."""
+
+    def normalize(s: str) -> str:
+        return s.replace(" ", "").replace("-", "").lower()
+
+    for arch_id, arch in architectures.items():
+        if search.lower() in (arch_id.lower(), arch["name"].lower()):
+            return arch_id
+    for arch_id, arch in architectures.items():
+        if normalize(arch["name"]) == normalize(search):
+            return arch_id
+    return None
+
+
+class ModelAudit:
+    """Compares detection results with the model files in the database."""
+
+    def __init__(self, data_dir: Path):
+        self.by_sha256: dict[str, list[tuple[str, dict[str, Any]]]] = {}
+        self.architectures: dict[str, Any] = {}
+
+        arch_file = data_dir / "architectures.json"
+        if arch_file.exists():
+            self.architectures = json.loads(arch_file.read_text(encoding="utf-8"))
+
+        for file in sorted((data_dir / "models").glob("*.json")):
+            model = json.loads(file.read_text(encoding="utf-8"))
+            for resource in model.get("resources", []):
+                sha256 = resource.get("sha256")
+                if sha256:
+                    self.by_sha256.setdefault(sha256, []).append((file.stem, model))
+
+    def check(self, sha256: str, data: Optional[dict[str, Any]]) -> list[Any]:
+        results: list[Any] = []
+        for model_id, model in self.by_sha256.get(sha256, []):
+            mismatches: dict[str, Any] = {}
+            if data is not None:
+                arch = find_arch(self.architectures, data["architecture"])
+                # spandrel's names don't map onto all of our ids, so unknown names
+                # are not reported
+                if arch is not None and arch != model["architecture"]:
+                    mismatches["architecture"] = {
+                        "expected": model["architecture"],
+                        "actual": arch,
+                    }
+                for key in ("scale", "inputChannels", "outputChannels"):
+                    if model.get(key) != data[key]:
+                        mismatches[key] = {
+                            "expected": model.get(key),
+                            "actual": data[key],
+                        }
+            results.append({"id": model_id, "mismatches": mismatches})
+        return results
+
+
+def run_batch(
+    paths: list[str],
+    workers: int,
+    cache_dir: Path,
+    data_dir: Path,
+    detect: DetectMode = "auto",
+):
+    """
+    Detects the metadata of many model files in a process pool.
+
+    One JSON object is printed per file as soon as its result is known. Results are
+    cached by the sha256 of the file, so only new or changed files are loaded. If the
+    sha256 of a file appears in the `resources` of a model in the database, the result
+    is also compared with the architecture, scale, and channels of that model.
+    """
+
+    cache = ResultCache(cache_dir, get_spandrel_version())
+    audit = ModelAudit(data_dir)
+
+    def emit(file: Path, sha256: Optional[str], result: dict[str, Any], cached: bool):
+        line: dict[str, Any] = {"file": str(file), "sha256": sha256, "cached": cached}
+        line.update(result)
+        if sha256 is not None and sha256 in audit.by_sha256:
+            line["models"] = audit.check(sha256, result.get("data"))
+        print(json.dumps(line), flush=True)
+
+    pending: list[Path] = []
+    for file in collect_model_files(paths):
+        if not file.is_file():
+            emit(file, None, {"status": "error", "error": "File not found"}, False)
+            continue
+        sha256 = cache.known_hash(file)
+        result = cache.get(sha256) if sha256 is not None else None
+        if sha256 is not None and result is not None:
+            emit(file, sha256, result, True)
+        else:
+            pending.append(file)
+
+    if pending:
+        install_error = ensure_spandrel()
+        if install_error is not None:
+            for file in pending:
+                emit(file, None, {"status": "error", "error": install_error}, False)
+            return
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures: dict[Future[tuple[str, dict[str, Any], bool, bool]], Path] = {
+                pool.submit(
+                    check_file, str(file), str(cache_dir), cache.version, detect
+                ): file
+                for file in pending
             }
-        )
-    except spandrel.UnsupportedModelError:
-        return_error("Unsupported model architecture")
+            for future in as_completed(futures):
+                file = futures[future]
+                try:
+                    sha256, result, cached, cacheable = future.result()
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                    emit(file, None, {"status": "error", "error": error}, False)
+                    continue
+
+                cache.remember_hash(file, sha256)
+                if cacheable:
+                    cache.put(sha256, result)
+                emit(file, sha256, result, cached)
+    finally:
+        cache.save()
 
 
 if __name__ == "__main__":
-    if not is_installed("spandrel"):
-        if is_installed("torch"):
-            print("Installing spandrel...")
-            current_python = sys.executable
-            os.system(current_python + " -m pip install spandrel")
-        else:
-            return_error(
-                "PyTorch is not installed. Install PyTorch on your system's Python installation to automatically detect model metadata."
-            )
+    parser = argparse.ArgumentParser(
+        description="Detects the architecture, scale, and channels of model files using spandrel."
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        metavar="file",
+        help="The model file to inspect. Batch mode accepts many files and directories.",
+    )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="Keep spandrel loaded and answer JSON-lines requests from stdin.",
+    )
+    parser.add_argument(
+        "--detect",
+        choices=["auto", "header", "full"],
+        default="auto",
+        help="auto detects models from tensor shapes and only fully loads them if that fails.",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Inspect all given files and directories and print one JSON line per file.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="The number of worker processes in batch mode.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        default=Path(".spandrel-cache"),
+        help="Where batch mode caches results by the sha256 of model files.",
+    )
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=Path("data"),
+        help="The database that batch mode compares results with.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=2,
+        help="The maximum number of models the server loads at the same time.",
+    )
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=0,
+        help="Exit the server after this many requests. 0 means no limit.",
+    )
+    args = parser.parse_args()
+
+    if args.server:
+        serve(max(1, args.concurrency), args.max_requests, args.detect)
+        sys.exit(0)
+
+    if args.batch:
+        run_batch(
+            args.files,
+            max(1, args.workers),
+            args.cache_dir,
+            args.data_dir,
+            args.detect,
+        )
+        sys.exit(0)
+
+    if len(args.files) != 1:
+        parser.error("exactly one model file is required without --batch or --server")
+
+    error = ensure_spandrel()
+    if error is not None:
+        return_error(error)
 
-    print_metadata(sys.argv[1])
+    print_metadata(args.files[0], args.detect)
@@ -0,0 +1,319 @@
+"""
+Benchmarks `thumbnails.py` without network access.
+
+Synthetic models and LR/SR image pairs are generated in a temporary workspace and
+served by a local HTTP server that stands in for the image hosts and openmodeldb.info.
+The thumbnail pipeline then runs twice: once with empty caches (cold) and once more
+on the result (warm).
+
+    python3 scripts/benchmark-thumbnails.py --models 100 --output bench.json
+"""
+
+from __future__ import annotations
+from contextlib import contextmanager, redirect_stdout
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Iterator, Optional
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from metrics import Metrics
+import thumbnails
+
+# (width, height) of LR images. SR images are these times the scale.
+LR_SIZES = [(320, 240), (480, 320), (640, 480), (960, 540), (1280, 720)]
+SCALES = [1, 2, 2, 4, 4, 4, 8]
+# SR images larger than this are generated from smaller LR images
+MAX_SR_PIXELS = 4096 * 3072
+STANDALONE_SIZES = [(1920, 1080), (1200, 1600), (2560, 1440), (800, 800)]
+
+
+def synthetic_image(rng: np.random.Generator, width: int, height: int) -> np.ndarray:
+    """Smooth shapes with some noise, so encoders have something to work with."""
+
+    base = rng.integers(0, 256, (height // 32 + 2, width // 32 + 2, 3), dtype=np.uint8)
+    img = cv2.resize(base, (width, height), interpolation=cv2.INTER_CUBIC)
+    for _ in range(8):
+        center = int(rng.integers(0, width)), int(rng.integers(0, height))
+        radius = int(rng.integers(4, max(5, min(width, height) // 4)))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.circle(img, center, radius, color, thickness=int(rng.integers(1, 6)))
+    noise = rng.integers(0, 8, img.shape, dtype=np.uint8)
+    return cv2.add(img, noise)
+
+
+def write_image(directory: Path, name: str, img: np.ndarray) -> str:
+    cv2.imwrite(str(directory / name), img)
+    return name
+
+
+class Fixtures:
+    def __init__(self, workspace: Path, models: int, seed: int):
+        self.workspace = workspace
+        self.models = models
+        self.seed = seed
+
+    @property
+    def serve_dir(self) -> Path:
+        return self.workspace / "serve"
+
+    @property
+    def models_dir(self) -> Path:
+        return self.workspace / "models"
+
+    @property
+    def config_file(self) -> Path:
+        return self.workspace / "fixtures.json"
+
+    @property
+    def config(self) -> dict[str, int]:
+        return {"models": self.models, "seed": self.seed}
+
+    def exists(self) -> bool:
+        """Whether the workspace already has these fixtures from an earlier run."""
+
+        if not self.config_file.exists():
+            return False
+        return json.loads(self.config_file.read_text(encoding="utf-8")) == self.config
+
+    def generate(self):
+        """Generates the model files and the images they reference."""
+
+        shutil.rmtree(self.serve_dir, ignore_errors=True)
+        shutil.rmtree(self.models_dir, ignore_errors=True)
+        rng = np.random.default_rng(self.seed)
+        choice = random.Random(self.seed)
+        images_dir = self.serve_dir / "images"
+        images_dir.mkdir(parents=True, exist_ok=True)
+        self.models_dir.mkdir(parents=True, exist_ok=True)
+
+        for i in range(self.models):
+            scale = choice.choice(SCALES)
+            lr_size = choice.choice(LR_SIZES)
+            while lr_size[0] * lr_size[1] * scale * scale > MAX_SR_PIXELS:
+                lr_size = lr_size[0] // 2, lr_size[1] // 2
+
+            images: list[dict[str, Any]] = []
+            for j in range(choice.randint(1, 3)):
+                ext = choice.choice(["png", "jpg"])
+                sr = synthetic_image(rng, lr_size[0] * scale, lr_size[1] * scale)
+                lr = cv2.resize(sr, lr_size, interpolation=cv2.INTER_AREA)
+                if ext == "png" and choice.random() < 0.2:
+                    alpha = np.full(lr.shape[:2], 255, np.uint8)
+                    alpha[: lr.shape[0] // 4] = 128
+                    lr = np.dstack([lr, alpha])
+                images.append(
+                    {
+                        "type": "paired",
+                        "LR": write_image(images_dir, f"{i}-{j}-lr.{ext}", lr),
+                        "SR": write_image(images_dir, f"{i}-{j}-sr.{ext}", sr),
+                    }
+                )
+            if choice.random() < 0.25:
+                width, height = choice.choice(STANDALONE_SIZES)
+                img = synthetic_image(rng, width, height)
+                name = write_image(images_dir, f"{i}-standalone.jpg", img)
+                images.insert(
+                    choice.randint(0, len(images)), {"type": "standalone", "url": name}
+                )
+
+            model = {
+                "name": f"Benchmark {i}",
+                "author": "benchmark",
+                "license": "CC0-1.0",
+                "tags": [],
+                "description": "",
+                "date": "2024-01-01",
+                "architecture": "esrgan",
+                "size": None,
+                "scale": scale,
+                "inputChannels": 3,
+                "outputChannels": 3,
+                "resources": [],
+                "images": images,
+            }
+            file = self.models_dir / f"{scale}x-Benchmark-{i}.json"
+            file.write_text(json.dumps(model, indent=4), encoding="utf-8")
+
+        self.config_file.write_text(json.dumps(self.config), encoding="utf-8")
+
+    def install(self, target: Path, base_url: str):
+        """Copies the model files to `target`, with image URLs pointing to `base_url`."""
+
+        target.mkdir(parents=True, exist_ok=True)
+        for file in self.models_dir.glob("*.json"):
+            model = json.loads(file.read_text(encoding="utf-8"))
+            for image in model["images"]:
+                for key in ("LR", "SR", "url"):
+                    if key in image:
+                        image[key] = base_url + "images/" + image[key]
+            (target / file.name).write_text(
+                json.dumps(model, indent=4), encoding="utf-8"
+            )
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format: str, *args: Any):
+        pass
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request: Any, client_address: Any):
+        # clients that only read the start of an image close the connection early
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+@contextmanager
+def serve(directory: Path) -> Iterator[str]:
+    """Serves the directory on a free local port and yields its base URL."""
+
+    handler = partial(QuietHandler, directory=str(directory))
+    server = QuietServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run_pipeline(
+    site: Path, base_url: str, verbose: bool, **kwargs: Any
+) -> tuple[float, Metrics]:
+    # nothing is cached on the stand-in for openmodeldb.info
+    thumbnails.REMOTE_THUMBNAIL_URL = base_url + "remote/thumbs/"
+    thumbnails.REMOTE_IMAGE_METADATA_URL = (
+        thumbnails.REMOTE_THUMBNAIL_URL + "_image-metadata.json"
+    )
+    thumbnails.CACHE_ZIP_URL = base_url + "remote/thumbs.zip"
+    thumbnails.CACHE_BUNDLE_MANIFEST_URL = base_url + "remote/thumbs.json"
+    # in-memory caches would make later runs look faster than they are
+    thumbnails.get_image_index.cache_clear()
+    thumbnails.import_image_metadata.cache_clear()
+    thumbnails.decoded_image_cache = thumbnails.DecodedImageCache(
+        thumbnails.DECODED_IMAGE_CACHE_BYTES
+    )
+
+    cwd = os.getcwd()
+    os.chdir(site)
+    try:
+        output = sys.stdout if verbose else io.StringIO()
+        start = time.perf_counter()
+        with redirect_stdout(output):
+            metrics = thumbnails.process(**kwargs)
+        return time.perf_counter() - start, metrics
+    finally:
+        os.chdir(cwd)
+
+
+def summarize(seconds: float, metrics: Metrics, models: int) -> dict[str, Any]:
+    decoded = metrics.stages.get("decode")["count"]
+    encoded = metrics.stages.get("encode")["count"]
+    return {
+        "seconds": seconds,
+        "stages": metrics.stages.as_dict(),
+        "counters": metrics.counters.as_dict(),
+        "throughput": {
+            "models/s": models / seconds,
+            "images/s": decoded / seconds,
+            "thumbnails/s": encoded / seconds,
+        },
+    }
+
+
+def print_summary(name: str, result: dict[str, Any]):
+    print(f"\n{name}: {result['seconds']:.2f}s")
+    for stage, total in result["stages"].items():
+        print(f"  {stage:<14} {total['seconds']:8.3f}s {total['count']:6}x")
+    for counter, value in result["counters"].items():
+        print(f"  {counter:<18} {value:12}")
+    for unit, value in result["throughput"].items():
+        print(f"  {value:10.2f} {unit}")
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks `thumbnails.py` without network access."
+    )
+    parser.add_argument("--models", type=int, default=50, help="The number of models.")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the fixtures.")
+    parser.add_argument("--download-workers", type=int, default=16)
+    parser.add_argument("--encode-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--workspace",
+        type=Path,
+        help="Where to generate the fixtures. Defaults to a temporary directory that is deleted afterwards.",
+    )
+    parser.add_argument(
+        "--output", type=Path, help="Write the results as JSON to this file."
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="Show the output of thumbnails.py."
+    )
+    args = parser.parse_args(argv)
+
+    workspace: Path = args.workspace or Path(
+        tempfile.mkdtemp(prefix="thumbnail-bench-")
+    )
+    try:
+        fixtures = Fixtures(workspace, args.models, args.seed)
+        if fixtures.exists():
+            print(f"Reusing fixtures in {workspace}", flush=True)
+        else:
+            print(f"Generating {args.models} models in {workspace}", flush=True)
+            start = time.perf_counter()
+            fixtures.generate()
+            duration = time.perf_counter() - start
+            print(f"Generated fixtures in {duration:.2f}s", flush=True)
+
+        site = workspace / "site"
+        shutil.rmtree(site, ignore_errors=True)
+
+        results: dict[str, Any] = {}
+        with serve(fixtures.serve_dir) as base_url:
+            fixtures.install(site / thumbnails.MODEL_FILES_DIR, base_url)
+            for name in ("cold", "warm"):
+                seconds, metrics = run_pipeline(
+                    site,
+                    base_url,
+                    args.verbose,
+                    download_workers=args.download_workers,
+                    encode_workers=args.encode_workers,
+                )
+                results[name] = summarize(seconds, metrics, args.models)
+                print_summary(name, results[name])
+
+        if args.output:
+            report = {
+                "config": {
+                    "models": args.models,
+                    "seed": args.seed,
+                    "downloadWorkers": args.download_workers,
+                    "encodeWorkers": args.encode_workers,
+                },
+                "runs": results,
+            }
+            args.output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    finally:
+        if args.workspace is None:
+            shutil.rmtree(workspace, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Build a cache bundle of the thumbnail cache for `thumbnails.py` to restore.
+
+    python scripts/build-cache-bundle.py thumbs.tar
+    python scripts/build-cache-bundle.py thumbs-2.tar --base thumbs.json
+
+Next to the bundle, its manifest is written as JSON (e.g. thumbs.json, which clients
+download from CACHE_BUNDLE_MANIFEST_URL). With --base, only files that are missing
+from or changed since the base manifest are bundled, and the manifest refers to the
+bundles of the base for the others. The new bundle has to be published next to them.
+"""
+
+from __future__ import annotations
+from pathlib import Path
+from typing import Optional
+import argparse
+import json
+import time
+
+from cache_bundle import (
+    BUNDLE_VERSION,
+    BundleManifest,
+    build_manifest,
+    get_changed,
+    write_bundle,
+)
+
+CACHE_THUMBNAIL_DIR = Path(".thumb-cache/thumbs/")
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Build a cache bundle of the thumbnail cache for `thumbnails.py` to restore."
+    )
+    parser.add_argument("output", type=Path, help="The bundle file to write.")
+    parser.add_argument(
+        "--base",
+        type=Path,
+        help="The manifest of an earlier bundle. Only changed files are bundled.",
+    )
+    parser.add_argument(
+        "--directory",
+        type=Path,
+        default=CACHE_THUMBNAIL_DIR,
+        help=f"The directory to bundle. Defaults to {CACHE_THUMBNAIL_DIR}.",
+    )
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    manifest = build_manifest(args.directory)
+    names = list(manifest["entries"])
+    if args.base is not None:
+        base: BundleManifest = json.loads(args.base.read_text(encoding="utf-8"))
+        if base.get("version") != BUNDLE_VERSION:
+            parser.error(f"{args.base} has an unsupported version, rebuild it")
+        names = get_changed(manifest, base)
+
+    write_bundle(args.output, args.directory, manifest, names)
+    manifest_file = args.output.with_suffix(".json")
+    manifest_file.write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+
+    size = args.output.stat().st_size
+    duration = time.perf_counter() - start
+    print(
+        f"Bundled {len(names)} of {len(manifest['entries'])} files ({size} bytes) in {duration:.2f}s"
+    )
+    print(f"Wrote {args.output} and {manifest_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Bundles of cached files that are restored with HTTP range requests.
+
+A bundle is an uncompressed tar archive of cached files (thumbnails are compressed
+already). Next to it, a manifest lists the size and SHA256 of every file of the
+directory it was built from, and where its data is: the bundle (relative to the
+manifest) and the offset in it. Clients only download the byte ranges of the files they
+are missing. Ranges that are close together are merged, so restoring an empty cache
+reads each bundle with about one request.
+
+A delta bundle only contains the files that are missing from or changed since a base
+manifest. Its manifest lists all files, and refers to the bundles of the base for the
+unchanged ones. Clients only need the latest manifest to restore from a chain of
+deltas, as long as all bundles stay published next to each other.
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass
+from hashlib import sha256
+from multiprocessing.pool import ThreadPool
+from pathlib import Path, PurePosixPath
+from typing import IO, Optional, TypedDict
+import os
+import tarfile
+import tempfile
+
+from object_store import sha256_file
+
+BUNDLE_VERSION = 2
+CHUNK_SIZE = 1024 * 1024
+# Ranges with at most this many bytes between them are downloaded with one request.
+# This includes the tar header of each file (512 bytes or a few more).
+MAX_RANGE_GAP = 64 * 1024
+
+
+class BundleEntry(TypedDict):
+    size: int
+    sha256: str
+    # the bundle with the data of the file, relative to the manifest
+    bundle: str
+    # the offset of the data in the bundle
+    offset: int
+
+
+class BundleManifest(TypedDict):
+    version: int
+    entries: dict[str, BundleEntry]
+
+
+def get_files(directory: Path) -> list[str]:
+    """The names of all files of the directory as they appear in bundles."""
+
+    return sorted(
+        file.relative_to(directory).as_posix()
+        for file in directory.glob("**/*")
+        if file.is_file() and file.suffix != ".part"
+    )
+
+
+def build_manifest(directory: Path, workers: int = 8) -> BundleManifest:
+    """
+    Returns the manifest of the directory. The locations of the files are unknown until
+    a bundle is written, see `write_bundle`.
+    """
+
+    names = get_files(directory)
+
+    def entry(name: str) -> BundleEntry:
+        file = directory / name
+        return {
+            "size": file.stat().st_size,
+            "sha256": sha256_file(file),
+            "bundle": "",
+            "offset": 0,
+        }
+
+    with ThreadPool(workers) as pool:
+        entries = dict(zip(names, pool.map(entry, names)))
+    return {"version": BUNDLE_VERSION, "entries": entries}
+
+
+def get_changed(manifest: BundleManifest, base: BundleManifest) -> list[str]:
+    """
+    Returns the entries of the manifest that aren't the same in `base`. The others
+    are updated to the locations of the base.
+    """
+
+    changed: list[str] = []
+    for name, entry in manifest["entries"].items():
+        base_entry = base["entries"].get(name)
+        if (
+            base_entry is None
+            or base_entry["size"] != entry["size"]
+            or base_entry["sha256"] != entry["sha256"]
+        ):
+            changed.append(name)
+        else:
+            entry["bundle"] = base_entry["bundle"]
+            entry["offset"] = base_entry["offset"]
+    return changed
+
+
+def get_missing(manifest: BundleManifest, directory: Path) -> list[str]:
+    """
+    Returns the entries of the manifest that the directory doesn't have. Files are
+    only compared by size, since hashing all of them would take longer than a restore.
+    """
+
+    missing: list[str] = []
+    for name, entry in manifest["entries"].items():
+        try:
+            if (directory / name).stat().st_size == entry["size"]:
+                continue
+        except FileNotFoundError:
+            pass
+        missing.append(name)
+    return missing
+
+
+def write_bundle(
+    file: Path, directory: Path, manifest: BundleManifest, names: list[str]
+):
+    """
+    Writes a bundle with the given entries of the directory, and updates their
+    locations in the manifest.
+    """
+
+    file.parent.mkdir(parents=True, exist_ok=True)
+    with tarfile.open(file, "w", format=tarfile.PAX_FORMAT) as tar:
+        for name in names:
+            source = directory / name
+            # cached files are often hardlinks of each other, but `tar.add` would
+            # store those as links, which can't be extracted on their own
+            info = tarfile.TarInfo(name)
+            stat = source.stat()
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            header = info.tobuf(tar.format, tar.encoding, tar.errors)
+            entry = manifest["entries"][name]
+            entry["bundle"] = file.name
+            entry["offset"] = tar.offset + len(header)
+            with source.open("rb") as f:
+                tar.addfile(info, f)
+
+
+def is_safe_name(name: str) -> bool:
+    path = PurePosixPath(name)
+    return not path.is_absolute() and ".." not in path.parts
+
+
+@dataclass
+class BundleRange:
+    """A byte range of a bundle and the files in it."""
+
+    bundle: str
+    start: int
+    end: int
+    names: list[str]
+
+
+def get_ranges(manifest: BundleManifest, names: list[str]) -> list[BundleRange]:
+    """
+    Returns the byte ranges of the bundles that contain the given files. Files are
+    downloaded together if they are at most `MAX_RANGE_GAP` bytes apart.
+    """
+
+    by_bundle: dict[str, list[str]] = {}
+    for name in names:
+        if is_safe_name(name):
+            by_bundle.setdefault(manifest["entries"][name]["bundle"], []).append(name)
+
+    ranges: list[BundleRange] = []
+    for bundle, bundle_names in by_bundle.items():
+        bundle_names.sort(key=lambda name: manifest["entries"][name]["offset"])
+        current: Optional[BundleRange] = None
+        for name in bundle_names:
+            entry = manifest["entries"][name]
+            end = entry["offset"] + entry["size"]
+            if current is not None and entry["offset"] - current.end <= MAX_RANGE_GAP:
+                current.end = max(current.end, end)
+                current.names.append(name)
+            else:
+                current = BundleRange(bundle, entry["offset"], end, [name])
+                ranges.append(current)
+    return ranges
+
+
+def extract_range(
+    stream: IO[bytes],
+    bundle_range: BundleRange,
+    manifest: BundleManifest,
+    directory: Path,
+) -> int:
+    """
+    Extracts the files of the range from a stream of its bytes into the directory, and
+    checks them against the manifest. Returns the number of extracted files.
+    """
+
+    position = bundle_range.start
+    for name in bundle_range.names:
+        entry = manifest["entries"][name]
+        skip(stream, entry["offset"] - position)
+        extract_file(stream, directory / name, entry)
+        position = entry["offset"] + entry["size"]
+    return len(bundle_range.names)
+
+
+def skip(stream: IO[bytes], size: int):
+    while size > 0:
+        chunk = stream.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            raise ValueError("Unexpected end of the bundle")
+        size -= len(chunk)
+
+
+def extract_file(source: IO[bytes], file: Path, entry: BundleEntry):
+    """Streams the data of the entry from the source to the file and checks it."""
+
+    file.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=file.parent, prefix=file.name, suffix=".part")
+    try:
+        h = sha256()
+        remaining = entry["size"]
+        with os.fdopen(fd, "wb") as f:
+            while remaining > 0:
+                chunk = source.read(min(remaining, CHUNK_SIZE))
+                if not chunk:
+                    raise ValueError("Unexpected end of the bundle")
+                h.update(chunk)
+                f.write(chunk)
+                remaining -= len(chunk)
+        if h.hexdigest() != entry["sha256"]:
+            raise ValueError(f"{file.name} doesn't match the bundle manifest")
+        # other files may be hardlinks to the previous file, see object_store.py
+        os.replace(temp, file)
+    except BaseException:
+        os.unlink(temp)
+        raise
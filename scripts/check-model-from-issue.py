@@ -0,0 +1,340 @@
+"""
+Checks `model-from-issue.py` against a mock of the GitHub API, without network access.
+
+    python scripts/check-model-from-issue.py
+
+The mock serves the open issues of a repository in pages with Link headers and ETags,
+filters them by `since`, answers conditional requests with 304, and can pretend that
+the rate limit is exceeded. `model-from-issue.py` runs several times in a workspace
+with a copy of the model files, and each run is checked for the requests it made, the
+model files it (re)wrote, and the cache it left behind.
+"""
+
+from __future__ import annotations
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field
+from hashlib import sha256
+from pathlib import Path
+from typing import Any, Optional
+import argparse
+import asyncio
+import copy
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from aiohttp import web
+
+MODEL_FROM_ISSUE = Path(__file__).parent / "model-from-issue.py"
+MODEL_FILES_DIR = Path(__file__).parent.parent / "data/models/"
+REPO = "octo/models"
+ISSUES = 12
+# small pages, so the issues span a few of them
+PER_PAGE = 5
+
+
+def load_model_from_issue() -> Any:
+    spec = importlib.util.spec_from_file_location("model_from_issue", MODEL_FROM_ISSUE)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@dataclass
+class Request:
+    path: str
+    query: dict[str, str]
+    status: int
+
+
+@dataclass
+class MockGitHub:
+    """The issues API of one repository."""
+
+    issues: dict[int, Any] = field(default_factory=dict)
+    requests: list[Request] = field(default_factory=list)
+    # the page of lists that fails because the rate limit is exceeded
+    rate_limited_page: Optional[str] = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes(
+            [
+                web.get(f"/repos/{REPO}/issues", self.list_issues),
+                web.get(f"/repos/{REPO}/issues/{{number}}", self.get_issue),
+            ]
+        )
+        return app
+
+    def respond(
+        self, request: web.Request, data: Any, link: Optional[str] = None
+    ) -> web.Response:
+        body = json.dumps(data)
+        etag = f'"{sha256(body.encode()).hexdigest()[:16]}"'
+        if request.query.get("page", "1") == self.rate_limited_page:
+            headers = {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "1700000000"}
+            response = web.json_response({"message": "rate limit"}, status=403)
+            response.headers.update(headers)
+        elif request.headers.get("If-None-Match") == etag:
+            response = web.Response(status=304, headers={"ETag": etag})
+        else:
+            response = web.json_response(data, headers={"ETag": etag})
+            if link is not None:
+                response.headers["Link"] = link
+        query = dict(request.query)
+        self.requests.append(Request(request.path, query, response.status))
+        return response
+
+    async def list_issues(self, request: web.Request) -> web.Response:
+        since = request.query.get("since", "")
+        issues = sorted(
+            (issue for issue in self.issues.values() if issue["updated_at"] >= since),
+            key=lambda issue: issue["updated_at"],
+        )
+        per_page = int(request.query.get("per_page", 30))
+        page = int(request.query.get("page", 1))
+        last = max(1, -(-len(issues) // per_page))
+
+        links: list[str] = []
+        for rel, number in (("next", page + 1), ("last", last)):
+            if number <= last:
+                url = request.url.update_query(page=str(number))
+                links.append(f'<{url}>; rel="{rel}"')
+        data = issues[(page - 1) * per_page : page * per_page]
+        return self.respond(request, data, ", ".join(links) if links else None)
+
+    async def get_issue(self, request: web.Request) -> web.Response:
+        issue = self.issues.get(int(request.match_info["number"]))
+        if issue is None:
+            raise web.HTTPNotFound()
+        return self.respond(request, issue)
+
+    def add_issue(self, number: int, model_id: str, model: Any, updated_at: str):
+        self.issues[number] = {
+            "number": number,
+            "title": f"[MODEL ADD REQUEST] {model_id}",
+            "body": "```json\n" + json.dumps(model, indent=4) + "\n```",
+            "updated_at": updated_at,
+        }
+
+
+def get_model(number: int) -> tuple[str, Any]:
+    """A valid model for the issue, based on an existing model."""
+
+    base = json.loads((MODEL_FILES_DIR / "4x-UltraSharp.json").read_text("utf-8"))
+    model = copy.deepcopy(base)
+    model["name"] = f"Mock {number}"
+    return f"4x-Mock-{number}", model
+
+
+class Checks:
+    def __init__(self):
+        self.failures = 0
+
+    def compare(self, label: str, actual: Any, expected: Any):
+        if actual == expected:
+            print(f"ok    {label}")
+        else:
+            self.failures += 1
+            print(f"FAIL  {label}: expected {expected}, got {actual}")
+
+
+def get_stamps(directory: Path) -> dict[str, int]:
+    return {file.name: file.stat().st_mtime_ns for file in directory.glob("*.json")}
+
+
+def get_written(directory: Path, stamps: dict[str, int]) -> list[str]:
+    """Returns the files of the directory that were written since the stamps."""
+
+    return sorted(
+        name
+        for name, stamp in get_stamps(directory).items()
+        if stamps.get(name) != stamp
+    )
+
+
+async def check(module: Any, checks: Checks):
+    github = MockGitHub()
+    for number in range(1, ISSUES + 1):
+        model_id, model = get_model(number)
+        github.add_issue(number, model_id, model, f"2024-01-{number:02d}T00:00:00Z")
+    # an issue with a problem, which is reported but not written
+    github.issues[ISSUES + 1] = {
+        "number": ISSUES + 1,
+        "title": "[MODEL ADD REQUEST] 4x-Broken",
+        "body": "not json",
+        "updated_at": "2024-01-20T00:00:00Z",
+    }
+    # pull requests are listed too, but ignored
+    github.issues[ISSUES + 2] = {
+        "number": ISSUES + 2,
+        "title": "Fix a typo",
+        "body": "",
+        "updated_at": "2024-01-21T00:00:00Z",
+        "pull_request": {},
+    }
+
+    runner = web.AppRunner(github.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    api_url = f"http://127.0.0.1:{port}"
+    models_dir: Path = module.MODEL_FILES_DIR
+    options = module.ImportOptions()
+
+    async def run(issue_number: Optional[int] = None) -> int:
+        github.requests.clear()
+        with redirect_stdout(io.StringIO()):
+            return await module.run(issue_number, api_url, REPO, options)
+
+    def load_cache() -> Any:
+        return json.loads(module.CACHE_JSON.read_text(encoding="utf-8"))
+
+    def list_requests() -> list[tuple[str, str, int]]:
+        """The page, `since`, and status of each request of the last run."""
+
+        return sorted(
+            (r.query.get("page", "1"), r.query.get("since", ""), r.status)
+            for r in github.requests
+        )
+
+    try:
+        # all pages are fetched, and the issue with a problem fails the run
+        checks.compare("first run exit code", await run(), 1)
+        checks.compare(
+            "first run requests",
+            list_requests(),
+            [("1", "", 200), ("2", "", 200), ("3", "", 200)],
+        )
+        written = sorted(f"4x-Mock-{n}.json" for n in range(1, ISSUES + 1))
+        new = get_written(models_dir, get_stamps(MODEL_FILES_DIR))
+        checks.compare("first run model files", new, written)
+        _, model = get_model(1)
+        actual = json.loads((models_dir / "4x-Mock-1.json").read_text("utf-8"))
+        checks.compare("model file content", actual, model)
+        cache = load_cache()
+        checks.compare("first run since", cache["since"], "2024-01-21T00:00:00Z")
+        checks.compare("first run etag", cache["etag"], None)
+        checks.compare(
+            "reported problem",
+            "problems" in cache["issues"][str(ISSUES + 1)],
+            True,
+        )
+
+        # `since` is inclusive, so the latest issue is listed again, but nothing is
+        # written. Its ETag is kept for the next run.
+        stamps = get_stamps(models_dir)
+        checks.compare("unchanged run exit code", await run(), 0)
+        checks.compare(
+            "unchanged run requests",
+            list_requests(),
+            [("1", "2024-01-21T00:00:00Z", 200)],
+        )
+        checks.compare("unchanged run writes", get_written(models_dir, stamps), [])
+        checks.compare("unchanged run etag", load_cache()["etag"] is not None, True)
+
+        checks.compare("conditional run exit code", await run(), 0)
+        checks.compare(
+            "conditional run requests",
+            list_requests(),
+            [("1", "2024-01-21T00:00:00Z", 304)],
+        )
+
+        # an edited issue is listed on its own and only its model is written again
+        model_id, model = get_model(3)
+        model["description"] = "Edited"
+        github.add_issue(3, model_id, model, "2024-02-01T00:00:00Z")
+        checks.compare("edited run exit code", await run(), 0)
+        checks.compare(
+            "edited run requests",
+            list_requests(),
+            [("1", "2024-01-21T00:00:00Z", 200)],
+        )
+        written = get_written(models_dir, stamps)
+        checks.compare("edited run writes", written, ["4x-Mock-3.json"])
+        cache = load_cache()
+        checks.compare("edited run since", cache["since"], "2024-02-01T00:00:00Z")
+
+        # A run that fails on the second page keeps `since` and the ETag, so the
+        # issues of both pages are listed again by the next run.
+        edited: list[str] = []
+        for number in range(4, 10):
+            model_id, model = get_model(number)
+            model["description"] = "Edited"
+            github.add_issue(number, model_id, model, f"2024-02-{number:02d}T00:00:00Z")
+            edited.append(f"{model_id}.json")
+        github.rate_limited_page = "2"
+        checks.compare("rate limited exit code", await run(), 1)
+        # the issues of the first page may have been imported already
+        failed_cache = load_cache()
+        checks.compare(
+            "rate limited cache",
+            (failed_cache["since"], failed_cache["etag"]),
+            (cache["since"], cache["etag"]),
+        )
+        github.rate_limited_page = None
+        checks.compare("recovered exit code", await run(), 0)
+        checks.compare(
+            "recovered run requests",
+            list_requests(),
+            [("1", "2024-02-01T00:00:00Z", 200), ("2", "2024-02-01T00:00:00Z", 200)],
+        )
+        descriptions = [
+            json.loads((models_dir / name).read_text("utf-8"))["description"]
+            for name in edited
+        ]
+        checks.compare("recovered run models", descriptions, ["Edited"] * len(edited))
+        checks.compare(
+            "recovered run since", load_cache()["since"], "2024-02-09T00:00:00Z"
+        )
+
+        # single issues are fetched with their own ETag, and the unchanged model isn't
+        # written again
+        stamps = get_stamps(models_dir)
+        checks.compare("single issue exit code", await run(10), 0)
+        checks.compare("single issue requests", list_requests(), [("1", "", 200)])
+        checks.compare("single issue writes", get_written(models_dir, stamps), [])
+        checks.compare(
+            "single issue etag", "etag" in load_cache()["issues"]["10"], True
+        )
+        await run(10)
+        checks.compare("unchanged single issue", list_requests(), [("1", "", 304)])
+    finally:
+        await runner.cleanup()
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Checks `model-from-issue.py` against a mock of the GitHub API."
+    )
+    parser.parse_args(argv)
+
+    module = load_model_from_issue()
+    module.PER_PAGE = PER_PAGE
+    checks = Checks()
+    with tempfile.TemporaryDirectory(prefix="model-from-issue-") as temp:
+        # model files, their snapshot, and the issue cache are relative to the working
+        # directory
+        shutil.copytree(MODEL_FILES_DIR, Path(temp) / module.MODEL_FILES_DIR)
+        cwd = os.getcwd()
+        os.chdir(temp)
+        try:
+            asyncio.run(check(module, checks))
+        finally:
+            os.chdir(cwd)
+
+    if checks.failures:
+        print(f"{checks.failures} checks failed")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""
+Checks `check-resources.py` without network access.
+
+    python scripts/check-resources-offline.py
+
+Resource files are served by a local HTTP server that stands in for the file hosts:
+a correct file, files whose size or hash doesn't match their model, a web page, and a
+URL that doesn't exist. `check-resources.py` runs against model files pointing to them
+and must report the right status for each. It then resumes from a partial checkpoint
+and must only request the URLs that weren't checked yet.
+"""
+
+from __future__ import annotations
+from contextlib import contextmanager, redirect_stdout
+from functools import partial
+from hashlib import sha256
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Iterator, Optional
+import argparse
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+
+CHECK_RESOURCES = Path(__file__).parent / "check-resources.py"
+
+# the expected status of each served file
+EXPECTED = {
+    "ok.pth": "ok",
+    "size.pth": "size mismatch",
+    "hash.pth": "hash mismatch",
+    "page.html": "web page",
+    "missing.pth": "error",
+}
+
+
+def load_check_resources() -> Any:
+    spec = importlib.util.spec_from_file_location("check_resources", CHECK_RESOURCES)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class RecordingHandler(SimpleHTTPRequestHandler):
+    """Serves a directory and records the paths of all GET requests."""
+
+    def __init__(self, *args: Any, requests: list[str], **kwargs: Any):
+        self.requests = requests
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        super().do_GET()
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+
+@contextmanager
+def serve(directory: Path, requests: list[str]) -> Iterator[str]:
+    """Serves the directory on a free local port and yields its base URL."""
+
+    handler = partial(RecordingHandler, directory=str(directory), requests=requests)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def create_fixtures(serve_dir: Path, models_dir: Path, base_url: str):
+    """Writes the served files and a model with a resource for each of them."""
+
+    serve_dir.mkdir(parents=True, exist_ok=True)
+    models_dir.mkdir(parents=True, exist_ok=True)
+    data = random.Random(0).randbytes(200_000)
+    for name in ("ok.pth", "size.pth", "hash.pth"):
+        (serve_dir / name).write_bytes(data)
+    (serve_dir / "page.html").write_text("<html>Download</html>", encoding="utf-8")
+
+    resources: list[dict[str, Any]] = []
+    for name in EXPECTED:
+        size, sha = len(data), sha256(data).hexdigest()
+        if name == "size.pth":
+            size += 1
+        elif name == "hash.pth":
+            sha = sha256(b"other").hexdigest()
+        resources.append(
+            {
+                "platform": "pytorch",
+                "type": "pth",
+                "size": size,
+                "sha256": sha,
+                "urls": [base_url + name],
+            }
+        )
+    model = {"name": "Offline", "author": "test", "resources": resources}
+    (models_dir / "4x-Offline.json").write_text(json.dumps(model), encoding="utf-8")
+
+
+def get_statuses(output: Path) -> dict[str, str]:
+    report = json.loads(output.read_text(encoding="utf-8"))
+    return {result["url"].rsplit("/", 1)[1]: result["status"] for result in report}
+
+
+def compare(label: str, actual: Any, expected: Any) -> bool:
+    if actual == expected:
+        print(f"ok    {label}")
+        return True
+    print(f"FAIL  {label}: expected {expected}, got {actual}")
+    return False
+
+
+def check(check_resources: Any, workspace: Path) -> int:
+    """Runs all checks in the workspace and returns the number of failures."""
+
+    requests: list[str] = []
+    failures = 0
+    with serve(workspace / "serve", requests) as base_url:
+        create_fixtures(workspace / "serve", workspace / "models", base_url)
+        checkpoint = workspace / "checkpoint.jsonl"
+        output = workspace / "results.json"
+        argv = ["--models-dir", str(workspace / "models")]
+        argv += ["--checkpoint", str(checkpoint), "--output", str(output)]
+
+        def run(*args: str) -> int:
+            requests.clear()
+            with redirect_stdout(io.StringIO()):
+                return check_resources.main([*argv, *args])
+
+        code = run()
+        failures += not compare("exit code", code, 1)
+        failures += not compare("statuses", get_statuses(output), EXPECTED)
+
+        # an interrupted run: the OK file is done, the hash mismatch was only checked
+        # by size, and the last line was cut off
+        lines = checkpoint.read_text(encoding="utf-8").splitlines()
+        results = [json.loads(line) for line in lines]
+        ok = next(r for r in results if r["url"].endswith("/ok.pth"))
+        size_only = next(r for r in results if r["url"].endswith("/hash.pth"))
+        size_only.update(status="ok", detail="size only")
+        partial_lines = [json.dumps(ok), json.dumps(size_only), lines[-1][:20]]
+        checkpoint.write_text("\n".join(partial_lines), encoding="utf-8")
+
+        code = run()
+        failures += not compare("resumed exit code", code, 1)
+        failures += not compare("resumed statuses", get_statuses(output), EXPECTED)
+        requested = sorted({path.lstrip("/") for path in requests})
+        expected = sorted(set(EXPECTED) - {"ok.pth", "size.pth", "page.html"})
+        # size mismatches and web pages are found by HEAD requests
+        failures += not compare("resumed downloads", requested, expected)
+
+        # only errors are checked again
+        run()
+        requested = sorted({path.lstrip("/") for path in requests})
+        failures += not compare("finished run downloads", requested, ["missing.pth"])
+
+        run("--restart")
+        requested = sorted({path.lstrip("/") for path in requests})
+        expected = sorted(set(EXPECTED) - {"size.pth", "page.html"})
+        failures += not compare("restarted downloads", requested, expected)
+    return failures
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Checks `check-resources.py` without network access."
+    )
+    parser.parse_args(argv)
+
+    check_resources = load_check_resources()
+    with tempfile.TemporaryDirectory(prefix="check-resources-") as temp:
+        # the model snapshot is written relative to the working directory
+        cwd = os.getcwd()
+        os.chdir(temp)
+        try:
+            failures = check(check_resources, Path(temp))
+        finally:
+            os.chdir(cwd)
+
+    if failures:
+        print(f"{failures} checks failed")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+"""
+Check that the resource files of all models match their size and SHA256.
+
+    python scripts/check-resources.py              # download and hash all files
+    python scripts/check-resources.py --head-only  # only compare sizes
+
+Each URL is checked with a HEAD request first, and files whose Content-Length is wrong
+aren't downloaded. All other files are hashed while they are streamed, so memory use
+doesn't depend on the size of the files. URLs of web pages (e.g. Google Drive or MEGA)
+can't be checked and are skipped.
+
+Results are appended to a checkpoint file as they arrive, so an interrupted run
+continues where it stopped. Use --restart to check everything again.
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from typing import Any, Literal, Optional, TypedDict
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+
+
+# install dependencies
+def is_installed(*packages: str) -> bool:
+    return all(importlib.util.find_spec(package) is not None for package in packages)
+
+
+if not is_installed("requests"):
+    pip_command = "pip install requests"
+    print(pip_command)
+    os.system(sys.executable + " -m " + pip_command)
+
+import requests  # noqa: E402
+
+from downloads import Downloader  # noqa: E402
+from model_db import MODEL_FILES_DIR  # noqa: E402
+import model_db  # noqa: E402
+
+CHECKPOINT_FILE = Path(".resource-check/checkpoint.jsonl")
+WORKERS = 8
+# most files are on a few hosts, which shouldn't be flooded
+PER_HOST = 4
+CHUNK_SIZE = 1024 * 1024
+
+Status = Literal["ok", "size mismatch", "hash mismatch", "web page", "error"]
+# statuses that are final, so the URL isn't checked again when resuming
+FINAL_STATUSES: frozenset[Status] = frozenset(
+    {"ok", "size mismatch", "hash mismatch", "web page"}
+)
+
+
+@dataclass(frozen=True)
+class Check:
+    url: str
+    size: Optional[int]
+    sha256: Optional[str]
+
+
+class CheckResult(TypedDict):
+    url: str
+    # the expected size and hash
+    size: Optional[int]
+    sha256: Optional[str]
+    status: Status
+    detail: str
+
+
+def get_checks(db: model_db.ModelDB) -> tuple[list[Check], dict[Check, list[str]]]:
+    """Returns all distinct checks and the models that need each one."""
+
+    models: dict[Check, list[str]] = {}
+    for model_id, model in db.models.items():
+        for resource in model["resources"]:
+            for url in resource["urls"]:
+                check = Check(url, resource.get("size"), resource.get("sha256"))
+                models.setdefault(check, []).append(model_id)
+    return list(models), models
+
+
+def load_checkpoint(file: Path) -> dict[Check, CheckResult]:
+    results: dict[Check, CheckResult] = {}
+    if not file.exists():
+        return results
+    with file.open(encoding="utf-8") as f:
+        for line in f:
+            try:
+                result: CheckResult = json.loads(line)
+            except ValueError:
+                # the last line of an interrupted run may be incomplete
+                continue
+            results[Check(result["url"], result["size"], result["sha256"])] = result
+    return results
+
+
+def is_web_page(content_type: str) -> bool:
+    return content_type.split(";")[0].strip().lower() == "text/html"
+
+
+def check_url(downloader: Downloader, check: Check, head_only: bool) -> CheckResult:
+    def result(status: Status, detail: str = "") -> CheckResult:
+        return {
+            "url": check.url,
+            "size": check.size,
+            "sha256": check.sha256,
+            "status": status,
+            "detail": detail,
+        }
+
+    try:
+        try:
+            headers = downloader.head(check.url)
+        except requests.HTTPError:
+            # some hosts don't support HEAD, so only GET can tell
+            headers = None
+
+        if headers is not None:
+            if is_web_page(headers.get("Content-Type", "")):
+                return result("web page")
+            length = headers.get("Content-Length")
+            if length is not None and check.size is not None:
+                if int(length) != check.size:
+                    return result("size mismatch", f"Content-Length is {length}")
+                if head_only:
+                    return result("ok", "size only")
+        if head_only:
+            return result("error", "the size is unknown without downloading")
+
+        file = downloader.hash_file(check.url, limit=check.size)
+        if is_web_page(file.content_type):
+            return result("web page")
+        if check.size is not None and file.size != check.size:
+            more = "more than " if file.sha256 is None else ""
+            return result("size mismatch", f"the file has {more}{file.size} bytes")
+        if check.sha256 is not None and file.sha256 != check.sha256.lower():
+            return result("hash mismatch", f"the file has SHA256 {file.sha256}")
+        return result("ok")
+    except (requests.RequestException, ValueError) as e:
+        return result("error", str(e))
+
+
+def run(
+    checks: list[Check],
+    checkpoint: Path,
+    *,
+    workers: int,
+    head_only: bool,
+    restart: bool,
+) -> dict[Check, CheckResult]:
+    done = {} if restart else load_checkpoint(checkpoint)
+    results = {c: r for c, r in done.items() if r["status"] in FINAL_STATUSES}
+    # `ok` results of --head-only runs only checked the size
+    if not head_only:
+        results = {c: r for c, r in results.items() if r["detail"] != "size only"}
+    todo = [check for check in checks if check not in results]
+    print(
+        f"Checking {len(todo)} of {len(checks)} URLs ({len(checks) - len(todo)} already checked)",
+        flush=True,
+    )
+
+    downloader = Downloader(per_host=PER_HOST, chunk_size=CHUNK_SIZE)
+    checkpoint.parent.mkdir(parents=True, exist_ok=True)
+    mode = "w" if restart else "a"
+    start = time.monotonic()
+    with checkpoint.open(mode, encoding="utf-8") as f, ThreadPool(workers) as pool:
+        # results are written as they arrive, so nothing is lost if the run is stopped
+        for i, result in enumerate(
+            pool.imap_unordered(lambda c: check_url(downloader, c, head_only), todo)
+        ):
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+            check = Check(result["url"], result["size"], result["sha256"])
+            results[check] = result
+            if result["status"] not in ("ok", "web page"):
+                print(f"{result['status']}: {result['url']} {result['detail']}")
+            if (i + 1) % 50 == 0:
+                elapsed = time.monotonic() - start
+                print(f"Checked {i + 1}/{len(todo)} URLs in {elapsed:.0f}s", flush=True)
+
+    return {check: results[check] for check in checks}
+
+
+def print_summary(results: dict[Check, CheckResult], models: dict[Check, list[str]]):
+    counts: dict[str, int] = {}
+    for result in results.values():
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    print()
+    for status, count in sorted(counts.items()):
+        print(f"{status:>14}: {count}")
+
+    for check, result in results.items():
+        if result["status"] in ("size mismatch", "hash mismatch", "error"):
+            print(f"\n{result['status']}: {check.url}")
+            print(f"  {result['detail']}")
+            print(f"  used by {', '.join(models[check])}")
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Check that the resource files of all models match their size and SHA256."
+    )
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument(
+        "--head-only",
+        action="store_true",
+        help="Only compare the Content-Length of files with their size.",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore the checkpoint and check all URLs again.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        default=CHECKPOINT_FILE,
+        help=f"The checkpoint file. Defaults to {CHECKPOINT_FILE}.",
+    )
+    parser.add_argument(
+        "--models-dir",
+        type=Path,
+        default=MODEL_FILES_DIR,
+        help="The directory of model files, e.g. fixtures served by a local server.",
+    )
+    parser.add_argument(
+        "--output", type=Path, help="Write all results as JSON to this file."
+    )
+    args = parser.parse_args(argv)
+
+    checks, models = get_checks(model_db.load(args.models_dir))
+    results = run(
+        checks,
+        args.checkpoint,
+        workers=args.workers,
+        head_only=args.head_only,
+        restart=args.restart,
+    )
+    print_summary(results, models)
+
+    if args.output:
+        report: list[Any] = [
+            {**result, "models": models[check]} for check, result in results.items()
+        ]
+        args.output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    failed = {"size mismatch", "hash mismatch", "error"}
+    return 1 if any(r["status"] in failed for r in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+"""
+Checks that header-only model detection of `invoke-spandrel.py` agrees with full loads.
+
+    python scripts/check-spandrel-detection.py
+
+Small models of a few architectures are created with random weights and saved as .pth
+and .safetensors files. Each file is detected with `--detect header` and `--detect
+full`, which must give the same result, and header-only detection must not fall back
+to a full load. The architectures include transformers (SwinIR, HAT, DAT) whose
+constructors need real tensors, so they can't be built on the meta device.
+"""
+
+from __future__ import annotations
+from pathlib import Path
+from typing import Any, Callable, Optional
+import argparse
+import importlib.util
+import sys
+import tempfile
+import warnings
+
+import torch
+from safetensors.torch import save_file
+
+INVOKE_SPANDREL = Path(__file__).parent.parent / "invoke-spandrel.py"
+
+
+def load_invoke_spandrel() -> Any:
+    spec = importlib.util.spec_from_file_location("invoke_spandrel", INVOKE_SPANDREL)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_models() -> dict[str, Callable[[], torch.nn.Module]]:
+    from spandrel.architectures.Compact import Compact
+    from spandrel.architectures.DAT import DAT
+    from spandrel.architectures.ESRGAN import ESRGAN
+    from spandrel.architectures.HAT import HAT
+    from spandrel.architectures.SwinIR import SwinIR
+
+    return {
+        "compact": lambda: Compact(num_feat=32, num_conv=8, upscale=2),
+        "esrgan": lambda: ESRGAN(num_filters=16, num_blocks=2),
+        "swinir": lambda: SwinIR(
+            upscale=4,
+            img_size=64,
+            window_size=8,
+            embed_dim=60,
+            depths=[6, 6, 6, 6],
+            num_heads=[6, 6, 6, 6],
+            mlp_ratio=2,
+            upsampler="pixelshuffledirect",
+        ),
+        "hat": lambda: HAT(
+            upscale=2,
+            embed_dim=60,
+            depths=[2, 2],
+            num_heads=[6, 6],
+            window_size=16,
+            upsampler="pixelshuffle",
+        ),
+        "dat": lambda: DAT(upscale=2, embed_dim=60, depth=[2, 2], num_heads=[2, 2]),
+    }
+
+
+def save_model(model: torch.nn.Module, directory: Path, name: str) -> list[Path]:
+    state_dict = {k: v.contiguous() for k, v in model.state_dict().items()}
+    pth = directory / f"{name}.pth"
+    torch.save(state_dict, pth)
+    safetensors = directory / f"{name}.safetensors"
+    save_file(state_dict, str(safetensors))
+    return [pth, safetensors]
+
+
+def check_file(invoke: Any, loader: Any, file: Path) -> Optional[str]:
+    """Returns why header-only detection of the file is wrong, if it is."""
+
+    try:
+        header = invoke.get_metadata(loader, str(file), "header")
+    except invoke.MetadataError as e:
+        return str(e)
+    full = invoke.get_metadata(loader, str(file), "full")
+
+    header.pop("detection")
+    full.pop("detection")
+    if header != full:
+        return f"header-only detection found {header}, a full load {full}"
+    return None
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Checks that header-only model detection of `invoke-spandrel.py` agrees with full loads."
+    )
+    parser.parse_args(argv)
+
+    import spandrel
+
+    # the architectures warn about deprecated torch APIs
+    warnings.filterwarnings("ignore", category=UserWarning)
+    invoke = load_invoke_spandrel()
+    loader = spandrel.ModelLoader()
+
+    failures = 0
+    with tempfile.TemporaryDirectory(prefix="spandrel-detection-") as temp:
+        for name, create in get_models().items():
+            torch.manual_seed(0)
+            for file in save_model(create(), Path(temp), name):
+                problem = check_file(invoke, loader, file)
+                if problem is None:
+                    print(f"ok    {file.name}")
+                else:
+                    failures += 1
+                    print(f"FAIL  {file.name}: {problem}")
+
+    if failures:
+        print(f"{failures} files failed")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""
+A small download engine shared by the Python scripts.
+
+All requests go through one connection-pooled session, are limited per host, and are
+retried with exponential backoff. Files are streamed to a temporary file next to their
+destination and renamed into place, so an interrupted download never leaves a partial
+file behind.
+"""
+
+from __future__ import annotations
+from contextlib import contextmanager
+from dataclasses import dataclass
+from hashlib import sha256
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Iterator, Optional, TypeVar
+from urllib.parse import urlsplit
+import io
+import os
+import tempfile
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from metrics import Counters
+
+T = TypeVar("T")
+
+# status codes that are worth retrying
+RETRY_STATUS_CODES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+
+@dataclass
+class StreamedFile:
+    size: int
+    # `None` if the file is larger than the limit it was streamed with
+    sha256: Optional[str]
+    content_type: str
+
+
+class CountingReader(io.RawIOBase):
+    """A raw stream of a response body that counts the downloaded bytes."""
+
+    def __init__(self, response: requests.Response, counters: Counters):
+        super().__init__()
+        self._raw = response.raw
+        # undo Content-Encoding like `iter_content` does
+        self._raw.decode_content = True
+        self._counters = counters
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        view = memoryview(buffer).cast("B")
+        data = self._raw.read(len(view))
+        view[: len(data)] = data
+        self._counters.add("downloaded bytes", len(data))
+        return len(data)
+
+
+class Downloader:
+    def __init__(
+        self,
+        *,
+        per_host: int = 8,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30,
+        chunk_size: int = 64 * 1024,
+        counters: Optional[Counters] = None,
+    ):
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        # requests, retries, and downloaded bytes
+        self.counters = counters or Counters()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._hosts: dict[str, threading.BoundedSemaphore] = {}
+        self._hosts_lock = threading.Lock()
+
+    @contextmanager
+    def _host_slot(self, url: str) -> Iterator[None]:
+        host = urlsplit(url).netloc
+        with self._hosts_lock:
+            semaphore = self._hosts.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host)
+                self._hosts[host] = semaphore
+        with semaphore:
+            yield
+
+    def _with_retries(self, url: str, fn: Callable[[], T]) -> T:
+        """
+        Calls `fn` until it succeeds. Connection errors, timeouts, and responses with a
+        retryable status code are retried; everything else is raised immediately.
+        """
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.counters.add("download retries")
+            try:
+                with self._host_slot(url):
+                    return fn()
+            except requests.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status not in RETRY_STATUS_CODES or attempt == self.retries:
+                    raise
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            time.sleep(self.backoff * 2**attempt)
+        raise AssertionError("unreachable")
+
+    def _get(
+        self, url: str, headers: Optional[dict[str, str]] = None
+    ) -> requests.Response:
+        self.counters.add("download requests")
+        response = self.session.get(
+            url, headers=headers, stream=True, timeout=self.timeout
+        )
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            response.close()
+            raise
+        return response
+
+    def download_file(self, url: str, file: Path, log: bool = True) -> None:
+        """Download from url and save to file"""
+
+        def download():
+            if log:
+                print(f"Downloading {url}", flush=True)
+            file.parent.mkdir(parents=True, exist_ok=True)
+            with self._get(url) as response:
+                fd, temp = tempfile.mkstemp(
+                    dir=file.parent, prefix=file.name, suffix=".part"
+                )
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        for chunk in response.iter_content(self.chunk_size):
+                            f.write(chunk)
+                            self.counters.add("downloaded bytes", len(chunk))
+                    os.replace(temp, file)
+                except BaseException:
+                    os.unlink(temp)
+                    raise
+
+        self._with_retries(url, download)
+
+    def download_head(self, url: str, size: int) -> bytes:
+        """Download (at most) the first `size` bytes from url"""
+
+        def download():
+            headers = {"Range": f"bytes=0-{size - 1}"}
+            with self._get(url, headers) as response:
+                # servers that don't support ranges send the whole file, so stop
+                # reading early
+                data = bytearray()
+                for chunk in response.iter_content(min(size, self.chunk_size)):
+                    data += chunk
+                    self.counters.add("downloaded bytes", len(chunk))
+                    if len(data) >= size:
+                        break
+                return bytes(data[:size])
+
+        return self._with_retries(url, download)
+
+    @contextmanager
+    def stream(
+        self, url: str, byte_range: Optional[tuple[int, int]] = None
+    ) -> Iterator[BinaryIO]:
+        """
+        Opens url for reading while it downloads. Only the request is retried, not
+        errors while reading.
+
+        If `byte_range` is given, only the bytes from its start to its (exclusive) end
+        are requested. The stream starts at the start of the range either way, but it
+        may go on past its end.
+        """
+
+        headers = None
+        if byte_range is not None:
+            headers = {"Range": f"bytes={byte_range[0]}-{byte_range[1] - 1}"}
+        response = self._with_retries(url, lambda: self._get(url, headers))
+        with response:
+            reader = io.BufferedReader(CountingReader(response, self.counters))
+            if byte_range is not None and response.status_code != 206:
+                # the server sent the whole file
+                remaining = byte_range[0]
+                while remaining > 0:
+                    chunk = reader.read(min(remaining, self.chunk_size))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+            yield reader
+
+    def head(self, url: str) -> CaseInsensitiveDict[str]:
+        """Returns the headers of url, following redirects"""
+
+        def head():
+            self.counters.add("download requests")
+            response = self.session.head(
+                url, allow_redirects=True, timeout=self.timeout
+            )
+            response.raise_for_status()
+            return response.headers
+
+        return self._with_retries(url, head)
+
+    def hash_file(self, url: str, limit: Optional[int] = None) -> StreamedFile:
+        """
+        Streams the file at url and returns its size and SHA256 without keeping it in
+        memory. Stops reading once more than `limit` bytes arrived.
+        """
+
+        def download():
+            with self._get(url) as response:
+                content_type = response.headers.get("Content-Type", "")
+                h = sha256()
+                size = 0
+                for chunk in response.iter_content(self.chunk_size):
+                    h.update(chunk)
+                    size += len(chunk)
+                    self.counters.add("downloaded bytes", len(chunk))
+                    if limit is not None and size > limit:
+                        return StreamedFile(size, None, content_type)
+                return StreamedFile(size, h.hexdigest().lower(), content_type)
+
+        return self._with_retries(url, download)
+
+    def download_json(self, url: str) -> Any:
+        """Download json from url"""
+
+        def download():
+            with self._get(url) as response:
+                self.counters.add("downloaded bytes", len(response.content))
+                return response.json()
+
+        return self._with_retries(url, download)
+
+    def prefetch(
+        self, files: dict[str, Path], workers: int = 16
+    ) -> dict[str, Exception]:
+        """
+        Downloads all given URLs to their files in parallel. Files that already exist
+        are skipped. Returns the errors of all failed downloads by URL.
+        """
+
+        missing = [(url, file) for url, file in files.items() if not file.exists()]
+        errors: dict[str, Exception] = {}
+
+        def fetch(item: tuple[str, Path]):
+            url, file = item
+            try:
+                self.download_file(url, file)
+            except Exception as e:
+                errors[url] = e
+
+        if missing:
+            with ThreadPool(workers) as pool:
+                pool.map(fetch, missing)
+        return errors
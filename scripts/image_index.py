@@ -0,0 +1,175 @@
+"""
+An SQLite index of image metadata by image URL.
+
+Unlike a JSON file, the index doesn't have to be read in full to look up an image or
+rewritten in full to add one.
+"""
+
+from __future__ import annotations
+from hashlib import sha256
+from pathlib import Path
+from typing import Iterable, Optional, TypedDict
+import sqlite3
+import threading
+
+# SQLite limits the number of parameters of a statement
+QUERY_CHUNK_SIZE = 500
+
+
+class CachedImageMetadata(TypedDict):
+    width: int
+    height: int
+
+
+# an image URL and the width and height of a window in it
+WindowKey = tuple[str, int, int]
+
+
+def url_key(url: str) -> bytes:
+    # 8 bytes are plenty to tell URLs apart, and the full URL is checked anyway
+    return sha256(url.encode("utf-8")).digest()[:8]
+
+
+class ImageIndex:
+    def __init__(self, file: Path):
+        file.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(file, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    key BLOB PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    width INTEGER NOT NULL,
+                    height INTEGER NOT NULL
+                ) WITHOUT ROWID
+                """)
+            # the most detailed window of a given size of each image, see saliency.py
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS windows (
+                    key BLOB NOT NULL,
+                    url TEXT NOT NULL,
+                    w INTEGER NOT NULL,
+                    h INTEGER NOT NULL,
+                    x INTEGER,
+                    y INTEGER,
+                    PRIMARY KEY (key, w, h)
+                ) WITHOUT ROWID
+                """)
+            # the perceptual hash of each image, computed from its small thumbnail
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS hashes (
+                    key BLOB PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    thumbnail TEXT NOT NULL,
+                    dhash BLOB NOT NULL
+                ) WITHOUT ROWID
+                """)
+
+    def get(self, url: str) -> Optional[CachedImageMetadata]:
+        return self.get_many([url]).get(url)
+
+    def get_many(self, urls: Iterable[str]) -> dict[str, CachedImageMetadata]:
+        urls = list(dict.fromkeys(urls))
+        result: dict[str, CachedImageMetadata] = {}
+        with self._lock:
+            for i in range(0, len(urls), QUERY_CHUNK_SIZE):
+                keys = [url_key(url) for url in urls[i : i + QUERY_CHUNK_SIZE]]
+                placeholders = ",".join("?" * len(keys))
+                rows = self._db.execute(
+                    f"SELECT url, width, height FROM images WHERE key IN ({placeholders})",
+                    keys,
+                )
+                for url, width, height in rows:
+                    result[url] = {"width": width, "height": height}
+        # drop hash collisions
+        return {url: result[url] for url in urls if url in result}
+
+    def upsert(
+        self, images: dict[str, CachedImageMetadata], *, replace: bool = True
+    ) -> None:
+        """
+        Adds the given images to the index. If `replace` is false, images that are
+        already in the index keep their metadata.
+        """
+
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        rows = [
+            (url_key(url), url, image["width"], image["height"])
+            for url, image in images.items()
+        ]
+        with self._lock, self._db:
+            self._db.executemany(
+                f"{verb} INTO images (key, url, width, height) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def get_windows(
+        self, windows: Iterable[WindowKey]
+    ) -> dict[WindowKey, Optional[tuple[int, int]]]:
+        """
+        Returns the cached positions of the most detailed windows of the given sizes in
+        the given images. The position is `None` if the image has no such window.
+        """
+
+        result: dict[WindowKey, Optional[tuple[int, int]]] = {}
+        with self._lock:
+            for url, w, h in dict.fromkeys(windows):
+                rows = self._db.execute(
+                    "SELECT url, x, y FROM windows WHERE key = ? AND w = ? AND h = ?",
+                    (url_key(url), w, h),
+                )
+                for row_url, x, y in rows:
+                    if row_url == url:
+                        result[(url, w, h)] = None if x is None else (x, y)
+        return result
+
+    def put_windows(self, windows: dict[WindowKey, Optional[tuple[int, int]]]) -> None:
+        """Adds the positions of windows by image URL and window size."""
+
+        rows = [
+            (url_key(url), url, w, h, *(position or (None, None)))
+            for (url, w, h), position in windows.items()
+        ]
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO windows (key, url, w, h, x, y) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def get_hashes(self, urls: Iterable[str]) -> dict[str, tuple[str, int]]:
+        """Returns the thumbnail each hash was computed from and the hash by URL."""
+
+        urls = list(dict.fromkeys(urls))
+        result: dict[str, tuple[str, int]] = {}
+        with self._lock:
+            for i in range(0, len(urls), QUERY_CHUNK_SIZE):
+                keys = [url_key(url) for url in urls[i : i + QUERY_CHUNK_SIZE]]
+                placeholders = ",".join("?" * len(keys))
+                rows = self._db.execute(
+                    f"SELECT url, thumbnail, dhash FROM hashes WHERE key IN ({placeholders})",
+                    keys,
+                )
+                for url, thumbnail, dhash in rows:
+                    result[url] = thumbnail, int.from_bytes(dhash, "big")
+        return {url: result[url] for url in urls if url in result}
+
+    def put_hashes(self, hashes: dict[str, tuple[str, int]]) -> None:
+        # SQLite integers are signed, so the 64-bit hashes are stored as bytes
+        rows = [
+            (url_key(url), url, thumbnail, dhash.to_bytes(8, "big"))
+            for url, (thumbnail, dhash) in hashes.items()
+        ]
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO hashes (key, url, thumbnail, dhash) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,68 @@
+"""
+Full-reference image quality metrics.
+"""
+
+from __future__ import annotations
+import math
+
+import cv2
+import numpy as np
+
+# the constants of the original SSIM paper for 8-bit images
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+
+def _as_gray(img: np.ndarray) -> np.ndarray:
+    if img.ndim == 3 and img.shape[2] == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    elif img.ndim == 3:
+        img = img[:, :, 0]
+    return img.astype(np.float32)
+
+
+def ssim(reference: np.ndarray, img: np.ndarray) -> float:
+    """
+    The mean SSIM of the luma of two uint8 images with an 11x11 Gaussian window. 1 means
+    the images are identical.
+    """
+
+    if reference.shape[:2] != img.shape[:2]:
+        raise ValueError(f"Size mismatch: {reference.shape} vs {img.shape}")
+
+    x = _as_gray(reference)
+    y = _as_gray(img)
+
+    def blur(a: np.ndarray) -> np.ndarray:
+        return cv2.GaussianBlur(a, (11, 11), 1.5)
+
+    mu_x = blur(x)
+    mu_y = blur(y)
+    mu_xx = mu_x * mu_x
+    mu_yy = mu_y * mu_y
+    mu_xy = mu_x * mu_y
+    sigma_xx = blur(x * x) - mu_xx
+    sigma_yy = blur(y * y) - mu_yy
+    sigma_xy = blur(x * y) - mu_xy
+
+    ssim_map = ((2 * mu_xy + SSIM_C1) * (2 * sigma_xy + SSIM_C2)) / (
+        (mu_xx + mu_yy + SSIM_C1) * (sigma_xx + sigma_yy + SSIM_C2)
+    )
+    return float(ssim_map.mean())
+
+
+def psnr(reference: np.ndarray, img: np.ndarray) -> float:
+    """The PSNR of two uint8 images in dB. Identical images have a PSNR of infinity."""
+
+    if reference.shape[:2] != img.shape[:2]:
+        raise ValueError(f"Size mismatch: {reference.shape} vs {img.shape}")
+
+    if reference.shape == img.shape:
+        diff = reference.astype(np.float32) - img.astype(np.float32)
+    else:
+        # e.g. a grayscale image that was encoded as color
+        diff = _as_gray(reference) - _as_gray(img)
+    mse = float(np.mean(diff * diff))
+    if mse == 0:
+        return math.inf
+    return 10 * math.log10(255 * 255 / mse)
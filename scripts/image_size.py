@@ -0,0 +1,101 @@
+"""
+Reads the dimensions of PNG, JPEG, WebP, and GIF images from the first few bytes of
+the file, without decoding any pixels.
+"""
+
+from __future__ import annotations
+from typing import Optional
+import struct
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# SOF markers that carry the frame size. C4 (DHT), C8 (JPG), and CC (DAC) don't.
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# markers without a length
+JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xDA)) | {0x01}
+
+
+def _probe_png(data: bytes) -> Optional[tuple[int, int]]:
+    if len(data) < 24 or data[12:16] != b"IHDR":
+        return None
+    width, height = struct.unpack(">II", data[16:24])
+    return width, height
+
+
+def _probe_gif(data: bytes) -> Optional[tuple[int, int]]:
+    if len(data) < 10:
+        return None
+    width, height = struct.unpack("<HH", data[6:10])
+    return width, height
+
+
+def _probe_webp(data: bytes) -> Optional[tuple[int, int]]:
+    if len(data) < 30:
+        return None
+
+    chunk = data[12:16]
+    if chunk == b"VP8 ":
+        # lossy: a 3 byte frame tag and a 3 byte start code precede the size
+        if data[23:26] != b"\x9d\x01\x2a":
+            return None
+        width, height = struct.unpack("<HH", data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b"VP8L":
+        # lossless: 14 bits each for width - 1 and height - 1
+        if data[20] != 0x2F:
+            return None
+        (bits,) = struct.unpack("<I", data[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        # extended: 24 bits each for canvas width - 1 and height - 1
+        width = int.from_bytes(data[24:27], "little") + 1
+        height = int.from_bytes(data[27:30], "little") + 1
+        return width, height
+    return None
+
+
+def _probe_jpeg(data: bytes) -> Optional[tuple[int, int]]:
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # fill byte
+            i += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            i += 2
+            continue
+        if marker == 0xDA:
+            # start of scan, the frame header should have come before
+            return None
+
+        (length,) = struct.unpack(">H", data[i + 2 : i + 4])
+        if marker in JPEG_SOF_MARKERS:
+            if i + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[i + 5 : i + 9])
+            return width, height
+        i += 2 + length
+    return None
+
+
+def probe_image_size(data: bytes) -> Optional[tuple[int, int]]:
+    """
+    Returns the (width, height) of the image whose file starts with the given bytes.
+
+    Returns `None` if the format is not supported or `data` doesn't contain the size.
+    For JPEGs, the size may come after large metadata segments (EXIF, ICC profiles),
+    so callers should retry with more data.
+    """
+
+    if data.startswith(PNG_SIGNATURE):
+        return _probe_png(data)
+    if data.startswith(b"\xff\xd8"):
+        return _probe_jpeg(data)
+    if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        return _probe_webp(data)
+    if data.startswith(b"GIF87a") or data.startswith(b"GIF89a"):
+        return _probe_gif(data)
+    return None
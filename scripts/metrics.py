@@ -0,0 +1,138 @@
+"""
+Lightweight instrumentation for the Python scripts.
+"""
+
+from __future__ import annotations
+from contextlib import contextmanager
+from typing import Any, Iterator, Mapping, TypedDict
+import threading
+import time
+
+
+class StageTime(TypedDict):
+    seconds: float
+    count: int
+
+
+class StageTimes:
+    """
+    Thread-safe totals of the time spent in each stage of a pipeline.
+
+    Stages that run in parallel add up the time of all workers, so their total can be
+    larger than the wall time of the pipeline.
+    """
+
+    def __init__(self):
+        self._stages: dict[str, StageTime] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float, count: int = 1):
+        with self._lock:
+            total = self._stages.setdefault(stage, {"seconds": 0.0, "count": 0})
+            total["seconds"] += seconds
+            total["count"] += count
+
+    @contextmanager
+    def measure(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def update(self, stages: dict[str, StageTime]):
+        """Adds the totals of another `StageTimes.as_dict()`, e.g. from a worker process."""
+
+        for stage, total in stages.items():
+            self.add(stage, total["seconds"], total["count"])
+
+    def get(self, stage: str) -> StageTime:
+        with self._lock:
+            total = self._stages.get(stage)
+            if total is None:
+                return {"seconds": 0.0, "count": 0}
+            return StageTime(**total)
+
+    def total(self) -> float:
+        """The time spent in all stages."""
+
+        with self._lock:
+            return sum(total["seconds"] for total in self._stages.values())
+
+    def as_dict(self) -> dict[str, StageTime]:
+        with self._lock:
+            return {stage: StageTime(**total) for stage, total in self._stages.items()}
+
+
+class Counters:
+    """Thread-safe named counters, e.g. cache hits or downloaded bytes."""
+
+    def __init__(self):
+        self._counts: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, value: int = 1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + value
+
+    def get(self, name: str) -> int:
+        with self._lock:
+            return self._counts.get(name, 0)
+
+    def as_dict(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+
+class Metrics:
+    """
+    Everything measured during one run of a pipeline: the times of its stages, counters,
+    the times of individual items (e.g. images) grouped by kind, and other values
+    recorded for items (e.g. the quality of thumbnails).
+    """
+
+    def __init__(self):
+        self.stages = StageTimes()
+        self.counters = Counters()
+        self._items: dict[str, dict[str, StageTimes]] = {}
+        self._records: dict[str, dict[str, dict[str, float]]] = {}
+        self._lock = threading.Lock()
+
+    def item(self, kind: str, key: str) -> StageTimes:
+        """Returns the stage times of a single item."""
+
+        with self._lock:
+            items = self._items.setdefault(kind, {})
+            times = items.get(key)
+            if times is None:
+                times = StageTimes()
+                items[key] = times
+            return times
+
+    def items(self, kind: str) -> dict[str, StageTimes]:
+        with self._lock:
+            return dict(self._items.get(kind, {}))
+
+    def record(self, kind: str, key: str, values: Mapping[str, float]):
+        """Records values of a single item. Later values replace earlier ones."""
+
+        with self._lock:
+            self._records.setdefault(kind, {})[key] = dict(values)
+
+    def records(self, kind: str) -> dict[str, dict[str, float]]:
+        with self._lock:
+            return dict(self._records.get(kind, {}))
+
+    def as_dict(self) -> dict[str, Any]:
+        with self._lock:
+            items = {kind: dict(items) for kind, items in self._items.items()}
+            records = {kind: dict(records) for kind, records in self._records.items()}
+        return {
+            "stages": self.stages.as_dict(),
+            "counters": self.counters.as_dict(),
+            "items": {
+                kind: {key: times.as_dict() for key, times in by_key.items()}
+                for kind, by_key in items.items()
+            },
+            "records": records,
+        }
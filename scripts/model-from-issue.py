@@ -1,58 +1,247 @@
-import requests
-import json
+"""
+Convert model request issues from OpenModelDB's GitHub to model files.
+
+    python scripts/model-from-issue.py        # all open model requests
+    python scripts/model-from-issue.py 123    # a single issue
+
+All pages of open issues are fetched concurrently. Conditional requests (`since` and
+ETags) make repeated runs only download issues that changed, and model files are only
+written if their content changed. Set GITHUB_TOKEN to use the higher rate limit of
+authenticated requests, and GITHUB_API_URL (or --api-url) to use another API, e.g. a
+local mock.
+
+Models are checked against the shape of the existing model files before they are
+written, and IDs may not collide with existing models. Issues with problems are
+reported and skipped until they are edited. With --hash-resources, the files of all
+resources are downloaded in parallel to fill in their size and SHA256.
+"""
+
+from __future__ import annotations
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from hashlib import sha256
+from pathlib import Path
+from typing import Any, AsyncIterator, Optional, TypedDict
 import argparse
+import asyncio
+import importlib.util
+import itertools
+import json
+import os
+import sys
+import time
 
 
-def fetch_issue(issue_number: int):
-    url = f"https://api.github.com/repos/OpenModelDB/open-model-database/issues/{issue_number}"
-    response = requests.get(url)
+# install dependencies
+def is_installed(*packages: str) -> bool:
+    return all(importlib.util.find_spec(package) is not None for package in packages)
 
-    if response.status_code == 200:
-        return json.loads(response.content)
 
-    return None
+if not is_installed("typing_extensions", "aiohttp", "requests"):
+    pip_command = "pip install typing-extensions aiohttp requests"
+    print(pip_command)
+    os.system(sys.executable + " -m " + pip_command)
 
+from typing_extensions import NotRequired  # noqa: E402
+import aiohttp  # noqa: E402
+from yarl import URL  # noqa: E402
 
-def fetch_all_issues():
-    url = "https://api.github.com/repos/OpenModelDB/open-model-database/issues"
-    response = requests.get(url)
+from downloads import RETRY_STATUS_CODES  # noqa: E402
+from model_validation import Shape, validate_model  # noqa: E402
+import model_db  # noqa: E402
+from object_store import write_atomic  # noqa: E402
 
-    if response.status_code == 200:
-        return json.loads(response.content)
+# config
+API_URL = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+REPO = "OpenModelDB/open-model-database"
+TITLE_PREFIX = "[MODEL ADD REQUEST]"
 
-    return None
+MODEL_FILES_DIR = Path("data/models/")
+CACHE_JSON = Path(".issue-cache/issues.json")
 
+# the maximum page size of the GitHub API
+PER_PAGE = 100
+# the maximum number of parallel requests
+CONCURRENCY = 8
+RETRIES = 3
+BACKOFF = 0.5
+TIMEOUT = 30
 
-# parse args
-parser = argparse.ArgumentParser(
-    description="Convert a model request issue from OpenModelDB's GitHub to a model file."
-)
+# resources are large, so they are hashed while they are streamed
+HASH_CONCURRENCY = 4
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+# the order of the properties of resources in model files
+RESOURCE_KEY_ORDER = ("platform", "type", "size", "sha256", "urls")
 
-parser.add_argument(
-    "issue_number",
-    type=int,
-    help="The issue number to fetch the model request from.",
-    nargs="?",
-)
 
-args = parser.parse_args()
+class IssueState(TypedDict):
+    updated_at: str
+    # the ETag of the issue, if it was fetched on its own
+    etag: NotRequired[str]
+    # the model the issue was converted to, if it could be converted
+    model: NotRequired[str]
+    # why the issue couldn't be converted
+    problems: NotRequired[list[str]]
 
 
-def convert_issue_to_model(issue):
-    issue_body = issue["body"]
+class Cache(TypedDict):
+    # the cache is only valid for the API and repository it was made with
+    source: str
+    # the latest `updated_at` of all fetched issues
+    since: Optional[str]
+    # the ETag of the list of open issues updated since `since`
+    etag: Optional[str]
+    issues: dict[str, IssueState]
 
-    if issue_body.startswith("```") and issue_body.endswith("```"):
-        issue_body = issue_body[3:-3]
 
-    if issue_body.startswith("json"):
-        issue_body = issue_body[4:]
+def new_cache(source: str) -> Cache:
+    return {"source": source, "since": None, "etag": None, "issues": {}}
 
-    issue_body = issue_body.strip()
-    issue_body = json.loads(issue_body)
 
-    issue_title = issue["title"]
-    model_name = (
-        issue_title.replace("[MODEL ADD REQUEST] ", "")
+def load_cache(source: str) -> Cache:
+    if CACHE_JSON.exists():
+        cache: Cache = json.loads(CACHE_JSON.read_text(encoding="utf-8"))
+        if cache.get("source") == source:
+            return cache
+    return new_cache(source)
+
+
+def save_cache(cache: Cache):
+    data = json.dumps(cache, indent=2, sort_keys=True).encode("utf-8")
+    write_atomic(CACHE_JSON, data)
+
+
+class RateLimitError(Exception):
+    pass
+
+
+@dataclass
+class Response:
+    status: int
+    data: Any
+    etag: Optional[str]
+    # the number of the last page of a paginated list
+    last_page: Optional[int]
+
+
+class GitHub:
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        api_url: str,
+        repo: str,
+        concurrency: int = CONCURRENCY,
+    ):
+        self.session = session
+        self.repo_url = f"{api_url.rstrip('/')}/repos/{repo}"
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.requests = 0
+
+    async def get(
+        self,
+        path: str,
+        params: Optional[dict[str, Any]] = None,
+        etag: Optional[str] = None,
+    ) -> Response:
+        """
+        GETs the path of the repository. If `etag` is given and the resource didn't
+        change, the status of the response is 304 and it has no data.
+        """
+
+        url = self.repo_url + path
+        headers = {"If-None-Match": etag} if etag else {}
+        for attempt in range(RETRIES + 1):
+            if attempt > 0:
+                await asyncio.sleep(BACKOFF * 2**attempt)
+            try:
+                async with self._semaphore, self.session.get(
+                    url, params=params, headers=headers
+                ) as response:
+                    self.requests += 1
+                    if response.status in RETRY_STATUS_CODES and attempt < RETRIES:
+                        continue
+                    check_rate_limit(response)
+                    if response.status == 304:
+                        return Response(304, None, etag, None)
+                    response.raise_for_status()
+                    last = response.links.get("last")
+                    return Response(
+                        response.status,
+                        await response.json(),
+                        response.headers.get("ETag"),
+                        int(URL(last["url"]).query["page"]) if last else None,
+                    )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == RETRIES:
+                    raise
+        raise AssertionError("unreachable")
+
+
+def check_rate_limit(response: aiohttp.ClientResponse):
+    if response.status in (403, 429) and (
+        response.headers.get("X-RateLimit-Remaining") == "0"
+        or "Retry-After" in response.headers
+    ):
+        reset = response.headers.get("X-RateLimit-Reset")
+        wait = f" until {time.ctime(int(reset))}" if reset else ""
+        raise RateLimitError(
+            f"GitHub rate limit exceeded{wait}. Set GITHUB_TOKEN to get a higher limit."
+        )
+
+
+async def iter_changed_issues(client: GitHub, cache: Cache) -> AsyncIterator[Any]:
+    """
+    Yields all open issues that changed since the last run, page by page as they
+    arrive. Once all pages are fetched, the `since` and `etag` of the cache are updated.
+    """
+
+    params: dict[str, Any] = {
+        "state": "open",
+        "sort": "updated",
+        "direction": "asc",
+        "per_page": PER_PAGE,
+    }
+    since = cache["since"]
+    if since is not None:
+        # `since` is inclusive, so this always returns the latest issue again
+        params["since"] = since
+
+    first = await client.get("/issues", params, etag=cache["etag"])
+    if first.status == 304:
+        return
+
+    new_since = since
+    pages = [
+        asyncio.create_task(client.get("/issues", {**params, "page": page}))
+        for page in range(2, (first.last_page or 1) + 1)
+    ]
+    try:
+        for page in itertools.chain([first], asyncio.as_completed(pages)):
+            if not isinstance(page, Response):
+                page = await page
+            for issue in page.data:
+                new_since = max(new_since or "", issue["updated_at"])
+                yield issue
+    finally:
+        for task in pages:
+            task.cancel()
+
+    # The ETag is only useful for the same query. If nothing changes until the next
+    # run, `since` stays the same and the next run gets a 304 for free.
+    cache["etag"] = first.etag if new_since == since else None
+    cache["since"] = new_since
+
+
+def is_model_request(issue: Any) -> bool:
+    # the issues API also lists pull requests
+    return "pull_request" not in issue and issue["title"].startswith(TITLE_PREFIX)
+
+
+def get_model_id(issue: Any) -> str:
+    return (
+        issue["title"]
+        .replace(TITLE_PREFIX + " ", "")
         .replace("_", "-")
         .replace(" ", "-")
         .replace(".", "-")
@@ -60,23 +249,334 @@ def convert_issue_to_model(issue):
         .replace("/", "-")
     )
 
-    models_dir = "./data/models"
-
-    with open(f"{models_dir}/{model_name}.json", "w") as f:
-        json.dump(issue_body, f, indent=4)
-
-
-if args.issue_number is None:
-    issues_list = fetch_all_issues()
-    if issues_list is None:
-        print("Failed to fetch issues")
-        exit(1)
-    for issue in issues_list:
-        if issue["title"].startswith("[MODEL ADD REQUEST]"):
-            convert_issue_to_model(issue)
-else:
-    issue = fetch_issue(args.issue_number)
-    if issue is None:
-        print(f"Failed to fetch issue {args.issue_number}")
-        exit(1)
-    convert_issue_to_model(issue)
+
+def parse_model(issue: Any) -> Any:
+    issue_body: str = issue["body"] or ""
+    issue_body = issue_body.strip()
+
+    if issue_body.startswith("```") and issue_body.endswith("```"):
+        issue_body = issue_body[3:-3]
+
+    if issue_body.startswith("json"):
+        issue_body = issue_body[4:]
+
+    return json.loads(issue_body.strip())
+
+
+def write_if_changed(file: Path, data: bytes) -> bool:
+    try:
+        if file.read_bytes() == data:
+            return False
+    except FileNotFoundError:
+        pass
+    write_atomic(file, data)
+    return True
+
+
+def dump_model(model: Any) -> bytes:
+    return json.dumps(model, indent=4).encode("utf-8")
+
+
+def sort_resource_keys(resource: dict[str, Any]) -> dict[str, Any]:
+    order = {key: i for i, key in enumerate(RESOURCE_KEY_ORDER)}
+    return dict(sorted(resource.items(), key=lambda kv: order.get(kv[0], len(order))))
+
+
+@dataclass
+class ImportOptions:
+    # download the files of resources to fill in and check their size and hash
+    hash_resources: bool = False
+    # only report problems, without writing model files
+    dry_run: bool = False
+
+
+class Importer:
+    """Validates and enriches the models of issues, and writes the valid ones."""
+
+    def __init__(
+        self,
+        cache: Cache,
+        options: ImportOptions,
+        downloads: Optional[aiohttp.ClientSession] = None,
+    ):
+        self.cache = cache
+        self.options = options
+        self.downloads = downloads
+
+        self.db = model_db.load(MODEL_FILES_DIR)
+        self.shape = Shape.infer(self.db.models.values())
+        self.models = {model_id.casefold(): model_id for model_id in self.db.models}
+        # the issue each model ID was written from
+        self.owners = {
+            state["model"].casefold(): number
+            for number, state in cache["issues"].items()
+            if "model" in state
+        }
+        # the issue that claimed each model ID in this run
+        self.claimed: dict[str, str] = {}
+        self.problems: dict[str, list[str]] = {}
+        self._hash_semaphore = asyncio.Semaphore(HASH_CONCURRENCY)
+
+    def check_id(self, number: str, model_id: str, model: Any) -> Optional[str]:
+        """
+        Returns a problem if the ID is already used by an existing model or another
+        issue. IDs that only differ in case collide, since files are named after them.
+        """
+
+        key = model_id.casefold()
+        other = self.claimed.setdefault(key, number)
+        if other != number:
+            return f"id: {model_id} is also requested by issue #{other}"
+
+        existing = self.models.get(key)
+        if existing is None or self.owners.get(key) == number:
+            return None
+        file = MODEL_FILES_DIR / f"{existing}.json"
+        if existing == model_id and file.read_bytes() == dump_model(model):
+            # the model was already added
+            return None
+        return f"id: {model_id} collides with the existing model {existing}"
+
+    async def hash_url(self, url: str) -> tuple[int, str]:
+        """Streams the file at the URL and returns its size and SHA256."""
+
+        assert self.downloads is not None
+        async with self._hash_semaphore, self.downloads.get(url) as response:
+            response.raise_for_status()
+            if response.content_type == "text/html":
+                raise ValueError("the URL is a web page, not a file")
+            h = sha256()
+            size = 0
+            async for chunk in response.content.iter_chunked(HASH_CHUNK_SIZE):
+                size += len(chunk)
+                # hashlib releases the GIL, so files of different issues are hashed
+                # in parallel
+                await asyncio.to_thread(h.update, chunk)
+            return size, h.hexdigest()
+
+    async def enrich_resource(self, i: int, resource: dict[str, Any]) -> list[str]:
+        error: Optional[Exception] = None
+        for url in resource.get("urls") or []:
+            try:
+                size, sha256 = await self.hash_url(url)
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+        else:
+            return [f"resources[{i}]: no URL could be downloaded ({error})"]
+
+        problems: list[str] = []
+        for key, value in (("size", size), ("sha256", sha256)):
+            if key not in resource:
+                resource[key] = value
+            elif resource[key] != value:
+                problems.append(
+                    f"resources[{i}].{key}: is {resource[key]}, but the file has {value}"
+                )
+        return problems
+
+    async def enrich(self, model: Any) -> list[str]:
+        """Fills in the size and SHA256 of all resources, and checks existing ones."""
+
+        resources = model.get("resources")
+        if not isinstance(resources, list):
+            return []
+        indexed = [(i, r) for i, r in enumerate(resources) if isinstance(r, dict)]
+        results = await asyncio.gather(
+            *(self.enrich_resource(i, r) for i, r in indexed)
+        )
+        for i, resource in indexed:
+            resources[i] = sort_resource_keys(resource)
+        return [problem for problems in results for problem in problems]
+
+    async def import_issue(self, issue: Any) -> Optional[str]:
+        """
+        Writes the model of the issue to its model file and returns the model ID.
+        Returns `None` if the issue has problems.
+
+        The issue is only recorded in the cache once it is converted or its problems
+        are reported, so issues whose import fails are tried again by the next run.
+        """
+
+        number = str(issue["number"])
+        state: IssueState = {"updated_at": issue["updated_at"]}
+        old_state = self.cache["issues"].get(number)
+        if old_state is not None and "etag" in old_state:
+            state["etag"] = old_state["etag"]
+
+        try:
+            model = parse_model(issue)
+        except ValueError as e:
+            return self.report(number, state, [f"body: not valid JSON ({e})"])
+        if not isinstance(model, dict):
+            return self.report(number, state, ["body: expected a JSON object"])
+
+        model_id = get_model_id(issue)
+        # this must happen before the first await, so the first issue claims the ID
+        collision = self.check_id(number, model_id, model)
+        if collision is not None:
+            return self.report(number, state, [collision])
+
+        problems: list[str] = []
+        if self.options.hash_resources:
+            problems += await self.enrich(model)
+        problems += validate_model(model_id, model, self.shape)
+        if problems:
+            return self.report(number, state, problems)
+        self.note_duplicate_files(number, model_id, model)
+
+        state["model"] = model_id
+        file = MODEL_FILES_DIR / f"{model_id}.json"
+        if not self.options.dry_run and write_if_changed(file, dump_model(model)):
+            print(f"Wrote {file} from issue #{number}")
+        self.cache["issues"][number] = state
+        return model_id
+
+    def note_duplicate_files(self, number: str, model_id: str, model: Any):
+        # a few models share files, e.g. pretrains, so this isn't a problem
+        for i, resource in enumerate(model["resources"]):
+            if "sha256" in resource:
+                others = self.db.models_with_file(resource["sha256"]) - {model_id}
+                if others:
+                    names = ", ".join(sorted(others))
+                    print(f"Issue #{number}: resources[{i}] is also used by {names}")
+
+    def report(self, number: str, state: IssueState, problems: list[str]) -> None:
+        state["problems"] = problems
+        self.cache["issues"][number] = state
+        self.problems[number] = problems
+        for problem in problems:
+            print(f"Issue #{number}: {problem}")
+        return None
+
+
+def is_converted(issue: Any, cache: Cache) -> bool:
+    """Whether the issue didn't change since it was imported."""
+
+    state = cache["issues"].get(str(issue["number"]))
+    if state is None or state["updated_at"] != issue["updated_at"]:
+        return False
+    model = state.get("model")
+    return model is None or (MODEL_FILES_DIR / f"{model}.json").exists()
+
+
+async def import_all(client: GitHub, importer: Importer) -> int:
+    """Imports all changed model requests while their pages are still being fetched."""
+
+    cache = importer.cache
+    since, etag = cache["since"], cache["etag"]
+    tasks: list[asyncio.Task[Optional[str]]] = []
+    try:
+        async for issue in iter_changed_issues(client, cache):
+            if is_model_request(issue) and not is_converted(issue, cache):
+                tasks.append(asyncio.create_task(importer.import_issue(issue)))
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # issues that weren't imported must be listed again by the next run
+        cache["since"], cache["etag"] = since, etag
+        raise
+    return len(tasks)
+
+
+async def import_one(client: GitHub, importer: Importer, number: int) -> bool:
+    state = importer.cache["issues"].get(str(number))
+    etag = None
+    if state is not None and "model" in state:
+        # the issue is only skipped if its model file still exists
+        if (MODEL_FILES_DIR / f"{state['model']}.json").exists():
+            etag = state.get("etag")
+
+    response = await client.get(f"/issues/{number}", etag=etag)
+    if response.status == 304:
+        return False
+    await importer.import_issue(response.data)
+    if response.etag is not None:
+        importer.cache["issues"][str(number)]["etag"] = response.etag
+    return True
+
+
+async def run(
+    issue_number: Optional[int], api_url: str, repo: str, options: ImportOptions
+) -> int:
+    headers = {
+        "Accept": "application/vnd.github+json",
+        "X-GitHub-Api-Version": "2022-11-28",
+    }
+    token = os.environ.get("GITHUB_TOKEN")
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+
+    source = f"{api_url.rstrip('/')}/repos/{repo}"
+    # dry runs check all open requests
+    cache = new_cache(source) if options.dry_run else load_cache(source)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    async with AsyncExitStack() as stack:
+        session = await stack.enter_async_context(
+            aiohttp.ClientSession(headers=headers, timeout=timeout)
+        )
+        downloads = None
+        if options.hash_resources:
+            # a separate session, so the token isn't sent to other hosts
+            downloads = await stack.enter_async_context(
+                aiohttp.ClientSession(timeout=HASH_TIMEOUT)
+            )
+        client = GitHub(session, api_url, repo)
+        importer = Importer(cache, options, downloads)
+        try:
+            if issue_number is None:
+                changed = await import_all(client, importer)
+                print(
+                    f"Checked {changed} changed issues with {client.requests} requests"
+                )
+            elif not await import_one(client, importer, issue_number):
+                print(f"Issue #{issue_number} didn't change")
+        except (aiohttp.ClientResponseError, RateLimitError) as e:
+            print(f"Failed to fetch issues: {e}")
+            return 1
+        finally:
+            if not options.dry_run:
+                # keep the progress of failed runs
+                save_cache(cache)
+
+    if importer.problems:
+        print(f"{len(importer.problems)} issues have problems")
+        return 1
+    return 0
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Convert model request issues from OpenModelDB's GitHub to model files."
+    )
+    parser.add_argument(
+        "issue_number",
+        type=int,
+        help="The issue number to fetch the model request from. Defaults to all open model requests.",
+        nargs="?",
+    )
+    parser.add_argument(
+        "--api-url",
+        default=API_URL,
+        help=f"The URL of the GitHub API. Defaults to {API_URL}.",
+    )
+    parser.add_argument(
+        "--repo", default=REPO, help=f"The repository. Defaults to {REPO}."
+    )
+    parser.add_argument(
+        "--hash-resources",
+        action="store_true",
+        help="Download the files of resources to fill in their size and SHA256, and to check existing ones.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Check all open model requests without writing any files.",
+    )
+    args = parser.parse_args(argv)
+
+    options = ImportOptions(hash_resources=args.hash_resources, dry_run=args.dry_run)
+    return asyncio.run(run(args.issue_number, args.api_url, args.repo, options))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+"""
+The model files of the database, parsed once and indexed for the Python scripts.
+
+Parsing all model files is the slowest part of starting a script, so the parsed models
+are pickled to a snapshot. A model is only parsed again if the size or mtime of its
+file changed since the snapshot was written.
+
+    db = model_db.load()
+    db.find(scale=4, architecture="esrgan", author="Kim2091")
+    db.models_with_image("https://i.slow.pics/...")
+"""
+
+from __future__ import annotations
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+from typing import Any, Hashable, Iterable, Optional
+import json
+import os
+import pickle
+
+from object_store import write_atomic
+
+MODEL_FILES_DIR = Path("data/models/")
+SNAPSHOT_FILE = Path(".model-cache/models.pickle")
+# Bump this whenever the format of the snapshot changes.
+SNAPSHOT_VERSION = 1
+# reading files releases the GIL, so a few threads hide the latency of the file system
+PARSE_WORKERS = 8
+
+# the mtime (in ns) and size of a model file
+FileStamp = tuple[int, int]
+Index = dict[Hashable, set[str]]
+
+
+def get_image_urls(model: Any) -> list[str]:
+    """Returns the URLs of the source images of the model."""
+
+    urls: list[str] = []
+    for image in model.get("images", []):
+        for key in ("LR", "SR", "url"):
+            if key in image:
+                urls.append(image[key])
+    return urls
+
+
+def as_list(value: Any) -> list[Any]:
+    # some properties, e.g. the author, are either a single value or a list
+    return value if isinstance(value, list) else [value]
+
+
+class ModelDB:
+    """All models of the database, with indexes for the common queries."""
+
+    def __init__(self, models: dict[str, Any]):
+        self.models = models
+        self.by_architecture: Index = defaultdict(set)
+        self.by_scale: Index = defaultdict(set)
+        self.by_author: Index = defaultdict(set)
+        self.by_tag: Index = defaultdict(set)
+        self.by_sha256: Index = defaultdict(set)
+        self.by_image_url: Index = defaultdict(set)
+
+        for model_id, model in models.items():
+            self.by_architecture[model.get("architecture")].add(model_id)
+            self.by_scale[model.get("scale")].add(model_id)
+            for author in as_list(model.get("author")):
+                self.by_author[author].add(model_id)
+            for tag in model.get("tags", []):
+                self.by_tag[tag].add(model_id)
+            for resource in model.get("resources", []):
+                if "sha256" in resource:
+                    self.by_sha256[resource["sha256"]].add(model_id)
+            for url in get_image_urls(model):
+                self.by_image_url[url].add(model_id)
+
+        # lookups of unknown keys shouldn't add them
+        for name in list(vars(self)):
+            if name.startswith("by_"):
+                setattr(self, name, dict(getattr(self, name)))
+
+    def find(
+        self,
+        *,
+        architecture: Optional[str] = None,
+        scale: Optional[int] = None,
+        author: Optional[str] = None,
+        tag: Optional[str] = None,
+    ) -> set[str]:
+        """Returns the IDs of all models that match all of the given properties."""
+
+        candidates = [
+            index.get(value, set())
+            for index, value in (
+                (self.by_architecture, architecture),
+                (self.by_scale, scale),
+                (self.by_author, author),
+                (self.by_tag, tag),
+            )
+            if value is not None
+        ]
+        if not candidates:
+            return set(self.models)
+        # the intersection costs as much as the smallest set
+        candidates.sort(key=len)
+        return candidates[0].intersection(*candidates[1:])
+
+    def models_with_image(self, url: str) -> set[str]:
+        return set(self.by_image_url.get(url, ()))
+
+    def models_with_file(self, sha256: str) -> set[str]:
+        return set(self.by_sha256.get(sha256.lower(), ()))
+
+
+def get_file_stamps(directory: Path) -> dict[str, FileStamp]:
+    stamps: dict[str, FileStamp] = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith(".json") and entry.is_file():
+                stat = entry.stat()
+                stamps[entry.name[:-5]] = (stat.st_mtime_ns, stat.st_size)
+    return stamps
+
+
+def read_snapshot(snapshot: Path, directory: Path) -> dict[str, tuple[FileStamp, Any]]:
+    try:
+        data = pickle.loads(snapshot.read_bytes())
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return {}
+    if (
+        not isinstance(data, dict)
+        or data.get("version") != SNAPSHOT_VERSION
+        or data.get("directory") != str(directory.resolve())
+    ):
+        return {}
+    return data["models"]
+
+
+def write_snapshot(
+    snapshot: Path, directory: Path, models: dict[str, tuple[FileStamp, Any]]
+):
+    data = {
+        "version": SNAPSHOT_VERSION,
+        "directory": str(directory.resolve()),
+        "models": models,
+    }
+    write_atomic(snapshot, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def parse_models(directory: Path, model_ids: Iterable[str]) -> list[Any]:
+    def parse(model_id: str) -> Any:
+        file = directory / f"{model_id}.json"
+        return json.loads(file.read_text(encoding="utf-8"))
+
+    model_ids = list(model_ids)
+    if len(model_ids) <= 1:
+        return [parse(model_id) for model_id in model_ids]
+    with ThreadPool(min(PARSE_WORKERS, len(model_ids))) as pool:
+        return pool.map(parse, model_ids)
+
+
+def load(
+    directory: Path = MODEL_FILES_DIR, snapshot: Optional[Path] = SNAPSHOT_FILE
+) -> ModelDB:
+    """
+    Loads all models of the directory. Only models that changed since the snapshot was
+    written are parsed, and the snapshot is updated if any were. Pass `None` as the
+    snapshot to parse all models.
+    """
+
+    stamps = get_file_stamps(directory)
+    cached = read_snapshot(snapshot, directory) if snapshot is not None else {}
+
+    entries: dict[str, tuple[FileStamp, Any]] = {}
+    stale: list[str] = []
+    for model_id, stamp in stamps.items():
+        entry = cached.get(model_id)
+        if entry is not None and entry[0] == stamp:
+            entries[model_id] = entry
+        else:
+            stale.append(model_id)
+    for model_id, model in zip(stale, parse_models(directory, stale)):
+        entries[model_id] = stamps[model_id], model
+
+    entries = dict(sorted(entries.items()))
+    if snapshot is not None and (stale or len(cached) != len(entries)):
+        write_snapshot(snapshot, directory, entries)
+    return ModelDB({model_id: model for model_id, (_, model) in entries.items()})
@@ -0,0 +1,109 @@
+"""
+Validation of model files for the Python scripts.
+
+The expected shape of a model is inferred from the existing model files, so it doesn't
+have to be kept in sync with `src/lib/model-props.ts` by hand. Properties that all
+models have are required, and a property may only have the types it has in some model.
+"""
+
+from __future__ import annotations
+from typing import Any, Iterable, Optional
+import re
+
+
+def json_type(value: Any) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, list):
+        return "array"
+    if isinstance(value, dict):
+        return "object"
+    raise ValueError(f"Not a JSON value: {value!r}")
+
+
+class Shape:
+    """The union of the shapes of some JSON values."""
+
+    def __init__(self):
+        self.types: set[str] = set()
+        # whether all numbers are integers
+        self.integer = True
+        self.properties: dict[str, Shape] = {}
+        # the properties all objects have
+        self.required: Optional[set[str]] = None
+        self.items: Optional[Shape] = None
+
+    @staticmethod
+    def infer(values: Iterable[Any]) -> Shape:
+        shape = Shape()
+        for value in values:
+            shape.add(value)
+        return shape
+
+    def add(self, value: Any):
+        t = json_type(value)
+        self.types.add(t)
+        if t == "number":
+            self.integer = self.integer and isinstance(value, int)
+        elif t == "object":
+            keys = set(value)
+            self.required = keys if self.required is None else self.required & keys
+            for key, v in value.items():
+                self.properties.setdefault(key, Shape()).add(v)
+        elif t == "array":
+            if self.items is None:
+                self.items = Shape()
+            for v in value:
+                self.items.add(v)
+
+    def validate(self, value: Any, path: str = "") -> list[str]:
+        """Returns a description of each way the value doesn't fit this shape."""
+
+        name = path or "value"
+        t = json_type(value)
+        if t not in self.types:
+            expected = " or ".join(sorted(self.types))
+            return [f"{name}: expected {expected}, got {t}"]
+
+        errors: list[str] = []
+        if t == "number" and self.integer and not isinstance(value, int):
+            errors.append(f"{name}: expected an integer, got {value}")
+        elif isinstance(value, dict):
+            prefix = f"{path}." if path else ""
+            for key in sorted((self.required or set()) - set(value)):
+                errors.append(f"{prefix}{key}: missing")
+            for key, v in value.items():
+                prop = self.properties.get(key)
+                if prop is None:
+                    errors.append(f"{prefix}{key}: unknown property")
+                else:
+                    errors.extend(prop.validate(v, prefix + key))
+        elif isinstance(value, list) and self.items is not None and self.items.types:
+            for i, v in enumerate(value):
+                errors.extend(self.items.validate(v, f"{path}[{i}]"))
+        return errors
+
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def validate_model(model_id: str, model: Any, shape: Shape) -> list[str]:
+    """Checks the model against the shape of existing models and a few invariants."""
+
+    errors = shape.validate(model)
+    if errors:
+        return errors
+
+    if not model_id.startswith(f"{model['scale']}x-"):
+        errors.append(f"id: {model_id} must start with {model['scale']}x-")
+    for i, resource in enumerate(model.get("resources", [])):
+        sha256 = resource.get("sha256")
+        if sha256 is not None and not SHA256_PATTERN.match(sha256):
+            errors.append(f"resources[{i}].sha256: not a lowercase SHA256 hash")
+    return errors
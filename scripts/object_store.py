@@ -0,0 +1,119 @@
+"""
+A content-addressed file store.
+
+Objects are immutable files named by a key, which is usually a hash of everything their
+content depends on. Files outside the store reference objects through hardlinks, so an
+object without any other links is no longer used and can be garbage collected.
+"""
+
+from __future__ import annotations
+from hashlib import sha256
+from pathlib import Path
+from typing import Iterator, Optional
+import os
+import shutil
+import tempfile
+import uuid
+
+
+def sha256_file(file: Path, chunk_size: int = 1024 * 1024) -> str:
+    h = sha256()
+    with file.open("rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest().lower()
+
+
+def write_atomic(file: Path, data: bytes):
+    """
+    Writes the data to a temporary file and renames it into place. Other hardlinks to
+    the previous file keep their content.
+    """
+
+    file.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=file.parent, prefix=file.name, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp, file)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def link_or_copy(source: Path, target: Path) -> bool:
+    """
+    Atomically replaces `target` with a hardlink to `source`. If the file system doesn't
+    support that, `source` is copied instead. Safe to call from many threads, also for
+    the same target.
+
+    Returns whether `target` changed.
+    """
+
+    if is_same_file(source, target):
+        return False
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # unique per call, since threads may link the same target at the same time
+    temp = target.with_name(f"{target.name}.{uuid.uuid4().hex}.link")
+    try:
+        try:
+            os.link(source, temp)
+        except OSError:
+            shutil.copyfile(source, temp)
+        os.replace(temp, target)
+    finally:
+        # rename does nothing if another thread already linked the same file, so the
+        # temporary link may still exist after a successful replace
+        temp.unlink(missing_ok=True)
+    return True
+
+
+def is_same_file(a: Path, b: Path) -> bool:
+    try:
+        return os.path.samefile(a, b)
+    except FileNotFoundError:
+        return False
+
+
+class ObjectStore:
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path(self, key: str, ext: str) -> Path:
+        return self.root / key[:2] / (key + ext)
+
+    def get(self, key: str, ext: str) -> Optional[Path]:
+        file = self.path(key, ext)
+        return file if file.exists() else None
+
+    def put(self, key: str, ext: str, data: bytes) -> Path:
+        file = self.path(key, ext)
+        if not file.exists():
+            write_atomic(file, data)
+        return file
+
+    def objects(self) -> Iterator[Path]:
+        if self.root.exists():
+            yield from (f for f in self.root.glob("*/*") if f.is_file())
+
+    def gc(self) -> tuple[int, int]:
+        """
+        Removes all objects that are not linked from anywhere else.
+
+        Objects that had to be copied because the file system doesn't support hardlinks
+        look unused and are removed too. The store is only a cache, so this just
+        costs regenerating them.
+
+        Returns the number of removed objects and their total size in bytes.
+        """
+
+        count = 0
+        size = 0
+        for file in self.objects():
+            stat = file.stat()
+            if stat.st_nlink <= 1:
+                file.unlink()
+                count += 1
+                size += stat.st_size
+        return count, size
@@ -0,0 +1,85 @@
+"""
+Perceptual hashes of images and a BK-tree to find similar hashes.
+
+The dHash of an image compares the brightness of neighboring pixels of a tiny grayscale
+version of it, so it survives resizing, recompression and small edits. Similar images
+have hashes with a small Hamming distance.
+"""
+
+from __future__ import annotations
+from typing import Generic, Optional, TypeVar
+
+import cv2
+import numpy as np
+
+T = TypeVar("T")
+
+# the hashes have HASH_SIZE * HASH_SIZE bits
+HASH_SIZE = 8
+
+
+def dhash(img: np.ndarray) -> int:
+    """The 64-bit difference hash of a uint8 image."""
+
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class _Node(Generic[T]):
+    def __init__(self, value: int, item: T):
+        self.value = value
+        self.items = [item]
+        self.children: dict[int, _Node[T]] = {}
+
+
+class BKTree(Generic[T]):
+    """
+    Finds all hashes within a Hamming distance of a hash without comparing it to all of
+    them. Each child of a node is at a different distance from it, so by the triangle
+    inequality, only children whose distance is close to the query's can match.
+    """
+
+    def __init__(self):
+        self._root: Optional[_Node[T]] = None
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, value: int, item: T):
+        self._size += 1
+        if self._root is None:
+            self._root = _Node(value, item)
+            return
+        node = self._root
+        while True:
+            distance = hamming(value, node.value)
+            if distance == 0:
+                node.items.append(item)
+                return
+            child = node.children.get(distance)
+            if child is None:
+                node.children[distance] = _Node(value, item)
+                return
+            node = child
+
+    def find(self, value: int, max_distance: int) -> list[tuple[int, T]]:
+        """Returns all items within `max_distance` of the value with their distance."""
+
+        result: list[tuple[int, T]] = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node.value)
+            if distance <= max_distance:
+                result.extend((distance, item) for item in node.items)
+            for d, child in node.children.items():
+                if distance - max_distance <= d <= distance + max_distance:
+                    stack.append(child)
+        return result
@@ -0,0 +1,158 @@
+"""
+Decodes a region of a PNG file without holding the whole decoded image in memory.
+
+The compressed rows are inflated in bands. Each band is wrapped in a small PNG that
+OpenCV decodes, so the rows are unfiltered in C. Rows below the region are never
+inflated, and only the pixels of the region are kept. A PNG row can reference the row
+above it, so the last row of each band is re-encoded as the unfiltered first row of
+the next one.
+"""
+
+from __future__ import annotations
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
+import struct
+import zlib
+
+import cv2
+import numpy as np
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# the channels of the color types that can be re-encoded from OpenCV's output. Palette
+# images and images with a tRNS chunk are not supported.
+COLOR_TYPE_CHANNELS = {0: 1, 2: 3, 4: 2, 6: 4}
+
+# the approximate size of the filtered rows decoded at once
+BAND_BYTES = 8 * 1024 * 1024
+
+
+def _read_chunks(f: BinaryIO) -> Iterator[tuple[bytes, bytes]]:
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        length, chunk_type = struct.unpack(">I4s", header)
+        data = f.read(length)
+        f.read(4)  # CRC
+        yield chunk_type, data
+
+
+def _chunk(chunk_type: bytes, data: bytes) -> bytes:
+    crc = zlib.crc32(data, zlib.crc32(chunk_type))
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def _to_raw_row(row: np.ndarray, color_type: int, bit_depth: int) -> bytes:
+    """Converts a row decoded by OpenCV back to the bytes of an unfiltered PNG row."""
+
+    if color_type == 2:
+        row = row[:, ::-1]
+    elif color_type == 4:
+        # OpenCV expands gray + alpha to BGRA
+        row = row[:, [0, 3]]
+    elif color_type == 6:
+        row = row[:, [2, 1, 0, 3]]
+    dtype = ">u2" if bit_depth == 16 else np.uint8
+    return np.ascontiguousarray(row, dtype=dtype).tobytes()
+
+
+class _Decoder:
+    def __init__(self, width: int, bit_depth: int, color_type: int):
+        self.width = width
+        self.bit_depth = bit_depth
+        self.color_type = color_type
+        self.stride = 1 + width * COLOR_TYPE_CHANNELS[color_type] * bit_depth // 8
+        self.previous: Optional[bytes] = None
+
+    def decode_band(self, filtered: bytes) -> np.ndarray:
+        """Decodes the filtered rows following the ones decoded before."""
+
+        rows = len(filtered) // self.stride
+        if self.previous is not None:
+            filtered = b"\x00" + self.previous + filtered
+            rows += 1
+        ihdr = struct.pack(
+            ">IIBBBBB", self.width, rows, self.bit_depth, self.color_type, 0, 0, 0
+        )
+        png = b"".join(
+            [
+                PNG_SIGNATURE,
+                _chunk(b"IHDR", ihdr),
+                _chunk(b"IDAT", zlib.compress(filtered, 0)),
+                _chunk(b"IEND", b""),
+            ]
+        )
+        img = cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_UNCHANGED)
+        if img is None:
+            raise ValueError("Unable to decode PNG rows")
+        if self.previous is not None:
+            img = img[1:]
+        self.previous = _to_raw_row(img[-1], self.color_type, self.bit_depth)
+        return img
+
+
+def decode_png_region(
+    file: Path, x: int, y: int, w: int, h: int
+) -> Optional[np.ndarray]:
+    """
+    Returns the pixels of the given region of the PNG like `cv2.imread` with
+    `cv2.IMREAD_UNCHANGED` would, cropped to the region.
+
+    Returns `None` if the file is not a PNG that can be decoded this way, i.e. interlaced
+    images, palette images, images with a tRNS chunk, and bit depths below 8.
+    """
+
+    with file.open("rb") as f:
+        if f.read(8) != PNG_SIGNATURE:
+            return None
+
+        decoder: Optional[_Decoder] = None
+        inflate = zlib.decompressobj()
+        pending = bytearray()
+        row = 0
+        bands: list[np.ndarray] = []
+        for chunk_type, data in _read_chunks(f):
+            if chunk_type == b"IHDR":
+                width, height, bit_depth, color_type, _, _, interlace = struct.unpack(
+                    ">IIBBBBB", data[:13]
+                )
+                if (
+                    interlace != 0
+                    or bit_depth not in (8, 16)
+                    or color_type not in COLOR_TYPE_CHANNELS
+                    or x < 0
+                    or y < 0
+                    or x + w > width
+                    or y + h > height
+                ):
+                    return None
+                decoder = _Decoder(width, bit_depth, color_type)
+            elif chunk_type in (b"tRNS", b"PLTE"):
+                return None
+            elif chunk_type == b"IDAT":
+                if decoder is None:
+                    return None
+                band_rows = max(1, BAND_BYTES // decoder.stride)
+                band_size = band_rows * decoder.stride
+                while data and row < y + h:
+                    # inflates at most one band at a time to bound memory
+                    pending += inflate.decompress(data, band_size - len(pending))
+                    data = inflate.unconsumed_tail
+                    rows = min(len(pending) // decoder.stride, y + h - row)
+                    if rows < band_rows and row + rows < y + h:
+                        continue
+                    img = decoder.decode_band(bytes(pending[: rows * decoder.stride]))
+                    del pending[: rows * decoder.stride]
+                    top, bottom = max(y - row, 0), min(y + h - row, rows)
+                    if top < bottom:
+                        bands.append(img[top:bottom, x : x + w].copy())
+                    row += rows
+                if row >= y + h:
+                    break
+            elif chunk_type == b"IEND":
+                break
+
+    if decoder is None or row < y + h:
+        raise ValueError(f"Truncated PNG {file}")
+    return np.concatenate(bands)
@@ -0,0 +1,77 @@
+"""
+Finds the most detailed region of an image, so crops don't show flat background.
+
+The detail of each pixel is its gradient magnitude. With an integral image of the
+detail, the total detail of a window is 4 lookups, so all window positions are scored
+at once with array slicing.
+"""
+
+from __future__ import annotations
+from typing import Optional
+import math
+
+import cv2
+import numpy as np
+
+# images are scored at most this large, which is plenty to find the detailed parts
+SCORE_MAX_SIDE = 256
+# windows further from the center score up to this much less, so the center wins ties
+CENTER_BIAS = 0.1
+# windows with less mean detail than this are flat (or only have compression noise)
+MIN_MEAN_DETAIL = 2.0
+
+
+def detail_map(img: np.ndarray) -> np.ndarray:
+    """The gradient magnitude of the luma of a uint8 image."""
+
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+    return cv2.magnitude(gx, gy)
+
+
+def window_sums(values: np.ndarray, w: int, h: int) -> np.ndarray:
+    """
+    Returns the sum of the values in every w x h window. The result at [y, x] is the
+    window whose top left corner is (x, y).
+    """
+
+    integral = cv2.integral(values, sdepth=cv2.CV_64F)
+    return integral[h:, w:] - integral[:-h, w:] - integral[h:, :-w] + integral[:-h, :-w]
+
+
+def find_salient_window(
+    img: np.ndarray, window: tuple[int, int]
+) -> Optional[tuple[int, int]]:
+    """
+    Returns the top left corner of the window of the given size with the most detail.
+    Returns `None` if the window covers the whole image or the image is flat.
+    """
+
+    height, width = img.shape[:2]
+    ww, wh = min(window[0], width), min(window[1], height)
+    if ww == width and wh == height:
+        return None
+
+    factor = max(1.0, max(width, height) / SCORE_MAX_SIDE)
+    if factor > 1:
+        size = max(1, round(width / factor)), max(1, round(height / factor))
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    rows, cols = img.shape[:2]
+    sw = min(cols, max(1, round(ww / factor)))
+    sh = min(rows, max(1, round(wh / factor)))
+
+    sums = window_sums(detail_map(img), sw, sh)
+    if sums.max() < MIN_MEAN_DETAIL * sw * sh:
+        return None
+
+    # the distance of each window from the center, from 0 to 1 in the corners
+    ys = np.linspace(-1, 1, sums.shape[0]) if sums.shape[0] > 1 else np.zeros(1)
+    xs = np.linspace(-1, 1, sums.shape[1]) if sums.shape[1] > 1 else np.zeros(1)
+    distance = np.sqrt(ys[:, None] ** 2 + xs[None, :] ** 2) / math.sqrt(2)
+    y, x = np.unravel_index(np.argmax(sums * (1 - CENTER_BIAS * distance)), sums.shape)
+
+    return (
+        min(max(0, round(int(x) * factor)), width - ww),
+        min(max(0, round(int(y) * factor)), height - wh),
+    )
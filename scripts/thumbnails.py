@@ -1,17 +1,22 @@
 from __future__ import annotations
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass, field, replace
 from functools import lru_cache
 import math
 from pathlib import Path
-from typing import Any, Literal, NewType, TypedDict, Union
+from typing import Any, Callable, Iterable, Literal, NewType, Optional, TypedDict, Union
+import argparse
 import json
 import importlib.util
 from hashlib import sha256
 import sys
 import os
 import time
+import threading
 import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from multiprocessing.pool import ThreadPool
+from urllib.parse import urljoin
 
 
 # install dependencies
@@ -27,35 +32,148 @@ if not is_installed("typing_extensions", "cv2", "numpy", "requests"):
 from typing_extensions import NotRequired  # noqa: E402
 import cv2  # noqa: E402
 import numpy as np  # noqa: E402
-import requests  # noqa: E402
 
-# config
-MODEL_FILES_DIR = Path("data/models/")
+from cache_bundle import (  # noqa: E402
+    BUNDLE_VERSION,
+    BundleManifest,
+    BundleRange,
+    extract_range,
+    get_missing,
+    get_ranges,
+)
+from downloads import Downloader  # noqa: E402
+from image_index import CachedImageMetadata, ImageIndex, WindowKey  # noqa: E402
+from image_quality import psnr, ssim  # noqa: E402
+from image_size import probe_image_size  # noqa: E402
+from metrics import Metrics, StageTime, StageTimes  # noqa: E402
+from model_db import MODEL_FILES_DIR  # noqa: E402
+import model_db  # noqa: E402
+from object_store import (  # noqa: E402
+    ObjectStore,
+    link_or_copy,
+    sha256_file,
+    write_atomic,
+)
+from perceptual_hash import BKTree, dhash  # noqa: E402
+from png_region import decode_png_region  # noqa: E402
+from saliency import find_salient_window  # noqa: E402
 
+# config
 CACHE_DIR = Path(".thumb-cache/")
 IMAGE_DOWNLOAD_DIR = CACHE_DIR / "images/"
 CACHE_THUMBNAIL_DIR = CACHE_DIR / "thumbs/"
 CACHE_IMAGE_METADATA_JSON = CACHE_THUMBNAIL_DIR / "_image-metadata.json"
+CACHE_IMAGE_INDEX = CACHE_THUMBNAIL_DIR / "_image-metadata.sqlite"
+# generated thumbnails by the hash of their source image and how they were generated
+CACHE_OBJECT_DIR = CACHE_DIR / "objects/"
 
 THUMBNAIL_DIR = Path("public/thumbs/")
 IMAGE_METADATA_JSON = THUMBNAIL_DIR / "_image-metadata.json"
 
+# thumbnails of the live website that can be reused
+REMOTE_THUMBNAIL_URL = "https://openmodeldb.info/thumbs/"
+REMOTE_IMAGE_METADATA_URL = REMOTE_THUMBNAIL_URL + "_image-metadata.json"
+CACHE_ZIP_URL = (
+    "https://github.com/OpenModelDB/auxiliary/releases/download/thumbnails/thumbs.zip"
+)
+# the manifest of the bundles of CACHE_THUMBNAIL_DIR, from which missing files are
+# downloaded, see cache_bundle.py and build-cache-bundle.py. The zip is only used if
+# they are unavailable.
+CACHE_BUNDLE_MANIFEST_URL = (
+    "https://github.com/OpenModelDB/auxiliary/releases/download/thumbnails/thumbs.json"
+)
+# the number of byte ranges of bundles downloaded in parallel
+CACHE_BUNDLE_WORKERS = 8
+# exists while the cache is restored, so an interrupted restore is continued
+CACHE_RESTORE_MARKER = CACHE_DIR / "restoring"
+
+MANIFEST_JSON = CACHE_THUMBNAIL_DIR / "_manifest.json"
+# Bump this whenever a change to this script changes the thumbnails generated for a
+# model. This invalidates all manifest entries, and since it's part of the names of
+# thumbnails, existing thumbnails (local, cached or remote) are no longer reused.
+MANIFEST_VERSION = 5
+
+# The number of bytes read to find the size of an image without downloading all of it.
+# JPEGs with large metadata segments need more than the first attempt.
+PROBE_SIZES = (64 * 1024, 1024 * 1024)
+
+# The number of slowest models listed after a run.
+SLOWEST_MODELS = 10
+METRICS_JSON = CACHE_DIR / "metrics.json"
+
+# Images of different models whose perceptual hashes differ in at most this many bits
+# are reported as near-duplicates.
+NEAR_DUPLICATE_DISTANCE = 4
+DUPLICATES_JSON = CACHE_DIR / "duplicates.json"
+
+# The maximum total size of decoded images kept in memory by the main process, e.g.
+# LR images decoded for their saliency. Encode workers don't cache decoded images.
+DECODED_IMAGE_CACHE_BYTES = 512 * 1024 * 1024
+# Searching for the lowest quality of a thumbnail (see encode_lowest_quality) usually
+# takes this many encodes. Only used to estimate the cost of image jobs.
+QUALITY_SEARCH_ENCODES = 4
+# The minimum number of seconds between progress messages of image jobs.
+PROGRESS_INTERVAL = 10.0
+# The number of bytes of an image compared at a time to check whether it's grayscale.
+GRAYSCALE_CHECK_BYTES = 1024 * 1024
+# JPEGs can be scaled down by these factors while decoding, which is a lot cheaper than
+# decoding them at full size.
+REDUCED_DECODE_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
 # The following are measured from the model card on the OMDB website.
 WEBSITE_MIN_WIDTH = 266
 WEBSITE_MIN_HEIGHT = 154
 WEBSITE_MAX_WIDTH = 549
 WEBSITE_MAX_HEIGHT = 222
-# 275 and 222 are measured from the website. It's the little thumbnail window at 100% DPI.
-# The 1.33 is a DPI scale factor, so devices with higher DPI will get a larger thumbnail.
-CROP_SIZE = (
-    math.ceil(math.ceil(WEBSITE_MAX_WIDTH / 2) * 1.33),
-    math.ceil(WEBSITE_MAX_HEIGHT * 1.33),
-)
+# The pixel densities (device pixels per CSS pixel) thumbnails are generated for. The
+# website picks the closest level for the screen, e.g. the 2x level on 1.5x and 3x
+# screens. Each level and its variants cost their own encodes.
+THUMBNAIL_DENSITIES = (1.0, 2.0)
+# One half of the model card at 100% DPI.
+PAIRED_CROP_SIZE = (math.ceil(WEBSITE_MAX_WIDTH / 2), WEBSITE_MAX_HEIGHT)
+# Paired thumbnails are shown pixelated at an integer number of device pixels per image
+# pixel, but at least one CSS pixel (see model-card.tsx). The most image pixels per CSS
+# pixel a screen can show this way is a bit under 1.34, for a DPR of just under 1.34.
+PAIRED_MAX_DENSITY = 1.33
+# The thumbnails in the image carousel are 48x48 CSS pixels.
+SMALL_THUMBNAIL_SIZE = 48
 COVER_MAX_WIDTH = WEBSITE_MAX_WIDTH
 COVER_MAX_RATIO = WEBSITE_MAX_WIDTH / WEBSITE_MIN_HEIGHT
 COVER_MIN_RATIO = WEBSITE_MIN_WIDTH / WEBSITE_MAX_HEIGHT
 
+# Modern formats the model thumbnail is also generated in, in order of preference. The
+# website serves them with <picture> if they are smaller than the JPEG/PNG thumbnail.
+# Formats that OpenCV can't encode are skipped.
+VARIANT_FORMATS = ("avif", "webp")
+VARIANT_MIME_TYPES = {"avif": "image/avif", "webp": "image/webp"}
+# the qualities searched for the smallest variant that is as good as the JPEG. Finer
+# steps barely change the size, but each one costs an encode.
+VARIANT_QUALITIES = range(30, 96, 5)
+# 0 is the slowest and smallest, 10 the fastest. Variants are generated once and then
+# reused, so the default of OpenCV (9) leaves too much size on the table.
+AVIF_SPEED = 6
+
+# With a target SSIM (--target-ssim), JPEG thumbnails use the lowest of these qualities
+# (up to their usual quality) whose SSIM to the unencoded thumbnail reaches the target.
+JPEG_QUALITIES = range(40, 96, 5)
+JPEG_TARGET_SSIM: Optional[float] = None
+# --verify reports thumbnails that are less similar than this to their unencoded pixels
+VERIFY_MIN_SSIM = 0.9
+# identical images have an infinite PSNR, which JSON can't represent
+MAX_PSNR = 100.0
+
 ModelId = NewType("ModelId", str)
+# thumbnails of one image at each density, from low to high
+Ladder = list[tuple[float, "ThumbnailResult"]]
+
+downloader = Downloader()
+thumbnail_store = ObjectStore(CACHE_OBJECT_DIR)
+# the measurements of the current run
+metrics = Metrics()
 
 
 class Model(TypedDict):
@@ -70,26 +188,54 @@ class PairedImage(TypedDict):
     LR: str
     SR: str
     thumbnail: NotRequired[str]
+    thumbnailSrcSet: NotRequired[list[ThumbnailLevel]]
 
 
 class StandaloneImage(TypedDict):
     type: Literal["standalone"]
     url: str
     thumbnail: NotRequired[str]
+    thumbnailSrcSet: NotRequired[list[ThumbnailLevel]]
 
 
 Image = Union[PairedImage, StandaloneImage]
 
 
+class ThumbnailSource(TypedDict):
+    url: str
+    type: str
+    # in bytes
+    size: int
+
+
+class ThumbnailLevel(TypedDict):
+    url: str
+    density: float
+    width: int
+    height: int
+    sources: NotRequired[list[ThumbnailSource]]
+
+
 class PairedThumbnail(TypedDict):
     type: Literal["paired"]
     LR: str
     SR: str
     LRSize: NotRequired[ImageSize]
     SRSize: NotRequired[ImageSize]
+    LRSources: NotRequired[list[ThumbnailSource]]
+    SRSources: NotRequired[list[ThumbnailSource]]
+    LRSrcSet: NotRequired[list[ThumbnailLevel]]
+    SRSrcSet: NotRequired[list[ThumbnailLevel]]
+
+
+class StandaloneThumbnail(TypedDict):
+    type: Literal["standalone"]
+    url: str
+    sources: NotRequired[list[ThumbnailSource]]
+    srcSet: NotRequired[list[ThumbnailLevel]]
 
 
-Thumbnail = Union[PairedThumbnail, StandaloneImage]
+Thumbnail = Union[PairedThumbnail, StandaloneThumbnail]
 
 
 class ImageSize(TypedDict):
@@ -97,38 +243,69 @@ class ImageSize(TypedDict):
     height: int
 
 
-def download_file(url: str, file: Path, log: bool = True) -> None:
-    """Download from url and save to file"""
+def restore_cache():
+    if CACHE_THUMBNAIL_DIR.exists() and not CACHE_RESTORE_MARKER.exists():
+        return
 
-    if log:
-        print(f"Downloading {url}", flush=True)
-    response = requests.get(url)
-    response.raise_for_status()
-    file.parent.mkdir(parents=True, exist_ok=True)
-    with file.open("wb") as f:
-        f.write(response.content)
+    print("Restoring cache", flush=True)
 
+    CACHE_RESTORE_MARKER.parent.mkdir(parents=True, exist_ok=True)
+    CACHE_RESTORE_MARKER.touch()
+    if not restore_cache_bundle():
+        restore_cache_zip()
+    CACHE_RESTORE_MARKER.unlink()
 
-def download_json(url: str) -> Any:
-    """Download json from url"""
 
-    response = requests.get(url)
-    response.raise_for_status()
-    return response.json()
+def restore_cache_bundle() -> bool:
+    """
+    Downloads the files of the cache bundles that are missing locally. Returns whether
+    the cache was restored, i.e. whether it now has all files of the bundle manifest.
+    """
 
+    try:
+        manifest: BundleManifest = downloader.download_json(CACHE_BUNDLE_MANIFEST_URL)
+    except Exception as e:
+        print(f"Failed to download cache manifest: {e}")
+        return False
+    if manifest.get("version") != BUNDLE_VERSION:
+        print(f"Unsupported cache manifest version {manifest.get('version')}")
+        return False
+
+    missing = get_missing(manifest, CACHE_THUMBNAIL_DIR)
+    if not missing:
+        return True
+    total = len(manifest["entries"])
+    ranges = get_ranges(manifest, missing)
+    print(
+        f"Restoring {len(missing)} of {total} cached files with {len(ranges)} requests",
+        flush=True,
+    )
 
-def restore_cache():
-    if CACHE_THUMBNAIL_DIR.exists():
-        return
+    def restore(bundle_range: BundleRange) -> int:
+        url = urljoin(CACHE_BUNDLE_MANIFEST_URL, bundle_range.bundle)
+        with downloader.stream(url, (bundle_range.start, bundle_range.end)) as stream:
+            return extract_range(stream, bundle_range, manifest, CACHE_THUMBNAIL_DIR)
 
-    print("Restoring cache", flush=True)
+    try:
+        with ThreadPool(CACHE_BUNDLE_WORKERS) as pool:
+            extracted = sum(pool.imap_unordered(restore, ranges))
+    except Exception as e:
+        print(f"Failed to restore cache bundle: {e}")
+        return False
+    metrics.counters.add("cache files restored", extracted)
+
+    # e.g. a bundle of the manifest wasn't published
+    missing = get_missing(manifest, CACHE_THUMBNAIL_DIR)
+    if missing:
+        print(f"Cache bundles are missing {len(missing)} of {total} files")
+        return False
+    return True
 
+
+def restore_cache_zip():
     zip_path = CACHE_DIR / "thumbs.zip"
     try:
-        download_file(
-            "https://github.com/OpenModelDB/auxiliary/releases/download/thumbnails/thumbs.zip",
-            zip_path,
-        )
+        downloader.download_file(CACHE_ZIP_URL, zip_path)
     except Exception as e:
         print(f"Failed to download cache: {e}")
         return
@@ -143,34 +320,30 @@ def restore_cache():
 def update_cache():
     print("Updating cache", flush=True)
 
-    # Copy all images from THUMBNAIL_DIR to CACHE_THUMBNAIL_DIR
+    # Link all images from THUMBNAIL_DIR to CACHE_THUMBNAIL_DIR
     CACHE_THUMBNAIL_DIR.mkdir(parents=True, exist_ok=True)
     for file in THUMBNAIL_DIR.glob("**/*"):
         target = CACHE_THUMBNAIL_DIR / file.relative_to(THUMBNAIL_DIR)
         if (
             file.is_file()
             and not target.exists()
-            and file.suffix in (".jpg", ".jpeg", ".png")
+            and file.suffix in (".jpg", ".jpeg", ".png", ".webp", ".avif")
         ):
-            target.parent.mkdir(parents=True, exist_ok=True)
-            target.write_bytes(file.read_bytes())
-
-    # merge _image-metadata.json
-    old_data = get_cached_image_metadata()
-    current_data = json.loads(IMAGE_METADATA_JSON.read_text(encoding="utf-8"))
-    old_data.update(current_data)
-    CACHE_IMAGE_METADATA_JSON.write_text(
-        json.dumps(old_data, indent=2), encoding="utf-8"
-    )
+            link_or_copy(file, target)
 
 
-class CachedImageMetadata(TypedDict):
-    width: int
-    height: int
+@lru_cache()
+def get_image_index() -> ImageIndex:
+    return ImageIndex(CACHE_IMAGE_INDEX)
 
 
 @lru_cache()
-def get_cached_image_metadata() -> dict[str, CachedImageMetadata]:
+def import_image_metadata():
+    """
+    Adds the image metadata of the website and of JSON files from older caches to the
+    index. This is only done (once) when the index is missing an image.
+    """
+
     def from_file(file: Path) -> dict[str, CachedImageMetadata]:
         if file.exists():
             return json.loads(file.read_text(encoding="utf-8"))
@@ -178,43 +351,187 @@ def get_cached_image_metadata() -> dict[str, CachedImageMetadata]:
 
     def from_url(url: str) -> dict[str, CachedImageMetadata]:
         try:
-            return download_json(url)
+            return downloader.download_json(url)
         except:  # noqa: E722
             return {}
 
-    result: dict[str, CachedImageMetadata] = {}
+    index = get_image_index()
+    # images measured locally take precedence
+    index.upsert(from_file(IMAGE_METADATA_JSON), replace=False)
+    index.upsert(from_file(CACHE_IMAGE_METADATA_JSON), replace=False)
+    index.upsert(from_url(REMOTE_IMAGE_METADATA_URL), replace=False)
 
-    result.update(from_url("https://openmodeldb.info/thumbs/_image-metadata.json"))
-    result.update(from_file(CACHE_IMAGE_METADATA_JSON))
-    result.update(from_file(IMAGE_METADATA_JSON))
 
+def get_cached_image_metadata(urls: Iterable[str]) -> dict[str, CachedImageMetadata]:
+    """Returns the known metadata of the given image URLs."""
+
+    urls = list(urls)
+    index = get_image_index()
+    result = index.get_many(urls)
+    if len(result) < len(set(urls)):
+        import_image_metadata()
+        result.update(index.get_many(url for url in urls if url not in result))
     return result
 
 
-def save_cached_image_metadata(images: dict[str, ImageMetadata]):
-    data: dict[str, CachedImageMetadata] = {}
-    for image in images.values():
-        data[image.url] = {
-            "width": image.width,
-            "height": image.height,
+def save_cached_image_metadata(
+    images: dict[str, ImageMetadata], unchanged_urls: set[str]
+):
+    """
+    Adds the metadata of the given images to the index and exports the metadata of
+    them and the given URLs for the website.
+    """
+
+    get_image_index().upsert(
+        {
+            image.url: {"width": image.width, "height": image.height}
+            for image in images.values()
         }
-    IMAGE_METADATA_JSON.parent.mkdir(parents=True, exist_ok=True)
-    IMAGE_METADATA_JSON.write_text(json.dumps(data, indent=2), encoding="utf-8")
+    )
+
+    data = get_cached_image_metadata(unchanged_urls.union(images))
+    data = dict(sorted(data.items()))
+    write_if_changed(IMAGE_METADATA_JSON, json.dumps(data, indent=2).encode("utf-8"))
 
 
 def get_current_models() -> dict[ModelId, Model]:
-    models: dict[ModelId, Model] = {}
-    for file in MODEL_FILES_DIR.glob("*.json"):
-        model_id = ModelId(file.stem)
-        model: Model = json.loads(file.read_text(encoding="utf-8"))
-        models[model_id] = model
-    return models
+    db = model_db.load(MODEL_FILES_DIR)
+    return {ModelId(model_id): model for model_id, model in db.models.items()}
 
 
 def sha256_str(s: str) -> str:
     return sha256(s.encode("utf-8")).hexdigest().lower()
 
 
+def write_if_changed(file: Path, data: bytes) -> bool:
+    """Writes the data to the file unless the file already has this content."""
+
+    try:
+        if file.stat().st_size == len(data) and file.read_bytes() == data:
+            return False
+    except FileNotFoundError:
+        pass
+
+    # thumbnails are hardlinked, so files must be replaced instead of overwritten
+    write_atomic(file, data)
+    return True
+
+
+def save_model(model_id: ModelId, model: Model):
+    model_file = MODEL_FILES_DIR / f"{model_id}.json"
+    write_if_changed(model_file, json.dumps(model, indent=4).encode("utf-8"))
+
+
+class ManifestEntry(TypedDict):
+    # a hash of everything the thumbnails of the model depend on
+    input: str
+    thumbnail: NotRequired[Thumbnail]
+    # the small thumbnail of each image of the model
+    imageThumbnails: list[Optional[str]]
+    imageThumbnailSrcSets: list[Optional[list[ThumbnailLevel]]]
+    # the names of the thumbnails generated from each image URL
+    outputs: dict[str, list[str]]
+
+
+def get_model_input_hash(model: Model) -> str:
+    """
+    Thumbnails only depend on the images of a model, so edits to anything else (and
+    generated thumbnail properties) don't change this hash.
+    """
+
+    images = [
+        {k: v for k, v in image.items() if k != "thumbnail"}
+        for image in model["images"]
+    ]
+    data = {
+        "version": MANIFEST_VERSION,
+        "formats": get_variant_formats(),
+        "densities": list(THUMBNAIL_DENSITIES),
+        "targetSsim": JPEG_TARGET_SSIM,
+        "images": images,
+    }
+    return sha256_str(json.dumps(data))
+
+
+def load_manifest() -> dict[ModelId, ManifestEntry]:
+    if MANIFEST_JSON.exists():
+        return json.loads(MANIFEST_JSON.read_text(encoding="utf-8"))
+    return {}
+
+
+def save_manifest(manifest: dict[ModelId, ManifestEntry]):
+    data = json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8")
+    write_if_changed(MANIFEST_JSON, data)
+
+
+def apply_manifest_entry(model: Model, entry: ManifestEntry):
+    if "thumbnail" in entry:
+        model["thumbnail"] = entry["thumbnail"]
+    for image, thumbnail, src_set in zip(
+        model["images"], entry["imageThumbnails"], entry["imageThumbnailSrcSets"]
+    ):
+        if thumbnail is not None:
+            image["thumbnail"] = thumbnail
+        if src_set is not None:
+            image["thumbnailSrcSet"] = src_set
+
+
+def get_image_urls(model: Model) -> list[str]:
+    """Returns the URLs of all images thumbnails are generated from."""
+
+    urls: list[str] = []
+    if len(model["images"]) == 0:
+        return urls
+
+    # small thumbnails
+    for image in model["images"]:
+        if image["type"] == "paired":
+            # we only use the LR image for small thumbnails
+            urls.append(image["LR"])
+        elif image["type"] == "standalone":
+            urls.append(image["url"])
+
+    # thumbnail
+    image = model["images"][0]
+    if image["type"] == "paired":
+        urls.append(image["SR"])
+
+    return urls
+
+
+class DecodedImageCache:
+    """A thread-safe LRU cache of decoded images bounded by their total size in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._bytes = 0
+        self._images: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            img = self._images.get(key)
+            if img is not None:
+                self._images.move_to_end(key)
+            return img
+
+    def put(self, key: str, img: np.ndarray):
+        if img.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._images[key] = img
+            self._bytes += img.nbytes
+            while self._bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+
+decoded_image_cache = DecodedImageCache(DECODED_IMAGE_CACHE_BYTES)
+
+
 @dataclass
 class ImageMetadata:
     url: str
@@ -238,75 +555,147 @@ class ImageMetadata:
     def size(self) -> tuple[int, int]:
         return self.width, self.height
 
-    def load(self) -> np.ndarray:
-        if not self.file.exists():
-            download_file(self.url, self.file)
+    def probe_size(self) -> Optional[tuple[int, int]]:
+        """
+        Reads the size of the image from the start of its file, without downloading or
+        decoding all of it. Returns `None` if the size couldn't be determined.
+        """
 
-        img = cv2.imread(str(self.file), cv2.IMREAD_UNCHANGED)
+        for size in PROBE_SIZES:
+            if self.file.exists():
+                with self.file.open("rb") as f:
+                    data = f.read(size)
+            else:
+                data = downloader.download_head(self.url, size)
+
+            result = probe_image_size(data)
+            if result is not None or len(data) < size:
+                return result
+        return None
+
+    def load(self, reduction: int = 1, region: Optional[Region] = None) -> np.ndarray:
+        """
+        Returns the decoded image as uint8 without alpha channel.
+
+        If `reduction` is greater than 1, the image is scaled down by this factor while
+        decoding. See `get_decode_reduction`.
+
+        If `region` is given, only this region of the image is returned. PNGs are then
+        decoded without holding the whole image in memory. See `get_decode_region`.
+
+        Decoded images are cached, so the returned array must not be modified.
+        """
+
+        key = self.url if reduction == 1 else f"{self.url}#{reduction}"
+        if region is not None:
+            key += f"#{region}"
+        img = decoded_image_cache.get(key)
+        if img is None:
+            img = self._decode(reduction, region)
+            img.flags.writeable = False
+            decoded_image_cache.put(key, img)
+        return img
+
+    def _decode(self, reduction: int, region: Optional[Region]) -> np.ndarray:
+        if not self.file.exists():
+            downloader.download_file(self.url, self.file)
+
+        img = None
+        if region is not None and self.ext == "png":
+            img = decode_png_region(self.file, region.x, region.y, region.w, region.h)
+        if img is None:
+            if reduction == 1:
+                flags = cv2.IMREAD_UNCHANGED
+            else:
+                # IMREAD_UNCHANGED doesn't apply the EXIF orientation, so this mustn't
+                # either
+                flags = REDUCED_DECODE_FLAGS[reduction] | cv2.IMREAD_IGNORE_ORIENTATION
+            img = cv2.imread(str(self.file), flags)
+            if img is None:
+                raise ValueError(f"Unable to decode {self.url}")
+            if region is not None:
+                # copied, so the cache doesn't keep the whole image alive
+                img = img[
+                    region.y : region.y + region.h, region.x : region.x + region.w
+                ].copy()
 
         # as uint8
         if img.dtype == np.uint16:
-            img = (img.astype(np.float32) / 257).round().astype(np.uint8)
+            # rounds like x / 257 without float temporaries
+            img = cv2.convertScaleAbs(img, alpha=1 / 257)
         if img.dtype == np.float32 or img.dtype == np.float64:
-            img = (img * 255).round().astype(np.uint8)
+            img *= 255
+            img = np.rint(img, out=img).astype(np.uint8)
 
         if img.ndim == 3:
             # remove alpha channel
             if img.shape[2] == 4:
-                img = (
-                    (
-                        img[:, :, :3].astype(np.float32)
-                        * img[:, :, 3:4].astype(np.float32)
-                        / 255
-                    )
-                    .round()
-                    .astype(np.uint8)
-                )
+                # premultiplies the color channels in place, rounding like c * a / 255
+                cv2.cvtColor(img, cv2.COLOR_RGBA2mRGBA, dst=img)
+                img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
 
             # convert to grayscale if possible
-            if img.shape[2] == 3:
-                if np.all(img[:, :, 0] == img[:, :, 1]) and np.all(
-                    img[:, :, 1] == img[:, :, 2]
-                ):
-                    img = img[:, :, 0]
+            if img.shape[2] == 3 and is_grayscale(img):
+                img = cv2.extractChannel(img, 0)
 
         return img
 
 
-def get_images(models: dict[ModelId, Model]) -> dict[str, ImageMetadata]:
+def is_grayscale(img: np.ndarray) -> bool:
+    """
+    Returns whether all channels of the image are equal.
+
+    The image is compared in bands of rows, so color images are usually detected after
+    the first band and no full-size temporaries are allocated.
+    """
+
+    rows = max(1, GRAYSCALE_CHECK_BYTES // (img.shape[1] * img.shape[2]))
+    for y in range(0, img.shape[0], rows):
+        band = img[y : y + rows]
+        if not (
+            np.array_equal(band[:, :, 0], band[:, :, 1])
+            and np.array_equal(band[:, :, 1], band[:, :, 2])
+        ):
+            return False
+    return True
+
+
+def get_images(
+    models: dict[ModelId, Model], workers: int = 16
+) -> dict[str, ImageMetadata]:
     images: dict[str, ImageMetadata] = {}
     for model in models.values():
-        if len(model["images"]) == 0:
-            continue
-
-        # small thumbnails
-        for image in model["images"]:
-            if image["type"] == "paired":
-                # we only use the LR image for small thumbnails
-                images[image["LR"]] = ImageMetadata(image["LR"], 0, 0)
-            elif image["type"] == "standalone":
-                images[image["url"]] = ImageMetadata(image["url"], 0, 0)
-
-        # thumbnail
-        image = model["images"][0]
-        if image["type"] == "paired":
-            images[image["LR"]] = ImageMetadata(image["LR"], 0, 0)
-            images[image["SR"]] = ImageMetadata(image["SR"], 0, 0)
-        elif image["type"] == "standalone":
-            images[image["url"]] = ImageMetadata(image["url"], 0, 0)
+        for url in get_image_urls(model):
+            images[url] = ImageMetadata(url, 0, 0)
 
-    cache = get_cached_image_metadata()
-    for image in list(images.values()):
+    cache = get_cached_image_metadata(images.keys())
+    uncached: list[ImageMetadata] = []
+    for image in images.values():
         cached = cache.get(image.url)
         if cached is not None:
             image.width = cached["width"]
             image.height = cached["height"]
         else:
-            try:
-                image.height, image.width = image.load().shape[:2]
-            except:  # noqa: E722
-                print(f"Failed to load {image.url}")
-                del images[image.url]
+            uncached.append(image)
+
+    def fetch_size(image: ImageMetadata) -> bool:
+        try:
+            size = image.probe_size()
+            if size is None:
+                # fall back to decoding the whole image
+                height, width = image.load().shape[:2]
+                size = width, height
+            image.width, image.height = size
+            return True
+        except:  # noqa: E722
+            print(f"Failed to load {image.url}")
+            return False
+
+    if uncached:
+        with ThreadPool(workers) as pool:
+            for image, ok in zip(uncached, pool.map(fetch_size, uncached)):
+                if not ok:
+                    del images[image.url]
 
     return images
 
@@ -315,24 +704,25 @@ def reuse_thumbnail(thumbnail_name: str) -> bool:
     file = THUMBNAIL_DIR / thumbnail_name
     if file.exists():
         # file exists locally
+        metrics.counters.add("reuse local")
         return True
 
     cached_file = CACHE_THUMBNAIL_DIR / thumbnail_name
     if cached_file.exists():
-        # copy from cache
-        file.parent.mkdir(parents=True, exist_ok=True)
-        file.write_bytes(cached_file.read_bytes())
+        # link from cache
+        link_or_copy(cached_file, file)
+        metrics.counters.add("reuse cache")
         return True
 
     try:
         # file exists on server
-        download_file(
-            f"https://openmodeldb.info/thumbs/{thumbnail_name}", file, log=False
-        )
+        downloader.download_file(REMOTE_THUMBNAIL_URL + thumbnail_name, file, log=False)
+        metrics.counters.add("reuse remote")
         return True
     except:  # noqa: E722
         pass
 
+    metrics.counters.add("reuse miss")
     return False
 
 
@@ -364,6 +754,132 @@ class ThumbnailResult:
     name: str
     width: int
     height: int
+    # the names of the variants of the thumbnail in other formats
+    variants: list[str] = field(default_factory=list)
+
+
+@dataclass(frozen=True)
+class ThumbnailSpec:
+    """Describes how a thumbnail is generated from its source image."""
+
+    name: str
+    crop: Optional[Region] = None
+    resize: Optional[tuple[int, int]] = None
+    # the JPEG quality
+    quality: int = 90
+    # Variants are alternatives of another thumbnail in a different format. Their
+    # quality is chosen to match the other thumbnail, unless they are lossless.
+    variant_of: Optional[str] = None
+    lossless: bool = False
+    # Lower density levels are resized from the pixels of the level above instead of
+    # the source image, which is cheaper and keeps the levels consistent.
+    resize_from: Optional[ThumbnailSpec] = None
+    # the SSIM the quality of a JPEG is lowered to, see JPEG_TARGET_SSIM
+    target_ssim: Optional[float] = None
+
+    def output_size(self, image: ImageMetadata) -> tuple[int, int]:
+        if self.resize is not None:
+            return self.resize
+        if self.crop is not None:
+            return self.crop.size
+        return image.size
+
+    @property
+    def ext(self) -> str:
+        return Path(self.name).suffix
+
+    def variants(self) -> list[ThumbnailSpec]:
+        """Returns the specs of the variants of this thumbnail in other formats."""
+
+        lossless = self.ext == ".png"
+        return [
+            replace(
+                self,
+                name=get_variant_name(self.name, fmt),
+                variant_of=self.name,
+                lossless=lossless,
+            )
+            for fmt in get_variant_formats()
+            # only WebP can be lossless
+            if not lossless or fmt == "webp"
+        ]
+
+    def pixel_params(self) -> dict[str, Any]:
+        """Everything the pixels of the thumbnail (before encoding) depend on."""
+
+        return {
+            "crop": None if self.crop is None else asdict(self.crop),
+            "resize": self.resize,
+            "from": (
+                None if self.resize_from is None else self.resize_from.pixel_params()
+            ),
+        }
+
+    def object_key(self, image: ImageMetadata, source_hash: str) -> str:
+        """
+        The key of the thumbnail in `thumbnail_store`. Unlike the name, this doesn't
+        depend on the URL of the image, only on its content.
+        """
+
+        params = {
+            "version": MANIFEST_VERSION,
+            "source": source_hash,
+            # images with a .jpg URL may be used as is, see `render_thumbnail`
+            "sourceExt": image.ext,
+            "ext": self.ext,
+            **self.pixel_params(),
+            "quality": self.quality,
+            "variant": self.variant_of is not None,
+            "lossless": self.lossless,
+            "targetSsim": self.target_ssim,
+        }
+        return sha256_str(json.dumps(params, sort_keys=True))
+
+
+@dataclass
+class ImageJob:
+    """All thumbnails that still have to be generated from one image."""
+
+    image: ImageMetadata
+    thumbnails: list[ThumbnailSpec]
+    # the SHA256 of the image file, once it's downloaded
+    source_hash: Optional[str] = None
+    # whether to measure the quality of the thumbnails, see `measure_quality`
+    verify: bool = False
+
+
+class QualityScore(TypedDict):
+    psnr: float
+    ssim: float
+    bytes: int
+
+
+class ImageJobResult(TypedDict):
+    # the time spent in each stage
+    times: dict[str, StageTime]
+    # the quality of each generated thumbnail, if the job was verified
+    scores: dict[str, QualityScore]
+
+
+class ImageJobs:
+    """Collects the thumbnails that have to be generated, grouped by source image."""
+
+    def __init__(self):
+        self._jobs: dict[str, ImageJob] = {}
+        self._lock = threading.Lock()
+
+    def add(self, image: ImageMetadata, spec: ThumbnailSpec):
+        with self._lock:
+            job = self._jobs.get(image.url)
+            if job is None:
+                job = ImageJob(image, [])
+                self._jobs[image.url] = job
+            if all(t.name != spec.name for t in job.thumbnails):
+                job.thumbnails.append(spec)
+
+    def values(self) -> list[ImageJob]:
+        with self._lock:
+            return list(self._jobs.values())
 
 
 def encode_png(img: np.ndarray) -> bytes:
@@ -383,106 +899,778 @@ def encode_jpeg(img: np.ndarray, *, quality: int) -> bytes:
     return cv2.imencode("foo.jpg", img, params)[1].tobytes()
 
 
-def encode_image(img: np.ndarray, name: str):
+def encode_webp(img: np.ndarray, *, quality: int, lossless: bool = False) -> bytes:
+    # qualities above 100 are lossless
+    params = [cv2.IMWRITE_WEBP_QUALITY, 101 if lossless else quality]
+    return cv2.imencode("foo.webp", img, params)[1].tobytes()
+
+
+def encode_avif(img: np.ndarray, *, quality: int) -> bytes:
+    params = [cv2.IMWRITE_AVIF_QUALITY, quality, cv2.IMWRITE_AVIF_SPEED, AVIF_SPEED]
+    return cv2.imencode("foo.avif", img, params)[1].tobytes()
+
+
+def encode_image(
+    img: np.ndarray, name: str, *, quality: int = 90, lossless: bool = False
+):
     if name.endswith(".png"):
         return encode_png(img)
     if name.endswith(".jpg") or name.endswith(".jpeg"):
-        return encode_jpeg(img, quality=90)
+        return encode_jpeg(img, quality=quality)
+    if name.endswith(".webp"):
+        return encode_webp(img, quality=quality, lossless=lossless)
+    if name.endswith(".avif"):
+        return encode_avif(img, quality=quality)
     raise ValueError("Unsupported image format")
 
 
-def get_lr_crop(size: tuple[int, int], scale: int) -> Region:
+@lru_cache()
+def get_variant_formats() -> list[str]:
+    return [f for f in VARIANT_FORMATS if cv2.haveImageWriter(f"foo.{f}")]
+
+
+def get_variant_name(thumbnail_name: str, fmt: str) -> str:
+    return Path(thumbnail_name).with_suffix(f".{fmt}").as_posix()
+
+
+def get_thumbnail_sources(thumbnail_url: str) -> list[ThumbnailSource]:
+    """
+    Returns the generated variants of the thumbnail that are smaller than it, in order
+    of preference.
+    """
+
+    if not thumbnail_url.startswith("/thumbs/"):
+        return []
+    name = thumbnail_url[len("/thumbs/") :]
+    try:
+        size = (THUMBNAIL_DIR / name).stat().st_size
+    except FileNotFoundError:
+        return []
+
+    sources: list[ThumbnailSource] = []
+    for fmt in get_variant_formats():
+        variant = get_variant_name(name, fmt)
+        try:
+            variant_size = (THUMBNAIL_DIR / variant).stat().st_size
+        except FileNotFoundError:
+            continue
+        if variant_size < size:
+            sources.append(
+                {
+                    "url": "/thumbs/" + variant,
+                    "type": VARIANT_MIME_TYPES[fmt],
+                    "size": variant_size,
+                }
+            )
+    return sources
+
+
+def add_thumbnail_sources(model: Model):
+    """Adds the variants of the generated thumbnail of the model to it."""
+
+    def add_to_levels(levels: list[ThumbnailLevel]):
+        for level in levels:
+            sources = get_thumbnail_sources(level["url"])
+            if sources:
+                level["sources"] = sources
+
+    thumbnail = model.get("thumbnail")
+    if thumbnail is None:
+        return
+    if thumbnail["type"] == "paired":
+        for key, sources_key in (("LR", "LRSources"), ("SR", "SRSources")):
+            sources = get_thumbnail_sources(thumbnail[key])
+            if sources:
+                thumbnail[sources_key] = sources
+        add_to_levels(thumbnail.get("LRSrcSet", []))
+        add_to_levels(thumbnail.get("SRSrcSet", []))
+    elif thumbnail["type"] == "standalone":
+        sources = get_thumbnail_sources(thumbnail["url"])
+        if sources:
+            thumbnail["sources"] = sources
+        add_to_levels(thumbnail.get("srcSet", []))
+
+
+def decode_buffer(data: bytes) -> np.ndarray:
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError("Unable to decode an encoded thumbnail")
+    return img
+
+
+def encode_lowest_quality(
+    img: np.ndarray,
+    name: str,
+    qualities: list[int],
+    target: float,
+    hint: Optional[int] = None,
+) -> tuple[bytes, int]:
+    """
+    Encodes the image with the lowest of the (ascending) qualities whose SSIM to the
+    image is at least `target`, or the highest quality if none is. Returns the encoded
+    image and its quality.
+
+    The search starts at the quality `hint`, e.g. the quality of the same variant at
+    another density, which is usually at most a step away.
+    """
+
+    results: dict[int, Optional[bytes]] = {}
+
+    def passes(i: int) -> bool:
+        if i not in results:
+            data = encode_image(img, name, quality=qualities[i])
+            results[i] = data if ssim(img, decode_buffer(data)) >= target else None
+        return results[i] is not None
+
+    # binary search, assuming that similarity increases with quality
+    low, high = 0, len(qualities) - 1
+    if hint in qualities:
+        # narrow the range around the hint first
+        i = qualities.index(hint)
+        if passes(i):
+            high = i - 1
+            if i > 0 and not passes(i - 1):
+                low = i
+        else:
+            low = i + 1
+    while low <= high:
+        mid = (low + high) // 2
+        if passes(mid):
+            high = mid - 1
+        else:
+            low = mid + 1
+
+    for i in range(low, len(qualities)):
+        data = results.get(i)
+        if data is not None:
+            return data, qualities[i]
+    quality = qualities[-1]
+    return encode_image(img, name, quality=quality), quality
+
+
+def encode_variant(
+    img: np.ndarray, spec: ThumbnailSpec, reference: bytes, hint: Optional[int] = None
+) -> tuple[bytes, int]:
+    """
+    Encodes the variant with the lowest quality that is at least as similar (SSIM) to
+    the image as the `reference` encoding of it. Returns the encoded variant and its
+    quality.
+    """
+
+    target = ssim(img, decode_buffer(reference))
+    return encode_lowest_quality(img, spec.name, list(VARIANT_QUALITIES), target, hint)
+
+
+def encode_jpeg_for_target(img: np.ndarray, spec: ThumbnailSpec) -> bytes:
+    """Encodes the JPEG with the lowest quality that reaches its target SSIM."""
+
+    assert spec.target_ssim is not None
+    qualities = [q for q in JPEG_QUALITIES if q < spec.quality] + [spec.quality]
+    data, _ = encode_lowest_quality(img, spec.name, qualities, spec.target_ssim)
+    return data
+
+
+def measure_quality(pixels: np.ndarray, data: bytes) -> QualityScore:
+    """Compares the encoded thumbnail to the pixels it was encoded from."""
+
+    decoded = decode_buffer(data)
+    return {
+        "psnr": min(psnr(pixels, decoded), MAX_PSNR),
+        "ssim": ssim(pixels, decoded),
+        "bytes": len(data),
+    }
+
+
+def get_crop_size(density: float) -> tuple[int, int]:
+    return (
+        math.ceil(PAIRED_CROP_SIZE[0] * density),
+        math.ceil(PAIRED_CROP_SIZE[1] * density),
+    )
+
+
+def get_lr_crop(
+    size: tuple[int, int],
+    scale: int,
+    density: float = PAIRED_MAX_DENSITY,
+    center: Optional[tuple[float, float]] = None,
+) -> Region:
+    """
+    Returns the crop of an LR image of the given size. The crop is centered on `center`
+    as far as the image allows, or on the center of the image.
+    """
+
     w, h = size
-    target_w, target_h = CROP_SIZE[0], CROP_SIZE[1]
+    target_w, target_h = get_crop_size(density)
     target_w = math.ceil(target_w / scale)
     target_h = math.ceil(target_h / scale)
+    if center is None:
+        return Region(
+            x=max(0, (w - target_w) // 2),
+            y=max(0, (h - target_h) // 2),
+            w=min(w, target_w),
+            h=min(h, target_h),
+        )
+
+    crop_w, crop_h = min(w, target_w), min(h, target_h)
     return Region(
-        x=max(0, (w - target_w) // 2),
-        y=max(0, (h - target_h) // 2),
-        w=min(w, target_w),
-        h=min(h, target_h),
+        x=min(max(0, round(center[0] - crop_w / 2)), w - crop_w),
+        y=min(max(0, round(center[1] - crop_h / 2)), h - crop_h),
+        w=crop_w,
+        h=crop_h,
     )
 
 
-def save_thumbnail(thumbnail_name: str, data: bytes):
-    file = THUMBNAIL_DIR / thumbnail_name
-    file.parent.mkdir(parents=True, exist_ok=True)
-    file.write_bytes(data)
+def get_thumbnail_pair(
+    model: Model, images: dict[str, ImageMetadata]
+) -> Optional[tuple[ImageMetadata, ImageMetadata]]:
+    """Returns the LR and SR image of the model thumbnail if it is a loaded pair."""
 
+    if len(model["images"]) == 0:
+        return None
+    image = model["images"][0]
+    if image["type"] != "paired":
+        return None
+    lr, sr = images.get(image["LR"]), images.get(image["SR"])
+    if lr is None or sr is None:
+        return None
+    return lr, sr
+
+
+def find_paired_centers(
+    models: dict[ModelId, Model], images: dict[str, ImageMetadata], workers: int
+) -> dict[tuple[str, str], tuple[float, float]]:
+    """
+    Returns the center of the most detailed region of each paired model thumbnail by
+    its LR and SR URL, in pixels of the LR size of the pair. Pairs without a detailed
+    region are missing and cropped at the center.
+
+    The most detailed window of an image is cached in the image index, so only new
+    images are downloaded and scored.
+    """
+
+    # the pairs whose crops are found by each window of an LR image, with the factor by
+    # which the LR image is larger than the LR size of the pair
+    windows: dict[WindowKey, list[tuple[tuple[str, str], int]]] = {}
+    for model in models.values():
+        pair = get_thumbnail_pair(model, images)
+        if pair is None:
+            continue
+        lr, sr = pair
+        scale = round(sr.width / lr.width)
+        # LR images upscaled to the size of the SR image, see `process_model`
+        factor = scale if lr.size == sr.size else 1
+        lr_size = lr.width // factor, lr.height // factor
+        crop = get_lr_crop(lr_size, scale).scale(factor)
+        key = (lr.url, crop.w, crop.h)
+        windows.setdefault(key, []).append(((lr.url, sr.url), factor))
+
+    index = get_image_index()
+    positions = index.get_windows(windows)
+    missing = [key for key in windows if key not in positions]
+    metrics.counters.add("saliency cached", len(positions))
+
+    def find(key: WindowKey) -> tuple[WindowKey, Optional[tuple[int, int]], bool]:
+        url, w, h = key
+        try:
+            return key, find_salient_window(images[url].load(), (w, h)), True
+        except Exception as e:
+            print(f"Failed to score {url}: {e}")
+            return key, None, False
+
+    if missing:
+        found: dict[WindowKey, Optional[tuple[int, int]]] = {}
+        with ThreadPool(workers) as pool:
+            for key, position, ok in pool.map(find, missing):
+                if ok:
+                    found[key] = position
+                positions[key] = position
+        index.put_windows(found)
+
+    centers: dict[tuple[str, str], tuple[float, float]] = {}
+    for (url, w, h), position in positions.items():
+        if position is None:
+            continue
+        for pair, factor in windows[(url, w, h)]:
+            x, y = position
+            centers[pair] = (x + w / 2) / factor, (y + h / 2) / factor
+    return centers
 
-def save_thumbnail_crop(
-    image: ImageMetadata, crop: Region, ext: Literal[".jpg", ".png"]
-) -> ThumbnailResult:
-    thumbnail_name = sha256_str(f"crop:{crop}:{image.url}")[:24] + ext
-    result = ThumbnailResult(thumbnail_name, width=crop.w, height=crop.h)
 
-    if reuse_thumbnail(thumbnail_name):
-        return result
+def save_thumbnail(thumbnail_name: str, data: bytes, key: Optional[str] = None):
+    """
+    Saves the thumbnail. If its `key` in `thumbnail_store` is known, the thumbnail is
+    stored there and linked into THUMBNAIL_DIR.
+    """
 
-    img = image.load()
-    img = img[crop.y : crop.y + crop.h, crop.x : crop.x + crop.w]
-    buffer = encode_image(img, thumbnail_name)
+    file = THUMBNAIL_DIR / thumbnail_name
+    if key is None:
+        write_if_changed(file, data)
+    else:
+        ext = Path(thumbnail_name).suffix
+        link_or_copy(thumbnail_store.put(key, ext, data), file)
+
+
+def render_pixels(
+    img: np.ndarray,
+    spec: ThumbnailSpec,
+    rendered: dict[str, np.ndarray],
+    origin: tuple[int, int] = (0, 0),
+) -> np.ndarray:
+    """
+    Returns the pixels of the thumbnail. `rendered` caches the pixels of thumbnails
+    from the same image, so variants and levels resized from them don't repeat work.
+    `origin` is the position of `img` in the image if only a region was decoded.
+    """
+
+    key = json.dumps(spec.pixel_params())
+    pixels = rendered.get(key)
+    if pixels is not None:
+        return pixels
+
+    if spec.resize_from is not None:
+        img = render_pixels(img, spec.resize_from, rendered, origin)
+        origin = (0, 0)
+    if spec.crop is not None:
+        x, y = spec.crop.x - origin[0], spec.crop.y - origin[1]
+        img = img[y : y + spec.crop.h, x : x + spec.crop.w]
+    if spec.resize is not None and spec.resize != (img.shape[1], img.shape[0]):
+        img = cv2.resize(img, spec.resize, interpolation=cv2.INTER_AREA)
+    rendered[key] = img
+    return img
+
+
+def render_thumbnail(
+    image: ImageMetadata,
+    img: np.ndarray,
+    spec: ThumbnailSpec,
+    times: StageTimes,
+    reference: Optional[bytes] = None,
+    rendered: Optional[dict[str, np.ndarray]] = None,
+    qualities: Optional[dict[str, int]] = None,
+    origin: tuple[int, int] = (0, 0),
+) -> bytes:
+    """
+    Renders the thumbnail from the decoded image. `reference` is the thumbnail a variant
+    is an alternative of. See `render_pixels` for `rendered` and `origin`. `qualities`
+    are the last qualities chosen for variants by format, used as hints for the next
+    one.
+    """
+
+    with times.measure("resize"):
+        img = render_pixels(img, spec, {} if rendered is None else rendered, origin)
+    with times.measure("encode"):
+        if spec.variant_of is not None and not spec.lossless:
+            assert reference is not None
+            qualities = {} if qualities is None else qualities
+            buffer, qualities[spec.ext] = encode_variant(
+                img, spec, reference, qualities.get(spec.ext)
+            )
+            return buffer
+        if spec.target_ssim is not None and spec.ext == ".jpg":
+            buffer = encode_jpeg_for_target(img, spec)
+        else:
+            buffer = encode_image(
+                img, spec.name, quality=spec.quality, lossless=spec.lossless
+            )
 
     if (
-        image.size == crop.size
-        and ext == ".jpg"
-        and image.ext == ext[1:]
+        spec.output_size(image) == image.size
+        and spec.name.endswith(".jpg")
+        and image.ext == "jpg"
         and image.file.stat().st_size < len(buffer)
     ):
         # just use the original
         buffer = image.file.read_bytes()
 
-    save_thumbnail(thumbnail_name, buffer)
+    return buffer
+
+
+def get_decode_reduction(job: ImageJob) -> int:
+    """
+    Returns the largest factor by which the image of the job can be scaled down while
+    decoding without affecting the quality of its thumbnails.
+
+    This is only done for JPEGs (libjpeg can skip most of the work), and only if all
+    thumbnails are resizes of the whole image to at most half of the reduced size, so
+    the resize still has enough pixels to work with.
+    """
+
+    image = job.image
+    if image.ext != "jpg":
+        return 1
+    # only the specs at the start of resize chains see the decoded image
+    roots: list[ThumbnailSpec] = []
+    for spec in job.thumbnails:
+        while spec.resize_from is not None:
+            spec = spec.resize_from
+        roots.append(spec)
+    sizes = [spec.resize for spec in roots if spec.crop is None]
+    if len(sizes) != len(roots) or None in sizes:
+        return 1
+
+    max_w = max(size[0] for size in sizes if size is not None)
+    max_h = max(size[1] for size in sizes if size is not None)
+    for reduction in sorted(REDUCED_DECODE_FLAGS, reverse=True):
+        w = math.ceil(image.width / reduction)
+        h = math.ceil(image.height / reduction)
+        if w >= 2 * max_w and h >= 2 * max_h:
+            return reduction
+    return 1
+
+
+def get_decode_region(job: ImageJob) -> Optional[Region]:
+    """
+    Returns the region of the image that contains all thumbnails of the job, if they
+    are all crops of a part of the image. For example, the crops of paired images only
+    need a small window of large SR images.
+    """
+
+    regions: list[Region] = []
+    for spec in job.thumbnails:
+        while spec.resize_from is not None:
+            spec = spec.resize_from
+        if spec.crop is None:
+            return None
+        regions.append(spec.crop)
+
+    x = min(region.x for region in regions)
+    y = min(region.y for region in regions)
+    w = max(region.x + region.w for region in regions) - x
+    h = max(region.y + region.h for region in regions) - y
+    if (w, h) == job.image.size:
+        return None
+    return Region(x=x, y=y, w=w, h=h)
+
+
+def run_image_job(job: ImageJob, queued: Optional[float] = None) -> ImageJobResult:
+    """
+    Decodes the image once and generates all of its thumbnails.
+
+    Returns the time spent in each stage and the quality of verified thumbnails, so
+    worker processes can report them. `queued` is the `time.time()` at which the job
+    was submitted.
+    """
+
+    times = StageTimes()
+    if queued is not None:
+        times.add("queue wait", max(0.0, time.time() - queued))
+    region = get_decode_region(job)
+    origin = (0, 0) if region is None else (region.x, region.y)
+    with times.measure("decode"):
+        img = job.image.load(get_decode_reduction(job), region)
+    buffers: dict[str, bytes] = {}
+    rendered: dict[str, np.ndarray] = {}
+    qualities: dict[str, int] = {}
+    scores: dict[str, QualityScore] = {}
+    for spec in job.thumbnails:
+        reference = None
+        if spec.variant_of is not None and not spec.lossless:
+            reference = buffers.get(spec.variant_of)
+            if reference is None:
+                # the thumbnail itself was reused
+                reference = (THUMBNAIL_DIR / spec.variant_of).read_bytes()
+        buffer = render_thumbnail(
+            job.image, img, spec, times, reference, rendered, qualities, origin
+        )
+        buffers[spec.name] = buffer
+        key = None
+        if job.source_hash is not None:
+            key = spec.object_key(job.image, job.source_hash)
+        with times.measure("write"):
+            save_thumbnail(spec.name, buffer, key)
+        if job.verify and spec.ext != ".png" and not spec.lossless:
+            with times.measure("verify"):
+                pixels = render_pixels(img, spec, rendered, origin)
+                scores[spec.name] = measure_quality(pixels, buffer)
+    return {"times": times.as_dict(), "scores": scores}
+
+
+def link_stored_thumbnails(image_jobs: list[ImageJob], workers: int) -> list[ImageJob]:
+    """
+    Links all thumbnails of the jobs that were already generated from an image with the
+    same content, e.g. the same image at another URL.
+
+    Returns the jobs that still have thumbnails to generate.
+    """
+
+    def link(job: ImageJob) -> ImageJob:
+        job.source_hash = sha256_file(job.image.file)
+        remaining: list[ThumbnailSpec] = []
+        for spec in job.thumbnails:
+            stored = thumbnail_store.get(
+                spec.object_key(job.image, job.source_hash), spec.ext
+            )
+            if stored is not None:
+                link_or_copy(stored, THUMBNAIL_DIR / spec.name)
+                metrics.counters.add("reuse store")
+            else:
+                remaining.append(spec)
+        job.thumbnails = remaining
+        return job
+
+    with ThreadPool(workers) as pool:
+        return [job for job in pool.map(link, image_jobs) if job.thumbnails]
+
+
+def init_encode_worker():
+    # parallelism comes from the worker processes, so OpenCV's own thread pool would
+    # only oversubscribe the CPUs
+    cv2.setNumThreads(1)
+    # each image job decodes a different image, so anything a worker cached would never
+    # be used again. Images the parent decoded before the fork can still be hit.
+    decoded_image_cache.max_bytes = 0
+
+
+def estimate_cost(job: ImageJob) -> float:
+    """
+    A rough estimate of the time the job takes, in pixels. Decoding costs the pixels of
+    the decoded image, and encoding the pixels of each thumbnail times the number of
+    encodes. Sizes come from the image metadata, so this needs no decoding.
+    """
+
+    reduction = get_decode_reduction(job)
+    region = get_decode_region(job)
+    if region is not None and job.image.ext == "png":
+        # the rows below the region aren't decoded
+        cost = job.image.width * (region.y + region.h)
+    else:
+        cost = job.image.width * job.image.height / reduction**2
+    for spec in job.thumbnails:
+        w, h = spec.output_size(job.image)
+        searched = (spec.variant_of is not None and not spec.lossless) or (
+            spec.target_ssim is not None and spec.ext == ".jpg"
+        )
+        cost += w * h * (QUALITY_SEARCH_ENCODES if searched else 1)
+    return cost
+
+
+class Progress:
+    """Prints how many jobs are done with an ETA based on the estimated cost."""
+
+    def __init__(self, total_jobs: int, total_cost: float):
+        self.total_jobs = total_jobs
+        self.total_cost = total_cost
+        self.jobs = 0
+        self.cost = 0.0
+        self.start = time.perf_counter()
+        self.last_print = self.start
+
+    def update(self, cost: float):
+        self.jobs += 1
+        self.cost += cost
+        now = time.perf_counter()
+        if now - self.last_print < PROGRESS_INTERVAL and self.jobs < self.total_jobs:
+            return
+        self.last_print = now
+
+        elapsed = now - self.start
+        remaining = self.total_cost - self.cost
+        eta = elapsed * remaining / self.cost if self.cost > 0 else 0.0
+        print(
+            f"Generated thumbnails of {self.jobs}/{self.total_jobs} images"
+            f" ({elapsed:.0f}s elapsed, ETA {eta:.0f}s)",
+            flush=True,
+        )
+
+
+def run_image_jobs(image_jobs: list[ImageJob], workers: int):
+    """
+    Runs the CPU-bound decoding and encoding in `workers` processes.
+
+    Jobs are started from the most to the least expensive (see `estimate_cost`), so a
+    huge image isn't left running alone at the end while the other workers are idle.
+    """
+
+    def record(job: ImageJob, result: ImageJobResult):
+        metrics.stages.update(result["times"])
+        metrics.item("images", job.image.url).update(result["times"])
+        for name, score in result["scores"].items():
+            values = {k: score[k] for k in ("psnr", "ssim", "bytes")}
+            metrics.record("quality", name, values)
+
+    costs = {id(job): estimate_cost(job) for job in image_jobs}
+    image_jobs = sorted(image_jobs, key=lambda job: costs[id(job)], reverse=True)
+    progress = Progress(len(image_jobs), sum(costs.values()))
+
+    if workers <= 1 or len(image_jobs) <= 1:
+        for job in image_jobs:
+            record(job, run_image_job(job))
+            progress.update(costs[id(job)])
+        return
+
+    with ProcessPoolExecutor(workers, initializer=init_encode_worker) as executor:
+        # the executor starts jobs in the order they are submitted
+        futures = {
+            executor.submit(run_image_job, job, time.time()): job for job in image_jobs
+        }
+        for future in as_completed(futures):
+            job = futures[future]
+            # errors of workers are raised here
+            record(job, future.result())
+            progress.update(costs[id(job)])
+
+
+def schedule_thumbnail(
+    image: ImageMetadata, spec: ThumbnailSpec, jobs: ImageJobs, variants: bool = False
+) -> ThumbnailResult:
+    """
+    Returns the thumbnail described by the spec. If it can't be reused, it will be
+    generated when `jobs` are run. The same goes for its variants if `variants` is true.
+    """
+
+    if spec.ext == ".jpg" and spec.variant_of is None:
+        spec = replace(spec, target_ssim=JPEG_TARGET_SSIM)
+    width, height = spec.output_size(image)
+    result = ThumbnailResult(spec.name, width=width, height=height)
+    # variants come after their thumbnail, so their job can use it as a reference
+    for s in [spec] + (spec.variants() if variants else []):
+        if not reuse_thumbnail(s.name):
+            jobs.add(image, s)
+        if s is not spec:
+            result.variants.append(s.name)
     return result
 
 
-def save_thumbnail_resize(
-    image: ImageMetadata, crop_size: tuple[int, int], resize_size: tuple[int, int]
+def get_paired_densities() -> list[float]:
+    return sorted({min(d, PAIRED_MAX_DENSITY) for d in THUMBNAIL_DENSITIES})
+
+
+def get_resize_ladder(
+    size: tuple[int, int], max_size: tuple[int, int]
+) -> list[tuple[float, tuple[int, int]]]:
+    """
+    Returns the size of each density level of a thumbnail that is `size` at 1x,
+    without upscaling beyond `max_size`. The 1x level is always included.
+    """
+
+    levels = [(1.0, size)]
+    for density in sorted(d for d in THUMBNAIL_DENSITIES if d > 1):
+        w = math.ceil(size[0] * density)
+        h = math.ceil(size[1] * density)
+        if w >= max_size[0] or h >= max_size[1]:
+            # the largest level is the source itself
+            if max_size[0] > levels[-1][1][0]:
+                levels.append((round(max_size[0] / size[0], 2), max_size))
+            break
+        levels.append((density, (w, h)))
+    return levels
+
+
+def get_thumbnail_name(key: str, ext: str) -> str:
+    """The file name of a thumbnail. `key` describes everything its pixels depend on."""
+
+    if JPEG_TARGET_SSIM is not None and ext == ".jpg":
+        # JPEGs of a lower quality mustn't replace the ones of the usual quality
+        key += f":ssim={JPEG_TARGET_SSIM}"
+    # thumbnails of older versions of this script may look different
+    key += f":v{MANIFEST_VERSION}"
+    return sha256_str(key)[:24] + ext
+
+
+def save_thumbnail_crop(
+    image: ImageMetadata,
+    crop: Region,
+    ext: Literal[".jpg", ".png"],
+    jobs: ImageJobs,
+    variants: bool = False,
 ) -> ThumbnailResult:
-    thumbnail_name = (
-        sha256_str(f"resize:{crop_size}:{resize_size}:{image.url}")[:24] + ".jpg"
-    )
-    result = ThumbnailResult(
-        thumbnail_name, width=resize_size[0], height=resize_size[1]
-    )
+    thumbnail_name = get_thumbnail_name(f"crop:{crop}:{image.url}", ext)
+    spec = ThumbnailSpec(thumbnail_name, crop=crop)
+    return schedule_thumbnail(image, spec, jobs, variants)
+
+
+def schedule_ladder(
+    image: ImageMetadata,
+    levels: list[tuple[float, tuple[int, int]]],
+    get_name: Callable[[tuple[int, int]], str],
+    jobs: ImageJobs,
+    crop: Optional[Region] = None,
+    quality: int = 90,
+    variants: bool = False,
+) -> Ladder:
+    """
+    Schedules the (cropped) image resized to each level. The top level is resized from
+    the image, and every other level from the one above it.
+    """
+
+    ladder: Ladder = []
+    above: Optional[ThumbnailSpec] = None
+    for density, size in reversed(levels):
+        if above is None:
+            spec = ThumbnailSpec(
+                get_name(size), crop=crop, resize=size, quality=quality
+            )
+        else:
+            spec = ThumbnailSpec(
+                get_name(size), resize=size, quality=quality, resize_from=above
+            )
+        ladder.insert(0, (density, schedule_thumbnail(image, spec, jobs, variants)))
+        above = spec
+    return ladder
 
-    if reuse_thumbnail(thumbnail_name):
-        return result
 
-    img = image.load()
-    if crop_size != image.size:
-        y = (image.height - crop_size[1]) // 2
-        x = (image.width - crop_size[0]) // 2
-        img = img[y : y + crop_size[1], x : x + crop_size[0]]
-    img = cv2.resize(img, resize_size, interpolation=cv2.INTER_AREA)
-    buffer = encode_image(img, thumbnail_name)
+def save_thumbnail_resize(
+    image: ImageMetadata,
+    crop_size: tuple[int, int],
+    resize_size: tuple[int, int],
+    jobs: ImageJobs,
+    variants: bool = False,
+) -> Ladder:
+    crop = Region(
+        x=(image.width - crop_size[0]) // 2,
+        y=(image.height - crop_size[1]) // 2,
+        w=crop_size[0],
+        h=crop_size[1],
+    )
 
-    if (
-        image.size == resize_size
-        and image.ext == "jpg"
-        and image.file.stat().st_size < len(buffer)
-    ):
-        # just use the original
-        buffer = image.file.read_bytes()
+    def get_name(size: tuple[int, int]) -> str:
+        return get_thumbnail_name(f"resize:{crop_size}:{size}:{image.url}", ".jpg")
 
-    save_thumbnail(thumbnail_name, buffer)
-    return result
+    levels = get_resize_ladder(resize_size, crop_size)
+    return schedule_ladder(image, levels, get_name, jobs, crop, variants=variants)
 
 
-def save_thumbnail_lr(image: ImageMetadata, scale: int) -> ThumbnailResult:
-    crop = get_lr_crop(image.size, scale)
+def save_thumbnail_lr(
+    image: ImageMetadata,
+    scale: int,
+    jobs: ImageJobs,
+    center: Optional[tuple[float, float]] = None,
+) -> Ladder:
     ext = ".jpg" if scale == 1 else ".png"
-    return save_thumbnail_crop(image, crop, ext)
+    return [
+        (
+            density,
+            save_thumbnail_crop(
+                image, get_lr_crop(image.size, scale, density, center), ext, jobs, True
+            ),
+        )
+        for density in get_paired_densities()
+    ]
 
 
-def save_thumbnail_sr(image: ImageMetadata, scale: int) -> ThumbnailResult:
-    crop = get_lr_crop((image.width // scale, image.height // scale), scale).scale(
-        scale
-    )
-    return save_thumbnail_crop(image, crop, ".jpg")
+def save_thumbnail_sr(
+    image: ImageMetadata,
+    scale: int,
+    jobs: ImageJobs,
+    center: Optional[tuple[float, float]] = None,
+) -> Ladder:
+    lr_size = image.width // scale, image.height // scale
+    return [
+        (
+            density,
+            save_thumbnail_crop(
+                image,
+                get_lr_crop(lr_size, scale, density, center).scale(scale),
+                ".jpg",
+                jobs,
+                True,
+            ),
+        )
+        for density in get_paired_densities()
+    ]
 
 
-def save_thumbnail_standalone(image: ImageMetadata) -> ThumbnailResult:
+def save_thumbnail_standalone(image: ImageMetadata, jobs: ImageJobs) -> Ladder:
     crop_size = image.size
 
     ratio = image.width / image.height
@@ -495,56 +1683,63 @@ def save_thumbnail_standalone(image: ImageMetadata) -> ThumbnailResult:
     if resize_size[0] > COVER_MAX_WIDTH:
         scale = COVER_MAX_WIDTH / resize_size[0]
         resize_size = COVER_MAX_WIDTH, math.ceil(resize_size[1] * scale)
-    return save_thumbnail_resize(image, crop_size, resize_size)
-
+    return save_thumbnail_resize(image, crop_size, resize_size, jobs, variants=True)
 
-def save_small_thumbnail(image: ImageMetadata) -> ThumbnailResult:
-    TARGET_SIZE = 72
 
+def save_small_thumbnail(image: ImageMetadata, jobs: ImageJobs) -> Ladder:
     def resize_to_target_size() -> tuple[int, int]:
         w, h = image.size
-        if w <= TARGET_SIZE and h <= TARGET_SIZE:
+        if w <= SMALL_THUMBNAIL_SIZE and h <= SMALL_THUMBNAIL_SIZE:
             return w, h
         if w == h:
-            return TARGET_SIZE, TARGET_SIZE
+            return SMALL_THUMBNAIL_SIZE, SMALL_THUMBNAIL_SIZE
         if w > h:
-            return TARGET_SIZE, max(1, round(h * TARGET_SIZE / w))
-        return max(1, round(w * TARGET_SIZE / h)), TARGET_SIZE
+            return SMALL_THUMBNAIL_SIZE, max(1, round(h * SMALL_THUMBNAIL_SIZE / w))
+        return max(1, round(w * SMALL_THUMBNAIL_SIZE / h)), SMALL_THUMBNAIL_SIZE
 
-    resize_size = resize_to_target_size()
+    def get_name(size: tuple[int, int]) -> str:
+        return "small/" + get_thumbnail_name(f"small:{size}:{image.url}", ".jpg")
 
-    thumbnail_name = "small/" + (
-        sha256_str(f"small:{resize_size}:{image.url}")[:24] + ".jpg"
-    )
-    result = ThumbnailResult(
-        thumbnail_name, width=resize_size[0], height=resize_size[1]
-    )
+    levels = get_resize_ladder(resize_to_target_size(), image.size)
+    return schedule_ladder(image, levels, get_name, jobs, quality=60)
 
-    if reuse_thumbnail(thumbnail_name):
-        return result
 
-    img = image.load()
-    img = cv2.resize(img, resize_size, interpolation=cv2.INTER_AREA)
-    buffer = encode_jpeg(img, quality=60)
+def process_model(
+    model_id: ModelId,
+    model: Model,
+    images: dict[str, ImageMetadata],
+    jobs: ImageJobs,
+    centers: dict[tuple[str, str], tuple[float, float]],
+) -> Optional[ManifestEntry]:
+    """
+    Adds the thumbnails of the model to `jobs` and saves the model. Paired thumbnails
+    are cropped around their center in `centers`, see `find_paired_centers`.
 
-    if (
-        image.size == resize_size
-        and image.ext == "jpg"
-        and image.file.stat().st_size < len(buffer)
-    ):
-        # just use the original
-        buffer = image.file.read_bytes()
-
-    save_thumbnail(thumbnail_name, buffer)
-    return result
+    Returns the manifest entry of the model, or `None` if some images couldn't be
+    loaded, so they are retried next time.
+    """
 
-
-def process_model(model_id: ModelId, model: Model, images: dict[str, ImageMetadata]):
     if len(model["images"]) == 0:
-        return
+        return None
 
     print(f"Processing {model_id}", flush=True)
 
+    outputs: dict[str, list[str]] = {}
+
+    def produced(url: str, ladder: Ladder) -> list[ThumbnailLevel]:
+        levels: list[ThumbnailLevel] = []
+        for density, result in ladder:
+            outputs.setdefault(url, []).extend([result.name] + result.variants)
+            levels.append(
+                {
+                    "url": "/thumbs/" + result.name,
+                    "density": density,
+                    "width": result.width,
+                    "height": result.height,
+                }
+            )
+        return levels
+
     # thumbnail
     image = model["images"][0]
     if image["type"] == "paired":
@@ -558,61 +1753,527 @@ def process_model(model_id: ModelId, model: Model, images: dict[str, ImageMetada
             lr, sr = images[lr_url], images[sr_url]
             # LR-SR pairs sometimes don't follow the scale factor, so it's better to calculate a scale for the pair instead of using the model scale.
             scale = round(sr.width / lr.width)
+            center = centers.get((lr_url, sr_url))
 
             if lr.size == sr.size:
-                lr_result = save_thumbnail_sr(lr, scale)
-                sr_result = save_thumbnail_sr(sr, scale)
+                lr_ladder = save_thumbnail_sr(lr, scale, jobs, center)
             else:
-                lr_result = save_thumbnail_lr(lr, scale)
-                sr_result = save_thumbnail_sr(sr, scale)
-
-            thumb["LR"] = "/thumbs/" + lr_result.name
-            thumb["SR"] = "/thumbs/" + sr_result.name
-            thumb["LRSize"] = {"width": lr_result.width, "height": lr_result.height}
-            thumb["SRSize"] = {"width": sr_result.width, "height": sr_result.height}
+                lr_ladder = save_thumbnail_lr(lr, scale, jobs, center)
+            lr_levels = produced(lr_url, lr_ladder)
+            sr_levels = produced(sr_url, save_thumbnail_sr(sr, scale, jobs, center))
+
+            # the largest crops, which cover the card at any DPR
+            lr_top, sr_top = lr_levels[-1], sr_levels[-1]
+            thumb["LR"] = lr_top["url"]
+            thumb["SR"] = sr_top["url"]
+            thumb["LRSize"] = {"width": lr_top["width"], "height": lr_top["height"]}
+            thumb["SRSize"] = {"width": sr_top["width"], "height": sr_top["height"]}
+            thumb["LRSrcSet"] = lr_levels
+            thumb["SRSrcSet"] = sr_levels
     elif image["type"] == "standalone":
         url = image["url"]
+        standalone: StandaloneThumbnail = {"type": "standalone", "url": url}
         if url in images:
-            url = "/thumbs/" + save_thumbnail_standalone(images[url]).name
+            levels = produced(url, save_thumbnail_standalone(images[url], jobs))
+            standalone["url"] = levels[0]["url"]
+            standalone["srcSet"] = levels
 
-        model["thumbnail"] = {"type": "standalone", "url": url}
+        model["thumbnail"] = standalone
 
     # small thumbnails
     for image in model["images"]:
-        if image["type"] == "paired":
-            lr_url = image["LR"]
-            if lr_url in images:
-                lr = images[lr_url]
-                image["thumbnail"] = "/thumbs/" + save_small_thumbnail(lr).name
-        elif image["type"] == "standalone":
-            url = image["url"]
-            if url in images:
-                image["thumbnail"] = "/thumbs/" + save_small_thumbnail(images[url]).name
+        url = image["LR"] if image["type"] == "paired" else image["url"]
+        if url in images:
+            levels = produced(url, save_small_thumbnail(images[url], jobs))
+            image["thumbnail"] = levels[0]["url"]
+            image["thumbnailSrcSet"] = levels
+
+    save_model(model_id, model)
+
+    if any(url not in images for url in get_image_urls(model)):
+        return None
+    entry: ManifestEntry = {
+        "input": get_model_input_hash(model),
+        "imageThumbnails": [image.get("thumbnail") for image in model["images"]],
+        "imageThumbnailSrcSets": [
+            image.get("thumbnailSrcSet") for image in model["images"]
+        ],
+        "outputs": outputs,
+    }
+    thumbnail = model.get("thumbnail")
+    if thumbnail is not None:
+        entry["thumbnail"] = thumbnail
+    return entry
+
+
+def remove_thumbnails(model: Model, urls: set[str]):
+    """
+    Removes the thumbnails generated from the given image URLs from the model, e.g.
+    because the images couldn't be downloaded. The thumbnail of the model is left as
+    `process_model` leaves it for images that couldn't be loaded.
+    """
 
-    model_file = MODEL_FILES_DIR / f"{model_id}.json"
-    model_file.write_text(json.dumps(model, indent=4), encoding="utf-8")
+    if len(model["images"]) == 0:
+        return
+
+    image = model["images"][0]
+    if image["type"] == "paired":
+        if image["LR"] in urls or image["SR"] in urls:
+            model["thumbnail"] = {
+                "type": "paired",
+                "LR": image["LR"],
+                "SR": image["SR"],
+            }
+    elif image["type"] == "standalone":
+        if image["url"] in urls:
+            model["thumbnail"] = {"type": "standalone", "url": image["url"]}
+
+    for image in model["images"]:
+        url = image["LR"] if image["type"] == "paired" else image["url"]
+        if url in urls:
+            image.pop("thumbnail", None)
+            image.pop("thumbnailSrcSet", None)
+
+
+def is_up_to_date(model: Model, entry: Optional[ManifestEntry]) -> bool:
+    """
+    Returns whether the manifest entry still describes the thumbnails of the model
+    and all of its thumbnails are available.
+    """
+
+    if entry is None or entry["input"] != get_model_input_hash(model):
+        return False
+    return all(
+        reuse_thumbnail(name) for names in entry["outputs"].values() for name in names
+    )
+
+
+def get_referenced_thumbnails(models: dict[ModelId, Model]) -> set[str]:
+    """Returns the names of all thumbnails the given (processed) models use."""
+
+    names: set[str] = set()
+
+    def add(url: str):
+        if url.startswith("/thumbs/"):
+            names.add(url[len("/thumbs/") :])
+
+    def add_sources(sources: list[ThumbnailSource]):
+        for source in sources:
+            add(source["url"])
+
+    def add_levels(levels: list[ThumbnailLevel]):
+        for level in levels:
+            add(level["url"])
+            add_sources(level.get("sources", []))
+
+    for model in models.values():
+        thumbnail = model.get("thumbnail")
+        if thumbnail is not None:
+            if thumbnail["type"] == "paired":
+                add(thumbnail["LR"])
+                add(thumbnail["SR"])
+                add_sources(thumbnail.get("LRSources", []))
+                add_sources(thumbnail.get("SRSources", []))
+                add_levels(thumbnail.get("LRSrcSet", []))
+                add_levels(thumbnail.get("SRSrcSet", []))
+            elif thumbnail["type"] == "standalone":
+                add(thumbnail["url"])
+                add_sources(thumbnail.get("sources", []))
+                add_levels(thumbnail.get("srcSet", []))
+        for image in model["images"]:
+            if "thumbnail" in image:
+                add(image["thumbnail"])
+            add_levels(image.get("thumbnailSrcSet", []))
+    return names
+
+
+def collect_garbage(
+    models: dict[ModelId, Model], manifest: dict[ModelId, ManifestEntry]
+):
+    """
+    Removes all thumbnails that none of the given models use from THUMBNAIL_DIR and the
+    cache, and all stored thumbnails that are no longer linked.
+
+    Thumbnails in the outputs of the manifest are kept too, even variants that aren't
+    served because they are larger than their thumbnail. Otherwise the models would no
+    longer be up to date and their variants would be generated again by the next run.
+    """
+
+    print("Collecting garbage", flush=True)
+
+    referenced = get_referenced_thumbnails(models)
+    for entry in manifest.values():
+        for names in entry["outputs"].values():
+            referenced.update(names)
+    removed = 0
+    for directory in (THUMBNAIL_DIR, CACHE_THUMBNAIL_DIR):
+        for file in list(directory.glob("**/*")):
+            name = file.relative_to(directory).as_posix()
+            if (
+                file.is_file()
+                and not file.name.startswith("_")
+                and name not in referenced
+            ):
+                file.unlink()
+                removed += 1
+    objects, size = thumbnail_store.gc()
+
+    metrics.counters.add("gc removed thumbnails", removed)
+    metrics.counters.add("gc removed objects", objects)
+    print(
+        f"Removed {removed} thumbnails and {objects} stored thumbnails ({size} bytes)"
+    )
+
+
+class DuplicateImage(TypedDict):
+    url: str
+    models: list[ModelId]
+
+
+class NearDuplicate(TypedDict):
+    distance: int
+    a: DuplicateImage
+    b: DuplicateImage
 
 
-def process():
+def get_perceptual_hashes(models: dict[ModelId, Model]) -> dict[str, int]:
+    """
+    Returns the perceptual hash of every image with a small thumbnail by URL. Hashes
+    are computed from the small thumbnails, so no image is downloaded or decoded, and
+    kept in the image index.
+    """
+
+    thumbnails: dict[str, str] = {}
+    for model in models.values():
+        for image in model["images"]:
+            url = image["LR"] if image["type"] == "paired" else image["url"]
+            thumbnail = image.get("thumbnail")
+            if thumbnail is not None:
+                thumbnails[url] = thumbnail
+
+    index = get_image_index()
+    known = index.get_hashes(thumbnails)
+    hashes = {
+        url: known[url][1]
+        for url, thumbnail in thumbnails.items()
+        if url in known and known[url][0] == thumbnail
+    }
+    new: dict[str, tuple[str, int]] = {}
+    for url, thumbnail in thumbnails.items():
+        if url in hashes:
+            continue
+        file = THUMBNAIL_DIR / thumbnail.removeprefix("/thumbs/")
+        img = cv2.imread(str(file), cv2.IMREAD_GRAYSCALE)
+        if img is not None:
+            hashes[url] = dhash(img)
+            new[url] = thumbnail, hashes[url]
+    index.put_hashes(new)
+    metrics.counters.add("perceptual hashes", len(new))
+    return hashes
+
+
+def find_near_duplicates(models: dict[ModelId, Model]) -> list[NearDuplicate]:
+    """Returns the pairs of similar images at different URLs used by different models."""
+
+    hashes = get_perceptual_hashes(models)
+    users: dict[str, list[ModelId]] = {}
+    for model_id, model in models.items():
+        for url in dict.fromkeys(get_image_urls(model)):
+            users.setdefault(url, []).append(model_id)
+
+    tree: BKTree[str] = BKTree()
+    for url, h in hashes.items():
+        tree.add(h, url)
+
+    duplicates: list[NearDuplicate] = []
+    for url, h in hashes.items():
+        for distance, other in tree.find(h, NEAR_DUPLICATE_DISTANCE):
+            # each pair once, and images within a model are fine
+            if other <= url or set(users[url]) == set(users[other]):
+                continue
+            duplicates.append(
+                {
+                    "distance": distance,
+                    "a": {"url": url, "models": users[url]},
+                    "b": {"url": other, "models": users[other]},
+                }
+            )
+    duplicates.sort(key=lambda d: (d["distance"], d["a"]["url"], d["b"]["url"]))
+    return duplicates
+
+
+def get_model_cost(model_id: ModelId, model: Model) -> float:
+    """
+    The seconds spent on the model: planning its thumbnails and generating them from
+    each of its images, without time spent waiting for a worker.
+    """
+
+    def work(times: StageTimes) -> float:
+        return times.total() - times.get("queue wait")["seconds"]
+
+    images = metrics.items("images")
+    seconds = work(metrics.item("models", model_id))
+    for url in set(get_image_urls(model)):
+        if url in images:
+            seconds += work(images[url])
+    return seconds
+
+
+def summarize_quality() -> Optional[dict[str, Any]]:
+    """
+    Summarizes the quality of the verified thumbnails of this run, with the thumbnails
+    that are less similar to their pixels than VERIFY_MIN_SSIM as outliers.
+    """
+
+    records = metrics.records("quality")
+    if not records:
+        return None
+    names = list(records)
+    scores = np.array(
+        [[records[n]["ssim"], records[n]["psnr"], records[n]["bytes"]] for n in names]
+    )
+    ssims, psnrs = scores[:, 0], scores[:, 1]
+    outliers = [names[i] for i in np.argsort(ssims) if ssims[i] < VERIFY_MIN_SSIM]
+    return {
+        "count": len(names),
+        "bytes": int(scores[:, 2].sum()),
+        "ssim": {"mean": float(ssims.mean()), "min": float(ssims.min())},
+        "psnr": {"mean": float(psnrs.mean()), "min": float(psnrs.min())},
+        "outliers": [{"name": name, **records[name]} for name in outliers],
+    }
+
+
+def report_metrics(models: dict[ModelId, Model], duration: float, file: Path):
+    """Prints a summary of the metrics of this run and saves all of them to `file`."""
+
+    slowest = sorted(
+        (
+            (model_id, get_model_cost(model_id, model))
+            for model_id, model in models.items()
+        ),
+        key=lambda x: x[1],
+        reverse=True,
+    )[:SLOWEST_MODELS]
+    slowest = [(model_id, seconds) for model_id, seconds in slowest if seconds > 0]
+
+    print("Stages:")
+    for stage, total in metrics.stages.as_dict().items():
+        print(f"  {stage}: {total['seconds']:.2f}s ({total['count']}x)")
+    print("Counters:")
+    for name, count in metrics.counters.as_dict().items():
+        print(f"  {name}: {count}")
+    if slowest:
+        print("Slowest models:")
+        for model_id, seconds in slowest:
+            print(f"  {model_id}: {seconds:.2f}s")
+    quality = summarize_quality()
+    if quality is not None:
+        ssims, psnrs = quality["ssim"], quality["psnr"]
+        print(f"Quality of {quality['count']} thumbnails ({quality['bytes']} bytes):")
+        print(f"  SSIM: {ssims['mean']:.4f} mean, {ssims['min']:.4f} min")
+        print(f"  PSNR: {psnrs['mean']:.2f} dB mean, {psnrs['min']:.2f} dB min")
+        for outlier in quality["outliers"][:SLOWEST_MODELS]:
+            print(f"  Outlier {outlier['name']}: SSIM {outlier['ssim']:.4f}")
+
+    report = {
+        "seconds": duration,
+        **metrics.as_dict(),
+        "slowestModels": [{"id": k, "seconds": v} for k, v in slowest],
+        "quality": quality,
+    }
+    file.parent.mkdir(parents=True, exist_ok=True)
+    file.write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+
+def process(
+    force: bool = False,
+    download_workers: int = 16,
+    encode_workers: int = os.cpu_count() or 1,
+    metrics_file: Path = METRICS_JSON,
+    gc: bool = False,
+    verify: bool = False,
+) -> Metrics:
+    """
+    Generates the thumbnails of all models and returns the metrics of this run. With
+    `verify`, the quality of all generated thumbnails is measured and reported.
+    """
+
+    global metrics
+    metrics = Metrics()
+    downloader.counters = metrics.counters
+    times = metrics.stages
+
     start = time.time()
 
-    restore_cache()
+    with times.measure("restore cache"):
+        restore_cache()
 
     models = get_current_models()
-    images = get_images(models)
-    save_cached_image_metadata(images)
+    manifest: dict[ModelId, ManifestEntry] = {} if force else load_manifest()
+
+    # models whose thumbnails are already known only need their thumbnail properties
+    changed: dict[ModelId, Model] = {}
+    unchanged_urls: set[str] = set()
+    with times.measure("manifest"):
+        for model_id, model in models.items():
+            entry = manifest.get(model_id)
+            if entry is not None and is_up_to_date(model, entry):
+                apply_manifest_entry(model, entry)
+                save_model(model_id, model)
+                unchanged_urls.update(get_image_urls(model))
+            else:
+                changed[model_id] = model
+    print(f"Skipping {len(models) - len(changed)} unchanged models", flush=True)
+
+    with times.measure("probe"):
+        images = get_images(changed, download_workers)
+        save_cached_image_metadata(images, unchanged_urls)
+
+    # the crops of paired thumbnails depend on the content of their LR image
+    with times.measure("saliency"):
+        centers = find_paired_centers(changed, images, download_workers)
+
+    jobs = ImageJobs()
 
     def apply(item: tuple[ModelId, Model]):
         model_id, model = item
-        process_model(model_id, model, images)
+        with metrics.item("models", model_id).measure("plan"):
+            return model_id, process_model(model_id, model, images, jobs, centers)
 
-    with ThreadPool(16) as pool:
-        pool.map(apply, models.items())
+    with times.measure("plan"), ThreadPool(download_workers) as pool:
+        for model_id, entry in pool.map(apply, changed.items()):
+            if entry is not None:
+                manifest[model_id] = entry
+            else:
+                manifest.pop(model_id, None)
+
+    # download all source images before the CPU-heavy work starts
+    image_jobs = jobs.values()
+    with times.measure("download"):
+        errors = downloader.prefetch(
+            {job.image.url: job.image.file for job in image_jobs}, download_workers
+        )
+    for url, error in errors.items():
+        print(f"Failed to download {url}: {error}")
+    metrics.counters.add("failed downloads", len(errors))
+    image_jobs = [job for job in image_jobs if job.image.url not in errors]
+    # the models don't get the thumbnails of these images and are retried next time
+    failed = set(errors)
+    for model_id, model in changed.items():
+        if failed.intersection(get_image_urls(model)):
+            remove_thumbnails(model, failed)
+            manifest.pop(model_id, None)
+
+    with times.measure("store"):
+        image_jobs = link_stored_thumbnails(image_jobs, download_workers)
+    for job in image_jobs:
+        job.verify = verify
+
+    # each image is only decoded once, no matter how many thumbnails use it
+    with times.measure("images"):
+        run_image_jobs(image_jobs, encode_workers)
+
+    # which variants are worth serving is only known once they are generated. The
+    # manifest entries share the thumbnail objects of the models.
+    for model_id, model in changed.items():
+        add_thumbnail_sources(model)
+        save_model(model_id, model)
+
+    # copied or re-uploaded comparison images
+    with times.measure("duplicates"):
+        duplicates = find_near_duplicates(models)
+    DUPLICATES_JSON.parent.mkdir(parents=True, exist_ok=True)
+    DUPLICATES_JSON.write_text(json.dumps(duplicates, indent=2), encoding="utf-8")
+    if duplicates:
+        print(f"Found {len(duplicates)} near-duplicate images, see {DUPLICATES_JSON}")
+
+    # forget models that were deleted
+    manifest = {k: v for k, v in manifest.items() if k in models}
+    save_manifest(manifest)
 
     duration = time.time() - start
     print(f"Finished thumbnails in {duration:.2f} seconds")
 
-    update_cache()
+    with times.measure("update cache"):
+        update_cache()
+
+    if gc:
+        with times.measure("gc"):
+            collect_garbage(models, manifest)
 
+    report_metrics(changed, duration, metrics_file)
 
-process()
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Generate thumbnails for all models and add them to the model files."
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Ignore the manifest and process all models.",
+    )
+    parser.add_argument(
+        "--download-workers",
+        type=int,
+        default=16,
+        help="The number of parallel downloads.",
+    )
+    parser.add_argument(
+        "--downloads-per-host",
+        type=int,
+        default=8,
+        help="The maximum number of parallel downloads from the same host.",
+    )
+    parser.add_argument(
+        "--encode-workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="The number of processes decoding and encoding images. Defaults to the number of CPUs.",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=Path,
+        default=METRICS_JSON,
+        help=f"Where to save the timings and counters of the run. Defaults to {METRICS_JSON}.",
+    )
+    parser.add_argument(
+        "--densities",
+        type=lambda s: tuple(float(d) for d in s.split(",")),
+        default=THUMBNAIL_DENSITIES,
+        help="The comma-separated pixel densities thumbnails are generated for. Defaults to "
+        + ",".join(f"{d:g}" for d in THUMBNAIL_DENSITIES)
+        + ".",
+    )
+    parser.add_argument(
+        "--gc",
+        action="store_true",
+        help="Remove all thumbnails that no model uses from the output and the cache.",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Measure the PSNR and SSIM of generated thumbnails and report outliers.",
+    )
+    parser.add_argument(
+        "--target-ssim",
+        type=float,
+        help="Lower the quality of each JPEG thumbnail as long as its SSIM stays above this, e.g. 0.98.",
+    )
+    args = parser.parse_args()
+
+    downloader = Downloader(per_host=args.downloads_per_host)
+    THUMBNAIL_DENSITIES = args.densities
+    JPEG_TARGET_SSIM = args.target_ssim
+    run_metrics = process(
+        force=args.force,
+        download_workers=args.download_workers,
+        encode_workers=args.encode_workers,
+        metrics_file=args.metrics,
+        gc=args.gc,
+        verify=args.verify,
+    )
+    if run_metrics.counters.get("failed downloads"):
+        sys.exit(1)
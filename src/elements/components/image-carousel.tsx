@@ -11,6 +11,7 @@ import {
 import { FiMoreHorizontal } from 'react-icons/fi';
 import { useWindowSize } from '../../lib/hooks/use-window-size';
 import { Image } from '../../lib/schema';
+import { getSrcSet } from '../../lib/thumbnail-util';
 import { joinClasses } from '../../lib/util';
 import { CarouselChromeProvider } from './carousel/chrome-context';
 import { FullscreenButton } from './carousel/viewer-chrome';
@@ -206,6 +207,10 @@ export const ImageCarousel = ({ images, readonly, indexKey, onChange }: ImageCar
                                                                     image.thumbnail ||
                                                                     (image.type === 'paired' ? image.LR : image.url)
                                                                 }
+                                                                srcSet={
+                                                                    image.thumbnailSrcSet &&
+                                                                    getSrcSet(image.thumbnailSrcSet)
+                                                                }
                                                                 title={image.caption}
                                                             />
                                                         </div>
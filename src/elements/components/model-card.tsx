@@ -9,8 +9,17 @@ import { useUpdateModel } from '../../lib/hooks/use-update-model';
 import { useUsers } from '../../lib/hooks/use-users';
 import { useWebApi } from '../../lib/hooks/use-web-api';
 import { joinList } from '../../lib/react-util';
-import { Collection, CollectionId, ImageSize, Model, ModelId, PairedThumbnail } from '../../lib/schema';
+import {
+    Collection,
+    CollectionId,
+    ImageSize,
+    Model,
+    ModelId,
+    PairedThumbnail,
+    ThumbnailSource,
+} from '../../lib/schema';
 import { getTextDescription } from '../../lib/text-description';
+import { getPairedDensity, getSourceSrcSets, getSrcSet, pickLevel } from '../../lib/thumbnail-util';
 import { asArray, assertNever, joinClasses } from '../../lib/util';
 import { ClampedTags } from './clamped-tags';
 import { EditableTags } from './editable-tags';
@@ -40,9 +49,31 @@ function getNaturalSize(image: HTMLImageElement): ImageSize {
     };
 }
 
+const Sources = ({ sources }: { sources: readonly ThumbnailSource[] | undefined }) => {
+    return (
+        <>
+            {sources?.map((source) => (
+                <source
+                    key={source.url}
+                    srcSet={source.url}
+                    type={source.type}
+                />
+            ))}
+        </>
+    );
+};
+
 const SideBySideImage = ({ model, image }: { model: Model; image: PairedThumbnail }) => {
-    const [lrDimensions, setLrDimensions] = useState(image.LRSize ?? EMPTY_SIZE);
-    const [srDimensions, setSrDimensions] = useState(image.SRSize ?? EMPTY_SIZE);
+    const dpr = useDevicePixelRatio();
+
+    // Pick the smallest crops that still fill the card at this DPR. LR and SR must have the same density.
+    const lrLevel = pickLevel(image.LRSrcSet ?? [], getPairedDensity(dpr));
+    const srLevel = lrLevel && pickLevel(image.SRSrcSet ?? [], lrLevel.density);
+    const lr = lrLevel && srLevel ? lrLevel : { url: image.LR, sources: image.LRSources };
+    const sr = lrLevel && srLevel ? srLevel : { url: image.SR, sources: image.SRSources };
+
+    const [lrDimensions, setLrDimensions] = useState<ImageSize>(lrLevel ?? image.LRSize ?? EMPTY_SIZE);
+    const [srDimensions, setSrDimensions] = useState<ImageSize>(srLevel ?? image.SRSize ?? EMPTY_SIZE);
 
     const maxHeight = Math.max(lrDimensions.height, srDimensions.height);
     const maxWidth = Math.max(lrDimensions.width, srDimensions.width);
@@ -50,7 +81,6 @@ const SideBySideImage = ({ model, image }: { model: Model; image: PairedThumbnai
     const lrRef = useRef<HTMLImageElement>(null);
     const srRef = useRef<HTMLImageElement>(null);
 
-    const dpr = useDevicePixelRatio();
     // The goal of this scale is to ensure that the image is rendered as an integer scale (e.g. 100%, 200%, 300%).
     // This is necessary to prevent scaling artifacts. Such artifacts are especially noticeable for 1x models.
     // Here is how the scale is calculated:
@@ -68,38 +98,44 @@ const SideBySideImage = ({ model, image }: { model: Model; image: PairedThumbnai
                 className="absolute top-0 left-1/2 z-10 h-full w-px -translate-x-1/2 bg-white/40 mix-blend-overlay"
             />
             <div className="relative flex h-full w-1/2 content-center overflow-hidden align-middle">
-                <img
-                    alt={model.name}
-                    className="rendering-pixelated absolute top-1/3 left-1/2 z-0 m-auto object-cover object-center"
-                    loading="lazy"
-                    ref={lrRef}
-                    src={image.LR}
-                    style={{
-                        height: `${maxHeight}px`,
-                        width: `${maxWidth}px`,
-                        transform: `translate(-50%, -50%) scale(${scale})`,
-                    }}
-                    onLoad={(e) => {
-                        setLrDimensions(getNaturalSize(e.target as HTMLImageElement));
-                    }}
-                />
+                <picture className="contents">
+                    <Sources sources={lr.sources} />
+                    <img
+                        alt={model.name}
+                        className="rendering-pixelated absolute top-1/3 left-1/2 z-0 m-auto object-cover object-center"
+                        loading="lazy"
+                        ref={lrRef}
+                        src={lr.url}
+                        style={{
+                            height: `${maxHeight}px`,
+                            width: `${maxWidth}px`,
+                            transform: `translate(-50%, -50%) scale(${scale})`,
+                        }}
+                        onLoad={(e) => {
+                            setLrDimensions(getNaturalSize(e.target as HTMLImageElement));
+                        }}
+                    />
+                </picture>
             </div>
             <div className="relative flex h-full w-1/2 content-center overflow-hidden align-middle">
-                <img
-                    alt={model.name}
-                    className="rendering-pixelated absolute top-1/3 left-1/2 z-0 m-auto object-cover object-center"
-                    loading="lazy"
-                    ref={srRef}
-                    src={image.SR}
-                    style={{
-                        height: `${maxHeight}px`,
-                        width: `${maxWidth}px`,
-                        transform: `translate(-50%, -50%) scale(${scale})`,
-                    }}
-                    onLoad={(e) => {
-                        setSrDimensions(getNaturalSize(e.target as HTMLImageElement));
-                    }}
-                />
+                <picture className="contents">
+                    <Sources sources={sr.sources} />
+                    <img
+                        alt={model.name}
+                        className="rendering-pixelated absolute top-1/3 left-1/2 z-0 m-auto object-cover object-center"
+                        loading="lazy"
+                        ref={srRef}
+                        src={sr.url}
+                        style={{
+                            height: `${maxHeight}px`,
+                            width: `${maxWidth}px`,
+                            transform: `translate(-50%, -50%) scale(${scale})`,
+                        }}
+                        onLoad={(e) => {
+                            setSrDimensions(getNaturalSize(e.target as HTMLImageElement));
+                        }}
+                    />
+                </picture>
             </div>
         </div>
     );
@@ -123,13 +159,28 @@ const getModelCardImageComponent = (model: Model | undefined) => {
         }
         case 'standalone': {
             const imageSrc = image.url;
+            const levels = 'srcSet' in image ? image.srcSet : undefined;
             return (
-                <img
-                    alt={model.name}
-                    className="z-0 h-full w-full object-cover"
-                    loading="lazy"
-                    src={imageSrc}
-                />
+                <picture className="contents">
+                    {levels ? (
+                        getSourceSrcSets(levels).map(({ type, srcSet }) => (
+                            <source
+                                key={type}
+                                srcSet={srcSet}
+                                type={type}
+                            />
+                        ))
+                    ) : (
+                        <Sources sources={'sources' in image ? image.sources : undefined} />
+                    )}
+                    <img
+                        alt={model.name}
+                        className="z-0 h-full w-full object-cover"
+                        loading="lazy"
+                        src={imageSrc}
+                        srcSet={levels && getSrcSet(levels)}
+                    />
+                </picture>
             );
         }
         default:
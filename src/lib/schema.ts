@@ -75,6 +75,7 @@ export interface PairedImage {
     LR: string;
     SR: string;
     thumbnail?: string;
+    thumbnailSrcSet?: ThumbnailLevel[];
 }
 
 export interface StandaloneImage {
@@ -82,6 +83,7 @@ export interface StandaloneImage {
     caption?: string;
     url: string;
     thumbnail?: string;
+    thumbnailSrcSet?: ThumbnailLevel[];
 }
 
 export type Thumbnail = PairedThumbnail | StandaloneThumbnail;
@@ -91,10 +93,38 @@ export interface PairedThumbnail {
     SR: string;
     LRSize?: ImageSize;
     SRSize?: ImageSize;
+    LRSources?: ThumbnailSource[];
+    SRSources?: ThumbnailSource[];
+    LRSrcSet?: ThumbnailLevel[];
+    SRSrcSet?: ThumbnailLevel[];
 }
 export interface StandaloneThumbnail {
     type: 'standalone';
     url: string;
+    sources?: ThumbnailSource[];
+    srcSet?: ThumbnailLevel[];
+}
+/**
+ * A thumbnail generated for one pixel density, from low to high density.
+ */
+export interface ThumbnailLevel {
+    url: string;
+    /** The device pixels per CSS pixel this level is meant for. */
+    density: number;
+    width: number;
+    height: number;
+    sources?: ThumbnailSource[];
+}
+/**
+ * A smaller version of a thumbnail in a modern image format, in order of preference.
+ * Browsers that don't support the format use the thumbnail itself.
+ */
+export interface ThumbnailSource {
+    url: string;
+    /** The MIME type of the image, e.g. `image/avif`. */
+    type: string;
+    /** The size of the file in bytes. */
+    size: number;
 }
 
 export interface ImageSize {
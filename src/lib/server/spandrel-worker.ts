@@ -0,0 +1,179 @@
+import { ChildProcessWithoutNullStreams, spawn } from 'child_process';
+import { createInterface } from 'readline';
+
+export interface Metadata {
+    architecture: string;
+    tags: string[];
+    scale: number;
+    inputChannels: number;
+    outputChannels: number;
+    /** Whether the model was detected from tensor shapes alone or by fully loading it. */
+    detection?: 'header' | 'full';
+}
+
+/** A model file that spandrel could not make sense of, as opposed to a broken worker. */
+export class SpandrelError extends Error {
+    constructor(message: string) {
+        super(message);
+        this.name = 'SpandrelError';
+    }
+}
+
+type WorkerResponse =
+    | { id: number; status: 'ok'; data: Metadata }
+    | { id: number | null; status: 'error'; error: string };
+
+interface Request {
+    file: string;
+    attempts: number;
+    resolve: (metadata: Metadata) => void;
+    reject: (error: Error) => void;
+}
+interface PendingRequest extends Request {
+    worker: ChildProcessWithoutNullStreams;
+}
+
+export interface SpandrelWorkerOptions {
+    /** The maximum number of models the worker loads at the same time. */
+    concurrency?: number;
+    /** The worker is replaced by a fresh process after this many requests. 0 means never. */
+    maxRequests?: number;
+    /** How often a request is resent after its worker died before giving up. */
+    maxAttempts?: number;
+}
+
+/**
+ * A long-lived `invoke-spandrel.py --server` process.
+ *
+ * Starting Python and importing spandrel and PyTorch takes seconds, so the worker is
+ * started once and reused for all requests. After `maxRequests` requests, new requests
+ * go to a fresh worker while the old one finishes its requests and exits. If a worker
+ * crashes, all of its requests without a response are sent to a new worker.
+ */
+export class SpandrelWorker {
+    private process: ChildProcessWithoutNullStreams | undefined;
+    private sentToProcess = 0;
+    private nextId = 0;
+    private readonly pending = new Map<number, PendingRequest>();
+    private readonly concurrency: number;
+    private readonly maxRequests: number;
+    private readonly maxAttempts: number;
+
+    constructor({ concurrency = 2, maxRequests = 100, maxAttempts = 2 }: Readonly<SpandrelWorkerOptions> = {}) {
+        this.concurrency = concurrency;
+        this.maxRequests = maxRequests;
+        this.maxAttempts = maxAttempts;
+    }
+
+    getMetadata(file: string): Promise<Metadata> {
+        return new Promise((resolve, reject) => {
+            this.send({ file, attempts: 0, resolve, reject });
+        });
+    }
+
+    private send(request: Request): void {
+        request.attempts++;
+        if (request.attempts > this.maxAttempts) {
+            request.reject(new Error(`The spandrel worker exited while processing ${request.file}`));
+            return;
+        }
+
+        const worker = this.getProcess();
+        const id = this.nextId++;
+        this.pending.set(id, { ...request, worker });
+        worker.stdin.write(`${JSON.stringify({ id, file: request.file })}\n`);
+
+        this.sentToProcess++;
+        if (this.maxRequests > 0 && this.sentToProcess >= this.maxRequests) {
+            // the worker exits on its own after answering these requests
+            this.process = undefined;
+        }
+    }
+
+    private getProcess(): ChildProcessWithoutNullStreams {
+        if (this.process) return this.process;
+
+        const child = spawn('python', [
+            'invoke-spandrel.py',
+            '--server',
+            '--concurrency',
+            String(this.concurrency),
+            '--max-requests',
+            String(this.maxRequests),
+        ]);
+        this.process = child;
+        this.sentToProcess = 0;
+
+        createInterface({ input: child.stdout }).on('line', (line) => this.onLine(line));
+        child.stderr.on('data', (data: Buffer) => {
+            process.stderr.write(data);
+        });
+        child.stdin.on('error', () => {
+            // the worker exited, which is handled below
+        });
+
+        let exited = false;
+        const onExit = (reason: string) => {
+            if (exited) return;
+            exited = true;
+            if (this.process === child) {
+                this.process = undefined;
+            }
+
+            // resend all requests that this worker didn't answer
+            const unanswered: Request[] = [];
+            for (const [id, request] of this.pending) {
+                if (request.worker === child) {
+                    this.pending.delete(id);
+                    unanswered.push(request);
+                }
+            }
+            if (unanswered.length > 0) {
+                console.warn(`Spandrel worker ${reason}. Resending ${unanswered.length} request(s).`);
+            }
+            for (const request of unanswered) {
+                this.send(request);
+            }
+        };
+        child.on('exit', (code) => onExit(`exited with code ${String(code)}`));
+        child.on('error', (err) => onExit(`failed: ${String(err)}`));
+
+        return child;
+    }
+
+    private onLine(line: string): void {
+        if (!line.startsWith('{')) return;
+
+        let response;
+        try {
+            response = JSON.parse(line) as WorkerResponse;
+        } catch {
+            console.warn(`Invalid response from spandrel worker: ${line}`);
+            return;
+        }
+
+        if (response.id === null) {
+            console.warn(`Spandrel worker error: ${response.error}`);
+            return;
+        }
+        const request = this.pending.get(response.id);
+        if (!request) return;
+        this.pending.delete(response.id);
+
+        if (response.status === 'ok') {
+            request.resolve(response.data);
+        } else {
+            request.reject(new SpandrelError(response.error));
+        }
+    }
+}
+
+let sharedWorker: SpandrelWorker | undefined;
+
+/**
+ * Returns the spandrel worker shared by all API routes.
+ */
+export function getSpandrelWorker(): SpandrelWorker {
+    sharedWorker ??= new SpandrelWorker();
+    return sharedWorker;
+}
@@ -0,0 +1,48 @@
+import { ThumbnailLevel, ThumbnailSource } from './schema';
+
+/**
+ * Returns the `srcset` attribute for the given levels with density descriptors.
+ */
+export const getSrcSet = (levels: readonly ThumbnailLevel[]): string => {
+    return levels.map((level) => `${level.url} ${level.density}x`).join(', ');
+};
+
+/**
+ * Returns the `srcset` attributes of the variants in other formats for the given levels, in order of preference.
+ *
+ * A format is only included if every level has a variant in it. Otherwise, browsers supporting the format might pick
+ * a level of the wrong density.
+ */
+export const getSourceSrcSets = (levels: readonly ThumbnailLevel[]): { type: string; srcSet: string }[] => {
+    if (levels.length === 0) return [];
+
+    const types = (levels[0].sources ?? []).map((source) => source.type);
+    return types.flatMap((type) => {
+        const sources: ThumbnailSource[] = [];
+        for (const level of levels) {
+            const source = level.sources?.find((s) => s.type === type);
+            if (!source) return [];
+            sources.push(source);
+        }
+        const srcSet = sources.map((source, i) => `${source.url} ${levels[i].density}x`).join(', ');
+        return [{ type, srcSet }];
+    });
+};
+
+/**
+ * The image pixels per CSS pixel paired thumbnails need to fill their box.
+ *
+ * Paired thumbnails are shown pixelated at an integer number of device pixels per image pixel, but no smaller than
+ * one CSS pixel per image pixel. See `SideBySideImage` in `model-card.tsx`.
+ */
+export const getPairedDensity = (dpr: number): number => {
+    return dpr / Math.max(1, Math.round(dpr + 0.16));
+};
+
+/**
+ * Returns the lowest level with at least the given density, or the highest level if there is none.
+ */
+export const pickLevel = <T extends ThumbnailLevel>(levels: readonly T[], density: number): T | undefined => {
+    // allow for the rounding of densities
+    return levels.find((level) => level.density >= density - 0.01) ?? levels[levels.length - 1];
+};
@@ -33,12 +33,13 @@ export const validateModel = (
         );
     }
 
-    if (model.thumbnail || model.images.some((image) => image.thumbnail)) {
+    if (model.thumbnail || model.images.some((image) => image.thumbnail || image.thumbnailSrcSet)) {
         report(`Thumbnails are automatically generated and should not appear in the database`, async () => {
             const model = await api.models.get(modelId);
             delete model.thumbnail;
             for (const image of model.images) {
                 delete image.thumbnail;
+                delete image.thumbnailSrcSet;
             }
             await api.models.update([[modelId, model]]);
         });
@@ -1,19 +1,10 @@
-import { exec as execCallback } from 'child_process';
 import { mkdir, unlink, writeFile } from 'fs/promises';
 import { NextApiRequest, NextApiResponse } from 'next';
 import path from 'path';
-import { promisify } from 'util';
 import { DATA_DIR } from '../../lib/server/file-data';
+import { Metadata, SpandrelError, getSpandrelWorker } from '../../lib/server/spandrel-worker';
 
-const exec = promisify(execCallback);
-
-export interface Metadata {
-    architecture: string;
-    tags: string[];
-    scale: number;
-    inputChannels: number;
-    outputChannels: number;
-}
+export type { Metadata };
 export type ResponseJson = { status: 'ok'; data: Metadata } | { status: 'error'; error: string };
 
 export default async function handler(req: NextApiRequest, res: NextApiResponse) {
@@ -26,17 +17,13 @@ export default async function handler(req: NextApiRequest, res: NextApiResponse)
 
         let metadata;
         try {
-            const { stdout } = await exec(`python invoke-spandrel.py "${temp}"`);
-            let m = /^SUCCESS:\s*(\{.*\})$/m.exec(stdout);
-            if (m) {
-                metadata = JSON.parse(m[1]) as Metadata;
-            } else if ((m = /^ERROR:\s*(\{.*\})$/m.exec(stdout))) {
-                const details = JSON.parse(m[1]) as { message: string };
-                res.status(500).json({ status: 'error', error: details.message });
+            metadata = await getSpandrelWorker().getMetadata(temp);
+        } catch (err) {
+            if (err instanceof SpandrelError) {
+                res.status(500).json({ status: 'error', error: err.message });
                 return;
-            } else {
-                throw new Error(`Could not parse metadata from stdout:\n${stdout}`);
             }
+            throw err;
         } finally {
             await unlink(temp);
         }
@@ -0,0 +1,68 @@
+import { describe, expect, it } from 'vitest';
+import { ThumbnailLevel } from '../../src/lib/schema';
+import { getPairedDensity, getSourceSrcSets, getSrcSet, pickLevel } from '../../src/lib/thumbnail-util';
+
+const level = (density: number, formats: string[] = []): ThumbnailLevel => ({
+    url: `/thumbs/${density}.jpg`,
+    density,
+    width: Math.round(100 * density),
+    height: Math.round(50 * density),
+    sources: formats.map((format) => ({ url: `/thumbs/${density}.${format}`, type: `image/${format}`, size: 1 })),
+});
+
+describe('getSrcSet', () => {
+    it('lists every level with its density', () => {
+        expect(getSrcSet([level(1), level(1.5)])).toBe('/thumbs/1.jpg 1x, /thumbs/1.5.jpg 1.5x');
+    });
+});
+
+describe('getSourceSrcSets', () => {
+    it('keeps the order of preference of the formats', () => {
+        expect(getSourceSrcSets([level(1, ['avif', 'webp']), level(2, ['avif', 'webp'])])).toEqual([
+            { type: 'image/avif', srcSet: '/thumbs/1.avif 1x, /thumbs/2.avif 2x' },
+            { type: 'image/webp', srcSet: '/thumbs/1.webp 1x, /thumbs/2.webp 2x' },
+        ]);
+    });
+
+    it('skips formats that some levels are missing', () => {
+        expect(getSourceSrcSets([level(1, ['avif', 'webp']), level(2, ['webp'])])).toEqual([
+            { type: 'image/webp', srcSet: '/thumbs/1.webp 1x, /thumbs/2.webp 2x' },
+        ]);
+    });
+
+    it('returns nothing without levels', () => {
+        expect(getSourceSrcSets([])).toEqual([]);
+    });
+});
+
+describe('getPairedDensity', () => {
+    it('needs one image pixel per CSS pixel at integer DPRs', () => {
+        expect(getPairedDensity(1)).toBe(1);
+        expect(getPairedDensity(2)).toBe(1);
+        expect(getPairedDensity(3)).toBe(1);
+    });
+
+    it('needs more image pixels just below the point where the scale rounds up', () => {
+        expect(getPairedDensity(1.25)).toBeCloseTo(1.25);
+        expect(getPairedDensity(1.5)).toBeCloseTo(0.75);
+    });
+});
+
+describe('pickLevel', () => {
+    const levels = [level(1), level(1.33)];
+
+    it('picks the lowest level that is dense enough', () => {
+        expect(pickLevel(levels, 1)).toBe(levels[0]);
+        expect(pickLevel(levels, 0.75)).toBe(levels[0]);
+        expect(pickLevel(levels, 1.2)).toBe(levels[1]);
+    });
+
+    it('allows for rounded densities', () => {
+        expect(pickLevel(levels, 1.333)).toBe(levels[1]);
+    });
+
+    it('falls back to the highest level', () => {
+        expect(pickLevel(levels, 2)).toBe(levels[1]);
+        expect(pickLevel([], 1)).toBeUndefined();
+    });
+});